@@ -3,8 +3,9 @@
 import os
 import sys
 import shutil
-import tempfile
 import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as futures_wait
 from convertmusic.cmd import (
     OUTPUT, Cmd, Option, std_main, JsonOption, YamlOption
 )
@@ -15,15 +16,25 @@ from convertmusic.tools import (
     to_ascii,
     tag,
     set_tags_on_file,
-    FfProbeFactory,
+    set_tags_and_hash,
+    TagWriterPool,
     transcode,
-    get_destdir,
-    normalize_audio,
+    OutputLayout,
+    source_volume_increase,
 )
 from convertmusic.cache import MediaCache
 
 
-FF_PROBES = FfProbeFactory()
+_FF_PROBES = None
+
+
+def ff_probes():
+    """The FfProbeFactory, made on first use."""
+    global _FF_PROBES
+    if _FF_PROBES is None:
+        from convertmusic.tools import FfProbeFactory
+        _FF_PROBES = FfProbeFactory()
+    return _FF_PROBES
 
 
 def _do_check_file(fn, args):
@@ -104,6 +115,26 @@ the command name.
         return True, args
 
     def _cmd(self, history, args):
+        # (source file, transcoded file, tags) for each file written.
+        updates = []
+        with TagWriterPool() as writers:
+            ret = self._update_tags(history, args, writers, updates)
+            failed = set()
+            for filename, e in writers.wait():
+                OUTPUT.error("Couldn't update tags on file {0} ({1})".format(
+                    filename, e
+                ))
+                failed.add(filename)
+                ret = 1
+        # The database only gets the tags that made it into the transcoded
+        # file; a failed source file is only reported.
+        for fn, tn, new_tags in updates:
+            if tn not in failed:
+                history.set_tags_for(fn, new_tags)
+                history.set_transcoded_digest(tn, writers.digests[tn])
+        return ret
+
+    def _update_tags(self, history, args, writers, updates):
         OUTPUT.list_start('affected_files')
         for fn in history.get_source_files():
             tn = history.get_transcoded_to(fn)
@@ -133,17 +164,12 @@ the command name.
                 OUTPUT.dict_end()
 
                 if not PRETEND_MODE:
-                    if FF_PROBES.is_supported(fn):
+                    if ff_probes().is_supported(fn):
                         # Fix the source, too.
-                        try:
-                            set_tags_on_file(fn, new_tags)
-                            # TODO This will make the checksums wrong, but, meh.
-                        except Exception as e:
-                            OUTPUT.error("Couldn't update tags on source file {0} ({1})".format(
-                                fn, e
-                            ))
-                    set_tags_on_file(tn, new_tags)
-                    history.set_tags_for(fn, new_tags)
+                        # TODO This will make the checksums wrong, but, meh.
+                        writers.submit(fn, new_tags)
+                    writers.submit(tn, new_tags, rehash=True)
+                    updates.append((fn, tn, new_tags))
 
             OUTPUT.dict_end()
 
@@ -212,8 +238,9 @@ Tags will not be removed, only changed.
                     OUTPUT.dict_item(tag_name, tag_value)
                 OUTPUT.dict_end()
 
-                set_tags_on_file(tn, new_tags)
+                digest = set_tags_and_hash(tn, new_tags)
                 history.set_tags_for(fn, new_tags)
+                history.set_transcoded_digest(tn, digest)
 
             OUTPUT.dict_end()
 
@@ -284,24 +311,32 @@ class CmdTranscode(Cmd):
         self.desc = 'Transcode (or re-transcode) selected files.'
         self.help = """
 Usage:
-    transcode [-n] (file1 (file2 ...))
+    transcode [-n[=headroom]] (file1 (file2 ...))
 
-Transcodes all the discovered files.  If `-n` is given, then a normalization
-step is performed after transcoding.
+Transcodes all the discovered files.  If `-n` is given, then the audio is
+normalized while transcoding, leaving `headroom` dB (default 0.1) above the
+peak level.  The levels are measured on the source file once and remembered,
+so normalizing again with a different headroom is just the transcode.
 
 For this command, you must specify a path match for matching files after
 the command name.
 """
 
     def _parse_args(self, args):
-        normalize = False
-        if args[0] == '-n':
-            normalize = True
+        headroom = None
+        if len(args) > 0 and (args[0] == '-n' or args[0].startswith('-n=')):
+            headroom = 0.1
+            if args[0].startswith('-n='):
+                try:
+                    headroom = float(args[0][3:])
+                except ValueError:
+                    OUTPUT.error('headroom must be a decimal number, read {0}'.format(args[0][3:]))
+                    return False, []
             args = args[1:]
         if len(args) <= 0:
             OUTPUT.error('Must provide at least one file matching argument')
             return False, []
-        return True, [normalize, *args]
+        return True, [headroom, *args]
 
     def _cmd(self, history, args):
         # FIXME HAAAAAACK
@@ -309,7 +344,8 @@ the command name.
         base_destdir = sys.argv[1]
 
         probe_cache = MediaCache(history)
-        normalize = args[0]
+        layout = OutputLayout(base_destdir)
+        headroom = args[0]
         search_for = args[1:]
         OUTPUT.list_start('transcoded_files')
         for fn in history.get_source_files():
@@ -318,31 +354,28 @@ the command name.
             current = probe_cache.get(fn)
             OUTPUT.list_dict_start()
             OUTPUT.dict_item('source_file', fn)
-            destfile = transcode.transcode_correct_format(
-                history, current.probe, get_destdir(base_destdir), verbose=False
+            increase = None
+            if headroom is not None:
+                increase = source_volume_increase(history, current.probe, headroom)
+                if increase is None:
+                    print("Can't normalize.")
+                else:
+                    print("Increasing volume by {0:#.1f}dB".format(increase))
+            destfile, digest = transcode.transcode_with_digest(
+                history, current.probe, layout.get_destdir(), verbose=False, layout=layout,
+                volume=increase
             )
             OUTPUT.dict_item('transcoded_file', destfile)
             if destfile != current.transcoded_to:
                 if os.path.exists(current.transcoded_to):
                     os.replace(destfile, current.transcoded_to)
+                    layout.release(destfile)
                     destfile = current.transcoded_to
+                    history.set_transcoded_digest(destfile, digest)
                 else:
-                    current.set_transcoded_to(destfile)
-            if normalize:
-                output_fd, output_file = tempfile.mkstemp(
-                    suffix=os.path.splitext(destfile)[1])
-                try:
-                    headroom = 0.1
-                    print("Normalizing file by {1:#.1f} into {0}".format(output_file, headroom))
-                    os.close(output_fd)
-                    increase = normalize_audio(destfile, output_file, headroom)
-                    if increase is None:
-                        print("Can't normalize.")
-                    else:
-                        print("Increased volume by {0}dB".format(increase))
-                        shutil.copyfile(output_file, destfile)
-                finally:
-                    os.unlink(output_file)
+                    current.set_transcoded_to(destfile, digest)
+            else:
+                history.set_transcoded_digest(destfile, digest)
             OUTPUT.dict_end()
 
         OUTPUT.list_end()
@@ -350,6 +383,104 @@ the command name.
         return 0
 
 
+def _analyze_file(fn):
+    from convertmusic.tools.pcm_analysis import analyze_probe, default_analyzers
+    from convertmusic.tools.fingerprint import FingerprintAnalyzer
+    probe = probe_media_file(fn)
+    if probe is None:
+        return None, None
+    return probe, analyze_probe(probe, default_analyzers() + [FingerprintAnalyzer()])
+
+
+class CmdAnalyze(Cmd):
+    def __init__(self):
+        Cmd.__init__(self)
+        self.name = 'analyze'
+        self.desc = 'Analyse the audio of the source files.'
+        self.help = """
+Usage:
+    analyze [-f] [-j count] [(file1 (file2 ...))]
+
+Decodes each source file and finds its peak and RMS levels, level
+histogram, clipped samples, and leading and trailing silence, and its
+acoustic fingerprint.  The results are stored in the database; the levels
+are then used when normalizing, and the fingerprint when the import looks
+for the same song in a different encoding.
+
+Files already analysed are skipped, unless `-f` is given.  `-j` sets how
+many files are analysed at once (default: one per CPU).  If file matches
+are given, only the matching source files are analysed.
+
+Needs numpy.
+"""
+
+    def _parse_args(self, args):
+        force = False
+        jobs = os.cpu_count() or 1
+        while len(args) > 0 and args[0] in ('-f', '-j'):
+            if args[0] == '-f':
+                force = True
+                args = args[1:]
+                continue
+            if len(args) < 2 or not args[1].isdigit() or int(args[1]) <= 0:
+                OUTPUT.error('-j needs a positive number')
+                return False, []
+            jobs = int(args[1])
+            args = args[2:]
+        from convertmusic.tools import pcm_analysis
+        if not pcm_analysis.available():
+            OUTPUT.error('The analysis needs numpy installed')
+            return False, []
+        return True, [force, jobs, *args]
+
+    def _cmd(self, history, args):
+        force = args[0]
+        jobs = args[1]
+        search_for = args[2:]
+        ret = 0
+        OUTPUT.list_start('analyzed_files')
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            running = {}
+            files = iter(history.get_source_files())
+            while True:
+                # Keep a few files per worker queued, but don't queue the
+                # whole catalogue.
+                for fn in files:
+                    if not _do_check_file(fn, search_for):
+                        continue
+                    if not force and history.is_analyzed(fn):
+                        continue
+                    running[executor.submit(_analyze_file, fn)] = fn
+                    if len(running) >= jobs * 2:
+                        break
+                if len(running) <= 0:
+                    break
+                done, pending = futures_wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    fn = running.pop(future)
+                    try:
+                        probe, analysis = future.result()
+                    except Exception as e:
+                        OUTPUT.error('Could not analyse {0}: {1}'.format(fn, e))
+                        ret = 1
+                        continue
+                    if probe is None:
+                        ret = 1
+                        continue
+                    history.set_audio_analysis(probe, analysis)
+                    if analysis.fingerprint is not None:
+                        history.set_fingerprint(probe, analysis.fingerprint)
+                    history.checkpoint()
+                    OUTPUT.list_dict_start()
+                    OUTPUT.dict_item('source_file', fn)
+                    for k, v in analysis.as_dict().items():
+                        if k != 'histogram':
+                            OUTPUT.dict_item(k, v)
+                    OUTPUT.list_dict_end()
+        OUTPUT.list_end()
+        return ret
+
+
 class CmdCleanAbandonedEntries(Cmd):
     def __init__(self):
         Cmd.__init__(self)
@@ -443,6 +574,7 @@ if __name__ == '__main__':
         CmdUpdateSource(),
         CmdDeleteTransform(),
         CmdTranscode(),
+        CmdAnalyze(),
         CmdCleanAbandonedEntries(),
         CmdCleanOrphanTranscodeFiles(),
     ), (
@@ -1,4 +1,10 @@
 
-from . import tools
-from .db import MediaFileHistory, get_history
-from . import cmd
+from .lazy_import import lazy_attributes
+
+# Loaded on first use; see lazy_import.
+__getattr__ = lazy_attributes(__name__, globals(), {
+    'tools': ('.tools', None),
+    'cmd': ('.cmd', None),
+    'MediaFileHistory': '.db',
+    'get_history': '.db',
+})
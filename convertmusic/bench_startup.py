@@ -0,0 +1,128 @@
+"""
+Measures how long the command line tools take to start, with
+`python -X importtime`, and checks that the database tools don't load the
+media tools.
+
+Run with:
+
+    python3 -m convertmusic.bench_startup [script ...]
+
+The scripts default to all the tools in the top directory.  Each one is
+loaded (not run) a few times, and the best run is reported: the time spent
+in imports, the number of modules, and the slowest top level imports.
+Exits with 1 if one of the DATABASE_TOOLS imports any of the
+DATABASE_TOOLS_FORBIDDEN modules, or fails to load.
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+
+SCRIPTS = ('db-explore.py', 'manage-data.py', 'import.py', 'interactive.py', 'batch-update.py')
+# The tools that mostly work on the database; anything that needs the
+# media tools loads them when it runs.
+DATABASE_TOOLS = ('db-explore.py', 'manage-data.py')
+# Modules that the database tools have no use for at start up, which are
+# slow to load or need libxmp.
+DATABASE_TOOLS_FORBIDDEN = (
+    'convertmusic.tools.xmp_lib.libxmp',
+    'convertmusic.tools.xmp_lib.xmp_probe',
+    'convertmusic.tools.ffmpeg_bin.ffprobe',
+    'convertmusic.tools.pcm_analysis',
+    'numpy',
+    'asyncio',
+)
+REPEAT = 5
+
+_LOAD = "import runpy, sys; sys.argv = [{0!r}]; runpy.run_path({0!r}, run_name='bench_startup')"
+
+
+class StartupTime(object):
+    def __init__(self, script, returncode, elapsed, imports, error):
+        """
+        imports: list of (module, self microseconds, cumulative
+            microseconds, depth) in the order importtime reports them.
+        """
+        object.__init__(self)
+        self.script = script
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.imports = imports
+        self.error = error
+
+    @property
+    def modules(self):
+        return [i[0] for i in self.imports]
+
+    @property
+    def import_seconds(self):
+        return sum(i[1] for i in self.imports) / 1e6
+
+    def slowest(self, count):
+        top = [i for i in self.imports if i[3] == 0]
+        top.sort(key=lambda i: -i[2])
+        return top[0:count]
+
+
+def measure(base_dir, script):
+    """
+    Loads the script once under `-X importtime`, and returns its
+    StartupTime.
+    """
+    filename = os.path.join(base_dir, script)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [base_dir] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', _LOAD.format(filename)],
+        cwd=base_dir, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    imports = []
+    error = None
+    for line in p.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:'):
+            if len(line.strip()) > 0:
+                error = line.strip()
+            continue
+        parts = line[12:].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            # The header line.
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(parts[0]), int(parts[1]), depth))
+    return StartupTime(script, p.returncode, elapsed, imports, p.returncode != 0 and error or None)
+
+
+def best_of(base_dir, script, repeat=REPEAT):
+    runs = [measure(base_dir, script) for _ in range(max(1, repeat))]
+    return min(runs, key=lambda r: r.elapsed)
+
+
+def main(args):
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    scripts = args[1:] or SCRIPTS
+    failed = False
+    for script in scripts:
+        result = best_of(base_dir, script)
+        print('{0}: {1:.1f} ms to start, {2:.1f} ms importing {3} modules'.format(
+            script, result.elapsed * 1000, result.import_seconds * 1000, len(result.modules)))
+        for name, self_us, cumulative_us, depth in result.slowest(5):
+            print('    {0:8.1f} ms  {1}'.format(cumulative_us / 1000, name))
+        if result.error is not None:
+            print('    failed to load: {0}'.format(result.error))
+        if script in DATABASE_TOOLS:
+            if result.returncode != 0:
+                failed = True
+            loaded = [m for m in result.modules if m in DATABASE_TOOLS_FORBIDDEN]
+            if len(loaded) > 0:
+                print('    *** FAIL: imports {0}'.format(', '.join(loaded)))
+                failed = True
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
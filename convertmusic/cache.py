@@ -41,6 +41,10 @@ class MediaCache(object):
         self.__cache_by_filename[filename] = entry
         return entry
     
+    @property
+    def history(self):
+        return self._history
+
     def commit(self):
         dirty = []
         for entry in self.__cache_by_filename.values():
@@ -109,13 +113,15 @@ class MediaEntry(object):
             self.__probe = probe_media_file(self.__source)
         return self.__probe
     
-    def set_transcoded_to(self, destfile):
+    def set_transcoded_to(self, destfile, digest=None):
         # Update immediately the transcode.
         if destfile != self.__transcoded:
             if self.__transcoded is not None:
                 self.__history.delete_transcoded_to(self.probe)
             self.__transcoded = destfile
-            self.__history.transcoded_to(self.probe, destfile)       
+            self.__history.transcoded_to(self.probe, destfile, digest)
+        elif digest is not None:
+            self.__history.set_transcoded_digest(destfile, digest)
 
     @property
     def duplicate_filenames(self):
@@ -8,6 +8,7 @@ except:
 from .db import get_history
 from .tools.cli_output import OutlineOutput, JsonOutput, YamlOutput, Output
 from . import transform_db_path
+from . import profiling
 
 
 def stdout_writer(text):
@@ -122,6 +123,26 @@ class YamlOption(Option):
 
 YAML_OPTION = YamlOption()
 
+class ProfileOption(Option):
+    def __init__(self):
+        Option.__init__(self)
+        self.name = 'profile'
+        self.has_arg = True
+        self.help = 'Run the operation under a profiler, `cpu` or `mem`, and write the profile to a file'
+        self.mode = None
+
+    def process(self, arg):
+        error = profiling.check_mode(arg)
+        if error is not None:
+            print(error)
+            return 1
+        self.mode = arg
+        return 0
+
+
+# Added to every tool's options by std_main.
+PROFILE_OPTION = ProfileOption()
+
 STD_OPTIONS = (JSON_OPTION, YAML_OPTION)
 
 OUTPUT_TYPES = {
@@ -181,6 +202,8 @@ def std_main(args, commands, options=None):
     """
     if options is None:
         options = STD_OPTIONS
+    if PROFILE_OPTION not in options:
+        options = tuple(options) + (PROFILE_OPTION,)
     exec_name = args[0]
     cmd_args = args[1:]
     command_names = {}
@@ -203,15 +226,23 @@ def std_main(args, commands, options=None):
         if cmd_args[argp] in command_names:
             cmd = command_names[cmd_args[argp]]
             argp += 1
-            try:
-                history = get_history(media_db_file)
-            except Exception as e:
-                print("Problem loading database file: {0}".format(e))
+            profile_mode = PROFILE_OPTION.mode or profiling.mode_from_env()
+            error = profile_mode is not None and profiling.check_mode(profile_mode)
+            if error:
+                print(error)
                 return 1
-            try:
-                return cmd.run(history, cmd_args[argp:])
-            finally:
-                history.close()
+            profile_name = '{0}-{1}'.format(
+                os.path.splitext(os.path.basename(exec_name))[0], cmd.name)
+            with profiling.profiled(profile_name, profile_mode):
+                try:
+                    history = get_history(media_db_file)
+                except Exception as e:
+                    print("Problem loading database file: {0}".format(e))
+                    return 1
+                try:
+                    return cmd.run(history, cmd_args[argp:])
+                finally:
+                    history.close()
         found_option = False
         for option_name, option in option_names.items():
             if option.has_arg and cmd_args[argp].startswith(option_name):
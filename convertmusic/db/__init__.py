@@ -2,9 +2,22 @@
 from .api import MediaFileHistory
 
 
-def get_history(db_filename):
+def get_history(db_filename, work=None, lock=True):
+    """
+    Opens the database.  `work` is where to keep a working copy of it (see
+    working_copy.py); by default, the CONVERTMUSIC_DB_WORK setting.  With
+    `lock` False, the file is used directly and without the lock file, for
+    a quick look that shouldn't leave anything behind.
+    """
     from .schema import SCHEMA
     from .meta import Db
     from .impl import Impl
-    db = Db(db_filename, SCHEMA)
+    from .working_copy import WorkingCopy, working_copy_from_env
+    if not lock:
+        working_copy = None
+    elif work is None:
+        working_copy = working_copy_from_env(db_filename)
+    else:
+        working_copy = WorkingCopy(db_filename, work)
+    db = Db(db_filename, SCHEMA, working_copy, lock)
     return MediaFileHistory(Impl(db))
@@ -1,14 +1,22 @@
 
+import os
+import json
+import time
 from .db_api import DbApi
+from .path_index import PathIndex
 
 from ..tools.tag import *
 from ..tools.keywords import get_keywords_for_tags
+# The ffmpeg and analysis classes are imported where they're used, so that
+# reading the database doesn't load NumPy.
 
 
 class MediaFileHistory(object):
     def __init__(self, db):
         assert isinstance(db, DbApi)
         self.__db = db
+        # location -> [file fingerprint, failure count]; loaded on first use.
+        self.__probe_failures = None
 
     def __del__(self):
         self.close()
@@ -17,9 +25,24 @@ class MediaFileHistory(object):
         if self.__db is not None:
             self.__db.close()
 
+    def checkpoint(self, force=False):
+        """
+        Publishes the working copy of the database (see db/working_copy.py)
+        if it's used, and the checkpoint interval has passed or `force`.
+        """
+        return self.__db.checkpoint(force)
+
     def is_processed(self, filename):
         return self.__db.get_source_file_id(filename) is not None
 
+    def load_processed_index(self):
+        """
+        Returns a PathIndex of all the processed source files, for checking
+        many files without a query each.  Files processed later must be
+        added to it by the caller.
+        """
+        return PathIndex(self.__db.iter_source_files())
+
     def mark_duplicate(self, source_probe, duplicate_of_filename):
         duplicate_of_id = self.__db.get_source_file_id(duplicate_of_filename)
         if duplicate_of_id is None:
@@ -176,14 +199,30 @@ class MediaFileHistory(object):
                 ret.append(f)
         return ret
 
-    def transcoded_to(self, probe, target_file):
+    def transcoded_to(self, probe, target_file, digest=None):
         """
         Does not mark as found; that must be done outside of here.
+
+        digest: the (size, sha256) of the target file, if known.
         """
         s_id = self.__db.get_source_file_id(probe.filename)
         if s_id is None:
             raise Exception('No such known source {0}'.format(probe.filename))
-        self.__db.add_target_file(s_id, target_file)
+        if digest is None:
+            self.__db.add_target_file(s_id, target_file)
+        else:
+            self.__db.add_target_file(s_id, target_file, digest[0],
+                _mtime_ns(target_file), digest[1])
+
+    def set_transcoded_digest(self, target_file, digest, local_file=None):
+        """
+        Records the new (size, sha256) of a target file that was rewritten.
+
+        local_file: where the target file is now, if it moved since it was
+            recorded (see transform_db_path).
+        """
+        self.__db.set_target_file_hashes([
+            (target_file, digest[0], _mtime_ns(local_file or target_file), digest[1])])
 
     def get_transcoded_to(self, probe_or_filename):
         if not isinstance(probe_or_filename, str):
@@ -207,9 +246,191 @@ class MediaFileHistory(object):
     def get_transcoded_filenames(self, like=None):
         return self.__db.find_target_files(like)
     
+    def get_transcoded_file_hashes(self):
+        """
+        Returns a list of (target file, size, modification time ns, sha256)
+        for every transcoded file, as last recorded by
+        `set_transcoded_file_hashes`.  Unrecorded values are None.
+        """
+        return list(self.__db.iter_target_file_hashes())
+
+    def set_transcoded_file_hashes(self, rows):
+        """
+        rows: list of (target file, size, modification time ns, sha256).
+        """
+        if len(rows) > 0:
+            self.__db.set_target_file_hashes(rows)
+
     def is_transcoded_filename(self, name):
         return self.__db.get_source_file_for_target_file(name) is not None
 
+    def get_volume_levels(self, probe):
+        """
+        Returns the VolumeLevel stored for the probed source, or None if it
+        wasn't measured or the file changed since it was.
+        """
+        s_id = self.__db.get_source_file_id(probe.filename)
+        if s_id is None:
+            return None
+        stored = self.__db.get_volume_level(s_id)
+        if stored is None or stored[0] != probe.tag('sha256'):
+            return None
+        from ..tools.ffmpeg_bin.ffmpeg import VolumeLevel
+        return VolumeLevel(stored[2], stored[1], {})
+
+    def set_volume_levels(self, probe, volume_levels):
+        """
+        Stores the measured VolumeLevel for the probed source.  Returns False
+        if the source isn't known.
+        """
+        s_id = self.__db.get_source_file_id(probe.filename)
+        if s_id is None:
+            return False
+        self.__db.set_volume_level(s_id, probe.tag('sha256'),
+            volume_levels.max, volume_levels.mean)
+        return True
+
+    def is_analyzed(self, filename):
+        s_id = self.__db.get_source_file_id(filename)
+        return s_id is not None and self.__db.get_audio_analysis(s_id) is not None
+
+    def get_audio_analysis(self, probe):
+        """
+        Returns the AudioAnalysis stored for the probed source, or None if it
+        wasn't analysed or the file changed since it was.
+        """
+        s_id = self.__db.get_source_file_id(probe.filename)
+        if s_id is None:
+            return None
+        stored = self.__db.get_audio_analysis(s_id)
+        if stored is None or stored[0] != probe.tag('sha256'):
+            return None
+        from ..tools.pcm_analysis import AudioAnalysis
+        return AudioAnalysis({
+            'duration': stored[1],
+            'peak_db': stored[2],
+            'rms_db': stored[3],
+            'clipped_samples': stored[4],
+            'leading_silence': stored[5],
+            'trailing_silence': stored[6],
+            'histogram': stored[7] and json.loads(stored[7]) or {},
+        })
+
+    def set_audio_analysis(self, probe, analysis):
+        """
+        Stores the AudioAnalysis for the probed source, along with its volume
+        levels.  Returns False if the source isn't known.
+        """
+        s_id = self.__db.get_source_file_id(probe.filename)
+        if s_id is None:
+            return False
+        source_hash = probe.tag('sha256')
+        self.__db.set_audio_analysis(s_id, source_hash,
+            analysis.duration, analysis.peak_db, analysis.rms_db,
+            analysis.clipped_samples, analysis.leading_silence,
+            analysis.trailing_silence, json.dumps(analysis.histogram, sort_keys=True))
+        self.__db.set_volume_level(s_id, source_hash, analysis.peak_db, analysis.rms_db)
+        return True
+
+    def set_fingerprint(self, probe, fingerprint):
+        """
+        Stores the acoustic Fingerprint, and the audio length, for the probed
+        source.  Returns False if the source isn't known.
+        """
+        s_id = self.__db.get_source_file_id(probe.filename)
+        if s_id is None:
+            return False
+        self.__db.set_fingerprint(s_id, probe.tag('sha256'), fingerprint.to_hex(),
+            fingerprint.keys(), probe.duration)
+        return True
+
+    def has_fingerprint(self, filename):
+        s_id = self.__db.get_source_file_id(filename)
+        return s_id is not None and self.__db.get_fingerprint(s_id) is not None
+
+    def get_audio_matches(self, probe, fingerprint, similarity=None):
+        """
+        Returns the source files that sound the same as the fingerprint, as
+        a list of [file name, similarity], best match first.  The probed
+        file itself isn't included, and neither are files of a different
+        length (or of an unknown length).
+        """
+        from ..tools.fingerprint import (
+            Fingerprint, MATCH_SIMILARITY, MAX_CANDIDATES,
+            common_key_limit, min_key_hits, duration_range
+        )
+        if similarity is None:
+            similarity = MATCH_SIMILARITY
+        if probe.duration is None:
+            return []
+        own_id = self.__db.get_source_file_id(probe.filename)
+        keys = fingerprint.keys()
+        limit = common_key_limit(self.__db.count_fingerprints())
+        key_counts = self.__db.get_fingerprint_key_counts(keys)
+        keys = [k for k in keys if key_counts.get(k, 0) <= limit]
+        min_duration, max_duration = duration_range(probe.duration)
+        ret = []
+        for s_id, stored in self.__db.find_fingerprint_candidates(
+                keys, min_key_hits(len(keys)), min_duration, max_duration, MAX_CANDIDATES):
+            if s_id == own_id:
+                continue
+            score = fingerprint.similarity(Fingerprint.from_hex(stored))
+            if score >= similarity:
+                ret.append([self.__db.get_source_file_for_id(s_id), score])
+        ret.sort(key=lambda m: -m[1])
+        return ret
+
+    def is_quarantined(self, filename):
+        """
+        True if the file failed to probe before and hasn't changed since.
+        """
+        failure = self.__get_probe_failures().get(filename)
+        if failure is None:
+            return False
+        try:
+            return failure[0] == file_fingerprint(filename)
+        except OSError:
+            return True
+
+    def mark_probe_failure(self, filename, error):
+        failures = self.__get_probe_failures()
+        try:
+            fingerprint = file_fingerprint(filename)
+        except OSError:
+            fingerprint = None
+        count = filename in failures and failures[filename][1] + 1 or 1
+        self.__db.set_probe_failure(filename, fingerprint, str(error), count, time.time())
+        failures[filename] = [fingerprint, count]
+
+    def clear_probe_failure(self, filename):
+        """Forgets the file's probe failure, if it had one."""
+        failures = self.__get_probe_failures()
+        if filename in failures:
+            del failures[filename]
+            self.__db.delete_probe_failure(filename)
+
+    def get_probe_failures(self, like=None):
+        """
+        Returns a list of dictionaries describing each probe failure.
+        """
+        ret = []
+        for location, fingerprint, error, count, when in self.__db.get_probe_failures(like):
+            ret.append({
+                'source': location,
+                'file_fingerprint': fingerprint,
+                'error': error,
+                'failure_count': count,
+                'last_failure': when,
+            })
+        return ret
+
+    def __get_probe_failures(self):
+        if self.__probe_failures is None:
+            self.__probe_failures = {}
+            for row in self.__db.get_probe_failures():
+                self.__probe_failures[row[0]] = [row[1], row[3]]
+        return self.__probe_failures
+
     def get_duplicates(self, probe_or_filename):
         if not isinstance(probe_or_filename, str):
             probe_or_filename = probe_or_filename.filename
@@ -236,6 +457,22 @@ class MediaFileHistory(object):
         return id
 
 
+def _mtime_ns(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
+def file_fingerprint(filename):
+    """
+    A cheap identity for the file's contents: its size and modification
+    time.
+    """
+    st = os.stat(filename)
+    return '{0}:{1}'.format(st.st_size, st.st_mtime_ns)
+
+
 def _get_probe_keywords(probe):
     return get_keywords_for_tags(probe.get_tags())
 
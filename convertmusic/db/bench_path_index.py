@@ -0,0 +1,102 @@
+"""
+Benchmarks the processed file index (PathIndex) against a query for each
+file, on a generated catalogue.
+
+Run with:
+
+    python3 -m convertmusic.db.bench_path_index [file count] [media.db]
+
+The file count defaults to one million.  If a media.db is given, its
+source files are used instead of a generated catalogue.  Reports the time
+to load the index, its memory use, and the lookup rate for known and new
+files.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import tracemalloc
+from . import get_history
+
+
+def make_catalogue(db_file, count):
+    """
+    Fills the database with `count` source files, with paths like a real
+    music library.
+    """
+    history = get_history(db_file)
+    history.close()
+    conn = sqlite3.connect(db_file)
+    conn.executemany('INSERT INTO SOURCE_FILE (source_location) VALUES (?)',
+        (('/music/Artist {0}/Album {1}/{2:02d} - Song number {3}.mp3'.format(
+            i // 200, i // 12, i % 12 + 1, i),) for i in range(count)))
+    conn.commit()
+    conn.close()
+
+
+def _rate(count, elapsed):
+    return count / max(elapsed, 1e-9)
+
+
+def bench(db_file, sample=20000):
+    history = get_history(db_file)
+    try:
+        known = list(history.get_source_files())[0:sample]
+        new = ['/music/new/{0}.mp3'.format(i) for i in range(sample)]
+
+        index = history.load_processed_index()
+        print('{0:>10} files indexed'.format(len(index)))
+        print('{0:10.3f}s  load time'.format(index.load_seconds))
+        print('{0:10.1f}MB index size ({1:.1f} bytes per file)'.format(
+            index.size_bytes / 1048576.0, index.size_bytes / max(len(index), 1)))
+        # Load again while tracing, which is much slower, for the memory use.
+        del index
+        tracemalloc.start()
+        index = history.load_processed_index()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{0:10.1f}MB traced memory after load, {1:.1f}MB peak while loading'.format(
+            current / 1048576.0, peak / 1048576.0))
+
+        for name, names in (('known', known), ('new', new)):
+            start = time.perf_counter()
+            for n in names:
+                n in index
+            index_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for n in names:
+                history.is_processed(n)
+            query_time = time.perf_counter() - start
+            print('{0:>10} lookups: index {1:12.0f}/s   query {2:12.0f}/s'.format(
+                name, _rate(len(names), index_time), _rate(len(names), query_time)))
+    finally:
+        history.close()
+
+
+def main(args):
+    count = 1000000
+    db_file = None
+    if len(args) > 1:
+        count = int(args[1])
+    if len(args) > 2:
+        db_file = args[2]
+    tmp = None
+    if db_file is None:
+        fd, tmp = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(tmp)
+        print('(generating {0} files)'.format(count))
+        make_catalogue(tmp, count)
+        db_file = tmp
+    try:
+        bench(db_file)
+    finally:
+        if tmp is not None:
+            os.unlink(tmp)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -17,6 +17,12 @@ class DbApi(object):
         """
         raise NotImplementedError()
 
+    def iter_source_files(self):
+        """
+        Yields every source file name.
+        """
+        raise NotImplementedError()
+
     def add_tag(self, file_id, tag_name, tag_value):
         """
         Returns the ID of the tag.
@@ -29,9 +35,23 @@ class DbApi(object):
         """
         raise NotImplementedError()
 
-    def add_target_file(self, source_file_id, target_filename):
+    def add_target_file(self, source_file_id, target_filename, size=None, mtime_ns=None, sha256=None):
         """
-        Returns the ID of the target file.
+        Returns the ID of the target file.  The size, modification time and
+        sha256 of the target are recorded if known.
+        """
+        raise NotImplementedError()
+
+    def iter_target_file_hashes(self):
+        """
+        Yields (target location, size, modification time ns, sha256) for
+        every target file; the last three are None if not yet recorded.
+        """
+        raise NotImplementedError()
+
+    def set_target_file_hashes(self, rows):
+        """
+        rows: list of (target location, size, modification time ns, sha256).
         """
         raise NotImplementedError()
 
@@ -59,6 +79,75 @@ class DbApi(object):
         """
         raise NotImplementedError()
 
+    def set_volume_level(self, source_id, source_hash, max_volume, mean_volume):
+        raise NotImplementedError()
+
+    def get_volume_level(self, source_id):
+        """
+        Returns the (source hash, max volume, mean volume) for the source
+        file, or None if it wasn't measured.
+        """
+        raise NotImplementedError()
+
+    def set_audio_analysis(self, source_id, source_hash, duration, peak_db, rms_db,
+            clipped_samples, leading_silence, trailing_silence, histogram):
+        raise NotImplementedError()
+
+    def get_audio_analysis(self, source_id):
+        """
+        Returns the (source hash, duration, peak dB, RMS dB, clipped samples,
+        leading silence, trailing silence, histogram JSON) for the source
+        file, or None if it wasn't analysed.
+        """
+        raise NotImplementedError()
+
+    def set_fingerprint(self, source_id, source_hash, fingerprint, keys, duration):
+        raise NotImplementedError()
+
+    def get_fingerprint(self, source_id):
+        """
+        Returns the (source hash, fingerprint) for the source file, or None.
+        """
+        raise NotImplementedError()
+
+    def count_fingerprints(self):
+        raise NotImplementedError()
+
+    def get_fingerprint_key_counts(self, keys):
+        """
+        Returns {key: number of files with the key} for the fingerprint
+        keys stored for any file.
+        """
+        raise NotImplementedError()
+
+    def find_fingerprint_candidates(self, keys, min_hits, min_duration, max_duration, limit):
+        """
+        Returns the [source file ID, fingerprint] of the files between
+        min_duration and max_duration seconds long that share at least
+        min_hits of the fingerprint keys, most shared keys first.
+        """
+        raise NotImplementedError()
+
+    def set_probe_failure(self, location, file_fingerprint, error, failure_count, last_failure):
+        raise NotImplementedError()
+
+    def delete_probe_failure(self, location):
+        raise NotImplementedError()
+
+    def get_probe_failures(self, like=None):
+        """
+        Returns a list of (location, file fingerprint, error, failure count,
+        last failure time).
+        """
+        raise NotImplementedError()
+
+    def checkpoint(self, force=False):
+        """
+        Publishes the working copy of the database, if it's used and due.
+        Returns True if it was published.
+        """
+        raise NotImplementedError()
+
     def close(self):
         """Close the connection."""
         raise NotImplementedError()
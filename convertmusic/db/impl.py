@@ -17,6 +17,9 @@ class Impl(DbApi):
             self.__db.close()
             self.__db = None
 
+    def checkpoint(self, force=False):
+        return self.__db.checkpoint(force)
+
     def add_source_file(self, filename):
         """
         Returns the ID for the source file.  Raises exception if it
@@ -39,6 +42,13 @@ class Impl(DbApi):
             break
         return ret
 
+    def iter_source_files(self):
+        """
+        Yields every source file name, streamed from the database.
+        """
+        for r in self.__db.query('SELECT source_location FROM SOURCE_FILE'):
+            yield r[0]
+
     def get_source_file_for_id(self, source_file_id):
         c = self.__db.query(
             "SELECT source_location FROM SOURCE_FILE WHERE source_file_id = ?",
@@ -93,12 +103,24 @@ class Impl(DbApi):
             ret[r[0]] = r[1]
         return ret
 
-    def add_target_file(self, source_file_id, target_filename):
+    def add_target_file(self, source_file_id, target_filename, size=None, mtime_ns=None, sha256=None):
         """
         Returns the ID of the target file.
         """
         return self.__db.table('TARGET_FILE').insert(
-            source_file_id, target_filename
+            source_file_id, target_filename, size, mtime_ns, sha256
+        )
+
+    def iter_target_file_hashes(self):
+        for r in self.__db.query(
+                'SELECT target_location, target_size, target_mtime_ns, target_hash FROM TARGET_FILE'):
+            yield tuple(r)
+
+    def set_target_file_hashes(self, rows):
+        self.__db.table('TARGET_FILE').update_many(
+            ['target_size', 'target_mtime_ns', 'target_hash'],
+            'target_location = ?',
+            [[r[1], r[2], r[3], r[0]] for r in rows]
         )
 
     def get_target_file(self, source_file_id):
@@ -365,6 +387,22 @@ class Impl(DbApi):
             "source_file_id = ?",
             source_id
         )
+        self.__db.table('VOLUME_LEVEL').delete_where(
+            "source_file_id = ?",
+            source_id
+        )
+        self.__db.table('AUDIO_ANALYSIS').delete_where(
+            "source_file_id = ?",
+            source_id
+        )
+        self.__db.table('AUDIO_FINGERPRINT').delete_where(
+            "source_file_id = ?",
+            source_id
+        )
+        self.__db.table('FINGERPRINT_KEY').delete_where(
+            "source_file_id = ?",
+            source_id
+        )
         return self.__db.table('SOURCE_FILE').delete_by_id(source_id)
 
     def delete_transcoded_file_for_source_id(self, source_id):
@@ -373,6 +411,182 @@ class Impl(DbApi):
             source_id
         )
 
+    def set_volume_level(self, source_id, source_hash, max_volume, mean_volume):
+        self.__db.table('VOLUME_LEVEL').delete_where(
+            "source_file_id = ?",
+            source_id
+        )
+        return self.__db.table('VOLUME_LEVEL').insert(
+            source_id, source_hash, max_volume, mean_volume
+        )
+
+    def get_volume_level(self, source_id):
+        """
+        Returns the (source hash, max volume, mean volume) for the source
+        file, or None if it wasn't measured.
+        """
+        c = self.__db.query(
+            'SELECT source_hash, max_volume, mean_volume FROM VOLUME_LEVEL WHERE source_file_id = ?',
+            source_id
+        )
+        ret = None
+        for r in c:
+            ret = (r[0], r[1], r[2])
+            c.close()
+            break
+        return ret
+
+    def set_audio_analysis(self, source_id, source_hash, duration, peak_db, rms_db,
+            clipped_samples, leading_silence, trailing_silence, histogram):
+        self.__db.table('AUDIO_ANALYSIS').delete_where(
+            "source_file_id = ?",
+            source_id
+        )
+        return self.__db.table('AUDIO_ANALYSIS').insert(
+            source_id, source_hash, duration, peak_db, rms_db,
+            clipped_samples, leading_silence, trailing_silence, histogram
+        )
+
+    def get_audio_analysis(self, source_id):
+        """
+        Returns the (source hash, duration, peak dB, RMS dB, clipped samples,
+        leading silence, trailing silence, histogram JSON) for the source
+        file, or None if it wasn't analysed.
+        """
+        c = self.__db.query(
+            '''SELECT source_hash, duration, peak_db, rms_db, clipped_samples,
+                leading_silence, trailing_silence, histogram
+            FROM AUDIO_ANALYSIS WHERE source_file_id = ?''',
+            source_id
+        )
+        ret = None
+        for r in c:
+            ret = tuple(r)
+            c.close()
+            break
+        return ret
+
+    def set_fingerprint(self, source_id, source_hash, fingerprint, keys, duration):
+        self.__db.table('AUDIO_FINGERPRINT').delete_where(
+            "source_file_id = ?",
+            source_id
+        )
+        self.__db.table('FINGERPRINT_KEY').delete_where(
+            "source_file_id = ?",
+            source_id
+        )
+        self.__db.table('FINGERPRINT_KEY').insert_many(
+            [(source_id, k) for k in keys]
+        )
+        return self.__db.table('AUDIO_FINGERPRINT').insert(
+            source_id, source_hash, fingerprint, duration
+        )
+
+    def get_fingerprint(self, source_id):
+        """
+        Returns the (source hash, fingerprint) for the source file, or None.
+        """
+        c = self.__db.query(
+            'SELECT source_hash, fingerprint FROM AUDIO_FINGERPRINT WHERE source_file_id = ?',
+            source_id
+        )
+        ret = None
+        for r in c:
+            ret = (r[0], r[1])
+            c.close()
+            break
+        return ret
+
+    def count_fingerprints(self):
+        c = self.__db.query('SELECT COUNT(*) FROM AUDIO_FINGERPRINT')
+        ret = 0
+        for r in c:
+            ret = r[0]
+            c.close()
+            break
+        return ret
+
+    def get_fingerprint_key_counts(self, keys):
+        """
+        Returns {key: number of files with the key} for the fingerprint
+        keys stored for any file.
+        """
+        if len(keys) <= 0:
+            return {}
+        c = self.__db.query('''
+            SELECT fingerprint_key, COUNT(*)
+            FROM FINGERPRINT_KEY
+            WHERE fingerprint_key IN ({0})
+            GROUP BY fingerprint_key
+            '''.format(','.join('?' * len(keys))),
+            *keys
+        )
+        ret = {}
+        for r in c:
+            ret[r[0]] = r[1]
+        return ret
+
+    def find_fingerprint_candidates(self, keys, min_hits, min_duration, max_duration, limit):
+        """
+        Returns the [source file ID, fingerprint] of the files between
+        min_duration and max_duration seconds long that share at least
+        min_hits of the fingerprint keys, most shared keys first.
+        """
+        if len(keys) <= 0:
+            return []
+        c = self.__db.query('''
+            SELECT k.source_file_id, f.fingerprint, COUNT(*) AS hits
+            FROM FINGERPRINT_KEY k
+            INNER JOIN AUDIO_FINGERPRINT f ON f.source_file_id = k.source_file_id
+            WHERE k.fingerprint_key IN ({0})
+                AND f.duration BETWEEN ? AND ?
+            GROUP BY k.source_file_id, f.fingerprint
+            HAVING COUNT(*) >= ?
+            ORDER BY hits DESC
+            LIMIT ?
+            '''.format(','.join('?' * len(keys))),
+            *keys, min_duration, max_duration, min_hits, limit
+        )
+        ret = []
+        for r in c:
+            ret.append((r[0], r[1]))
+        return ret
+
+    def set_probe_failure(self, location, file_fingerprint, error, failure_count, last_failure):
+        self.__db.table('PROBE_FAILURE').delete_where(
+            "source_location = ?",
+            location
+        )
+        return self.__db.table('PROBE_FAILURE').insert(
+            location, file_fingerprint, error, failure_count, last_failure
+        )
+
+    def delete_probe_failure(self, location):
+        return self.__db.table('PROBE_FAILURE').delete_where(
+            "source_location = ?",
+            location
+        )
+
+    def get_probe_failures(self, like=None):
+        """
+        Returns a list of (location, file fingerprint, error, failure count,
+        last failure time).
+        """
+        if like is None:
+            c = self.__db.query('''
+                SELECT source_location, file_fingerprint, error, failure_count, last_failure
+                FROM PROBE_FAILURE
+                ''')
+        else:
+            c = self.__db.query('''
+                SELECT source_location, file_fingerprint, error, failure_count, last_failure
+                FROM PROBE_FAILURE WHERE source_location LIKE ?
+                ''', like)
+        ret = []
+        for r in c:
+            ret.append(tuple(r))
+        return ret
+
     def get_source_files_without_tag_names(self, tag_names):
         ret = set()
         # Need to perform the query for every tag name, individually.
@@ -1,14 +1,17 @@
 
 import sqlite3
 import os
+from .working_copy import DbLock
+from .sql_stats import stats_from_env
 
 
 class Table(object):
-    def __init__(self, conn, table_name, columns):
+    def __init__(self, conn, table_name, columns, indexes=None):
         """
         columns: list of columns, which is itself a list of:
             column name, column SQL type, default value, is index.
             First column is always the primary key (never inserted)
+        indexes: list of column name lists, each one indexed.
         """
         object.__init__(self)
         self.__name = table_name
@@ -25,8 +28,20 @@ class Table(object):
                 upgrade = True
         c.close()
         if upgrade:
-            # TODO allow upgrade
-            pass
+            # Add the columns that are new since the table was created.
+            # SQLite can only add plain columns, so constraints other than
+            # the default are dropped.
+            existing = set()
+            c = conn.execute('PRAGMA table_info({0})'.format(table_name))
+            for row in c:
+                existing.add(row[1].lower())
+            c.close()
+            for c in columns:
+                if c[0].lower() not in existing:
+                    s = 'ALTER TABLE {0} ADD COLUMN {1} {2}'.format(table_name, c[0], c[1])
+                    if len(c) > 2 and c[2] is not None:
+                        s += ' DEFAULT {0}'.format(c[2])
+                    conn.execute(s)
         else:
             col_sql = []
             for c in columns:
@@ -38,6 +53,10 @@ class Table(object):
                 col_sql.append(s)
             sql = 'CREATE TABLE {0} ({1})'.format(table_name, ','.join(col_sql))
             conn.execute(sql)
+        # Indexes can be added to existing tables.
+        for index_columns in (indexes or []):
+            conn.execute('CREATE INDEX IF NOT EXISTS {0}_{1}_IDX ON {0} ({2})'.format(
+                table_name, '_'.join(index_columns), ','.join(index_columns)))
         conn.commit()
 
     def insert(self, *values):
@@ -52,6 +71,40 @@ class Table(object):
         self.__conn.commit()
         return r
 
+    def insert_many(self, rows):
+        """
+        Inserts each row (a list of values), in one transaction.
+        """
+        c = self.__conn.executemany("INSERT INTO {0} ({1}) VALUES ({2})".format(
+            self.__name, ','.join(self.__insert_column_names),
+            ','.join('?' * len(self.__insert_column_names))
+        ), rows)
+        c.close()
+        self.__conn.commit()
+
+    def update_where(self, column_names, where_clause, *values):
+        """
+        Sets the columns for the matching rows.  The values are the new
+        column values, followed by the where clause values.
+        """
+        c = self.__conn.execute('UPDATE {0} SET {1} WHERE {2}'.format(
+            self.__name, ','.join('{0} = ?'.format(n) for n in column_names),
+            where_clause), values)
+        ret = c.rowcount
+        c.close()
+        self.__conn.commit()
+        return ret
+
+    def update_many(self, column_names, where_clause, rows):
+        """
+        `update_where` for each row of values, in one transaction.
+        """
+        c = self.__conn.executemany('UPDATE {0} SET {1} WHERE {2}'.format(
+            self.__name, ','.join('{0} = ?'.format(n) for n in column_names),
+            where_clause), rows)
+        c.close()
+        self.__conn.commit()
+
     def delete_by_id(self, id):
         try:
             c = self.__conn.execute("DELETE FROM {0} WHERE {1} = ?".format(
@@ -88,6 +141,7 @@ class TableDef(object):
         object.__init__(self)
         self.__name = name
         self.__columns = []
+        self.__indexes = []
         if columns is not None:
             self.__columns.extend(columns)
 
@@ -95,6 +149,10 @@ class TableDef(object):
         self.__columns.append([name, type, default, index])
         return self
 
+    def with_index(self, *column_names):
+        self.__indexes.append(list(column_names))
+        return self
+
     @property
     def name(self):
         return self.__name
@@ -103,18 +161,35 @@ class TableDef(object):
     def columns(self):
         return self.__columns
 
+    @property
+    def indexes(self):
+        return self.__indexes
+
 
 class Db(object):
-    def __init__(self, filename, table_defs):
+    def __init__(self, filename, table_defs, working_copy=None, lock=True):
         """
         table_defs: list of TableDef instances.
+        working_copy: WorkingCopy to run against, instead of the file.
+        lock: False to use the file without the lock file (see DbLock).
         """
         object.__init__(self)
-        self.__conn = sqlite3.connect(filename)
+        self.__working_copy = working_copy
+        self.__lock = None
+        self.__conn = None
+        if working_copy is not None:
+            self.__conn = working_copy.open()
+        else:
+            if lock and filename != ':memory:':
+                self.__lock = DbLock(filename, False).acquire()
+            self.__conn = sqlite3.connect(filename)
+        stats = stats_from_env()
+        if stats is not None:
+            self.__conn = stats.wrap(self.__conn)
         self.__tables = {}
         for td in table_defs:
             assert isinstance(td, TableDef)
-            t = Table(self.__conn, td.name, td.columns)
+            t = Table(self.__conn, td.name, td.columns, td.indexes)
             self.__tables[td.name] = t
 
     def __del__(self):
@@ -122,8 +197,22 @@ class Db(object):
 
     def close(self):
         if self.__conn is not None:
-            self.__conn.close()
+            if self.__working_copy is not None:
+                self.__working_copy.close(self.__conn)
+            else:
+                self.__conn.close()
             self.__conn = None
+        if self.__lock is not None:
+            self.__lock.release()
+            self.__lock = None
+
+    def checkpoint(self, force=False):
+        """
+        Publishes the working copy, if there is one, and it's due.
+        """
+        if self.__working_copy is not None and self.__conn is not None:
+            return self.__working_copy.checkpoint(self.__conn, force)
+        return False
 
     def query(self, query, *values):
         """
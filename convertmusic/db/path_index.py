@@ -0,0 +1,66 @@
+"""
+In-memory index of the processed source file names, so that the import can
+skip known files without a database query for each one.
+
+The names are kept as a sorted array of 64 bit hashes (8 bytes per file),
+rather than a set of strings (well over 100 bytes per file).  The hash is
+Python's own string hash, which is fine because the index is rebuilt in
+each process.  Two different names sharing a 64 bit hash is vanishingly
+unlikely (around 1 in 10^13 for a million files), and would only make the
+import skip that one file.
+"""
+
+import sys
+import time
+from array import array
+from bisect import bisect_left
+
+
+HASH_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def _hash(name):
+    return hash(name) & HASH_MASK
+
+
+class PathIndex(object):
+    def __init__(self, names=()):
+        """
+        names: iterable of the known source file names.
+        """
+        object.__init__(self)
+        start = time.perf_counter()
+        hashes = [_hash(n) for n in names]
+        hashes.sort()
+        self.__hashes = array('Q', hashes)
+        del hashes
+        # Names added after loading.
+        self.__added = set()
+        self.load_seconds = time.perf_counter() - start
+
+    def __contains__(self, name):
+        if name in self.__added:
+            return True
+        h = _hash(name)
+        i = bisect_left(self.__hashes, h)
+        return i < len(self.__hashes) and self.__hashes[i] == h
+
+    def __len__(self):
+        return len(self.__hashes) + len(self.__added)
+
+    def add(self, name):
+        self.__added.add(name)
+
+    @property
+    def size_bytes(self):
+        """Approximate memory used by the index."""
+        return (self.__hashes.itemsize * len(self.__hashes)
+            + sys.getsizeof(self.__added)
+            + sum(sys.getsizeof(n) for n in self.__added))
+
+    def stats(self):
+        return {
+            'files': len(self),
+            'load_seconds': round(self.load_seconds, 3),
+            'size_bytes': self.size_bytes,
+        }
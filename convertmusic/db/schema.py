@@ -6,10 +6,16 @@ SCHEMA = (
     TableDef('SOURCE_FILE')
         .with_column('source_file_id', 'INTEGER', None, 'PRIMARY KEY')
         .with_column('source_location', 'VARCHAR', None, 'UNIQUE'),
+    # The target size, modification time and sha256 are recorded when the
+    # file is hashed, so that a later sync only needs to rehash files that
+    # changed.
     TableDef('TARGET_FILE', columns=[
         ['target_file_id', 'INTEGER', None, 'PRIMARY KEY'],
         ['source_file_id', 'INTEGER', None, 'UNIQUE'],
-        ['target_location', 'VARCHAR', None, 'UNIQUE']
+        ['target_location', 'VARCHAR', None, 'UNIQUE'],
+        ['target_size', 'INTEGER'],
+        ['target_mtime_ns', 'INTEGER'],
+        ['target_hash', 'VARCHAR']
     ]),
     TableDef('TAG', columns=[
         ['tag_id', 'INTEGER', None, 'PRIMARY KEY'],
@@ -31,5 +37,60 @@ SCHEMA = (
         ['duplicate_id', 'INTEGER', None, 'PRIMARY KEY'],
         ['source_file_id', 'INTEGER', None, 'UNIQUE'],
         ['duplicate_of_source_file_id', 'INTEGER']
+    ]),
+
+    # Volume levels measured on the source file, so that normalizing doesn't
+    # need an analysis pass each time.  The source hash is the file's sha256
+    # when it was measured; if the file changes, the levels are stale.
+    TableDef('VOLUME_LEVEL', [
+        ['volume_level_id', 'INTEGER', None, 'PRIMARY KEY'],
+        ['source_file_id', 'INTEGER', None, 'UNIQUE'],
+        ['source_hash', 'VARCHAR'],
+        ['max_volume', 'REAL'],
+        ['mean_volume', 'REAL']
+    ]),
+
+    # Results of the PCM analysis of the source file.  The histogram is the
+    # JSON object of whole dB below full scale -> sample count.
+    TableDef('AUDIO_ANALYSIS', [
+        ['audio_analysis_id', 'INTEGER', None, 'PRIMARY KEY'],
+        ['source_file_id', 'INTEGER', None, 'UNIQUE'],
+        ['source_hash', 'VARCHAR'],
+        ['duration', 'REAL'],
+        ['peak_db', 'REAL'],
+        ['rms_db', 'REAL'],
+        ['clipped_samples', 'INTEGER'],
+        ['leading_silence', 'REAL'],
+        ['trailing_silence', 'REAL'],
+        ['histogram', 'VARCHAR']
+    ]),
+
+    # Acoustic fingerprint of the source file (hex string; see
+    # tools/fingerprint.py), and each of its distinct frame codes, indexed
+    # for finding the same audio in other files.
+    TableDef('AUDIO_FINGERPRINT', [
+        ['audio_fingerprint_id', 'INTEGER', None, 'PRIMARY KEY'],
+        ['source_file_id', 'INTEGER', None, 'UNIQUE'],
+        ['source_hash', 'VARCHAR'],
+        ['fingerprint', 'VARCHAR'],
+        # Length of the source audio in seconds, or NULL if not known.
+        ['duration', 'REAL']
+    ]),
+    TableDef('FINGERPRINT_KEY', [
+        ['fingerprint_key_id', 'INTEGER', None, 'PRIMARY KEY'],
+        ['source_file_id', 'INTEGER'],
+        ['fingerprint_key', 'INTEGER']
+    ]).with_index('fingerprint_key').with_index('source_file_id'),
+
+    # Files that couldn't be probed.  The file fingerprint is the file's
+    # size and modification time when it failed; the import skips the file
+    # until that changes.
+    TableDef('PROBE_FAILURE', [
+        ['probe_failure_id', 'INTEGER', None, 'PRIMARY KEY'],
+        ['source_location', 'VARCHAR', None, 'UNIQUE'],
+        ['file_fingerprint', 'VARCHAR'],
+        ['error', 'VARCHAR'],
+        ['failure_count', 'INTEGER'],
+        ['last_failure', 'REAL']
     ])
 )
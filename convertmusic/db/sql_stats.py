@@ -0,0 +1,254 @@
+"""
+Optional instrumentation of the database statements.
+
+When turned on, the connection that meta.Db uses is wrapped so that every
+statement is timed, including fetching its rows and each commit.  The
+timings are grouped by statement template (the SQL, with any literals and
+runs of `?` collapsed), counting the calls, the total and maximum time
+and the rows returned or changed.  Statements slower than a threshold are
+logged to stderr with their `EXPLAIN QUERY PLAN`, and the slowest
+templates are reported to stderr when the process exits, so this works
+for every tool without changes to it.
+
+Turned on by environment variables:
+
+* CONVERTMUSIC_SQL_STATS - `on`, or the number of templates to report
+  (default 20).
+* CONVERTMUSIC_SQL_SLOW_MS - log statements that take at least this many
+  milliseconds (default 100).
+"""
+
+import os
+import re
+import sys
+import time
+import atexit
+import threading
+
+
+ENV_SQL_STATS = 'CONVERTMUSIC_SQL_STATS'
+ENV_SQL_SLOW_MS = 'CONVERTMUSIC_SQL_SLOW_MS'
+
+DEFAULT_TOP = 20
+DEFAULT_SLOW_MS = 100.0
+
+_STATS = None
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAMETER_RUN = re.compile(r'\?(?:\s*,\s*\?)+')
+_SPACE = re.compile(r'\s+')
+
+
+class SqlStats(object):
+    def __init__(self, slow_seconds=DEFAULT_SLOW_MS / 1000.0, out=None):
+        object.__init__(self)
+        self.slow_seconds = slow_seconds
+        self.out = out or sys.stderr
+        self.__lock = threading.Lock()
+        # template -> [calls, total seconds, max seconds, rows]
+        self.__templates = {}
+        # templates whose plan was already logged.
+        self.__explained = set()
+        self.slow_count = 0
+
+    def wrap(self, conn):
+        return InstrumentedConnection(conn, self)
+
+    def record(self, conn, sql, values, seconds, rows):
+        template = statement_template(sql)
+        with self.__lock:
+            t = self.__templates.get(template)
+            if t is None:
+                t = self.__templates[template] = [0, 0.0, 0.0, 0]
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+            t[3] += max(rows, 0)
+            slow = seconds >= self.slow_seconds
+            explain = slow and template not in self.__explained
+            if slow:
+                self.slow_count += 1
+            if explain:
+                self.__explained.add(template)
+        if slow:
+            self.__log_slow(conn, sql, values, template, seconds, rows, explain)
+
+    def templates(self):
+        """
+        Returns a list of (template, calls, total seconds, max seconds, rows),
+        slowest total first.
+        """
+        with self.__lock:
+            ret = [(k, v[0], v[1], v[2], v[3]) for k, v in self.__templates.items()]
+        ret.sort(key=lambda t: -t[2])
+        return ret
+
+    def report(self, top=DEFAULT_TOP):
+        templates = self.templates()
+        if len(templates) <= 0:
+            return
+        calls = sum(t[1] for t in templates)
+        total = sum(t[2] for t in templates)
+        self.out.write('SQL: {0} statements, {1} templates, {2:.1f} ms, {3} slow\n'.format(
+            calls, len(templates), total * 1000, self.slow_count))
+        self.out.write('{0:>8} {1:>10} {2:>9} {3:>9} {4:>9}  {5}\n'.format(
+            'calls', 'total ms', 'mean ms', 'max ms', 'rows', 'statement'))
+        for template, count, seconds, max_seconds, rows in templates[0:top]:
+            self.out.write('{0:>8} {1:>10.1f} {2:>9.3f} {3:>9.3f} {4:>9}  {5}\n'.format(
+                count, seconds * 1000, seconds * 1000 / count, max_seconds * 1000, rows,
+                template))
+        self.out.flush()
+
+    def __log_slow(self, conn, sql, values, template, seconds, rows, explain):
+        self.out.write('SLOW SQL ({0:.1f} ms, {1} rows): {2}\n'.format(seconds * 1000, rows, template))
+        if explain and _is_select(sql):
+            try:
+                c = conn.execute('EXPLAIN QUERY PLAN ' + sql, values)
+                for row in c:
+                    self.out.write('    {0}\n'.format(row[-1]))
+                c.close()
+            except Exception as e:
+                self.out.write('    (no plan: {0})\n'.format(e))
+        self.out.flush()
+
+
+class InstrumentedConnection(object):
+    """
+    Wraps a sqlite3 connection, timing execute, executemany and commit.
+    Everything else goes straight to the connection.
+    """
+    def __init__(self, conn, stats):
+        object.__init__(self)
+        self.connection = conn
+        self.stats = stats
+
+    def execute(self, sql, values=()):
+        start = time.perf_counter()
+        c = self.connection.execute(sql, values)
+        return TimedCursor(self, c, sql, values, time.perf_counter() - start)
+
+    def executemany(self, sql, rows):
+        start = time.perf_counter()
+        c = self.connection.executemany(sql, rows)
+        self.stats.record(self.connection, sql, (), time.perf_counter() - start, c.rowcount)
+        return c
+
+    def commit(self):
+        start = time.perf_counter()
+        self.connection.commit()
+        self.stats.record(self.connection, 'COMMIT', (), time.perf_counter() - start, 0)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class TimedCursor(object):
+    """
+    A cursor that adds the time spent fetching its rows to the statement,
+    and records it once all the rows are read, or it's closed.
+    """
+    def __init__(self, conn, cursor, sql, values, seconds):
+        object.__init__(self)
+        self.__conn = conn
+        self.__cursor = cursor
+        self.__sql = sql
+        self.__values = values
+        self.__seconds = seconds
+        self.__rows = 0
+        self.__done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        row = self.__cursor.fetchone()
+        self.__seconds += time.perf_counter() - start
+        if row is None:
+            self.__finish()
+            raise StopIteration
+        self.__rows += 1
+        return row
+
+    def fetchone(self):
+        try:
+            return next(self)
+        except StopIteration:
+            return None
+
+    def fetchall(self):
+        return list(self)
+
+    @property
+    def lastrowid(self):
+        return self.__cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.__cursor.rowcount
+
+    def close(self):
+        self.__cursor.close()
+        self.__finish()
+
+    def __del__(self):
+        self.__finish()
+
+    def __finish(self):
+        if self.__done:
+            return
+        self.__done = True
+        rows = self.__rows
+        if not _returns_rows(self.__sql):
+            rows = self.__cursor.rowcount
+        self.__conn.stats.record(self.__conn.connection, self.__sql, self.__values,
+            self.__seconds, rows)
+
+
+def statement_template(sql):
+    """
+    The statement with its literals replaced by `?`, each run of parameters
+    collapsed to `?,...`, and the white space squeezed.
+    """
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _PARAMETER_RUN.sub('?,...', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+def stats_from_env():
+    """
+    The process wide SqlStats if CONVERTMUSIC_SQL_STATS turns them on, or
+    None.  The first call registers the report for when the process exits.
+    """
+    global _STATS
+    if _STATS is not None:
+        return _STATS
+    setting = _env(ENV_SQL_STATS)
+    if setting is None or setting.lower() in ('0', 'off', 'no', 'false'):
+        return None
+    top = DEFAULT_TOP
+    if setting.isdigit():
+        top = int(setting)
+    slow_ms = _env(ENV_SQL_SLOW_MS)
+    if slow_ms is None:
+        slow_ms = DEFAULT_SLOW_MS
+    _STATS = SqlStats(float(slow_ms) / 1000.0)
+    atexit.register(_STATS.report, top)
+    return _STATS
+
+
+def _is_select(sql):
+    return sql.lstrip()[0:6].upper().startswith(('SELECT', 'WITH'))
+
+
+def _returns_rows(sql):
+    return _is_select(sql) or sql.lstrip()[0:6].upper() == 'PRAGMA'
+
+
+def _env(name):
+    value = os.environ.get(name)
+    if value is None or len(value.strip()) <= 0:
+        return None
+    return value.strip()
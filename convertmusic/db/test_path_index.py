@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+"""
+Tests for the index of the processed source file names.
+
+Run with:
+
+    python3 -m pytest convertmusic/db/test_path_index.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from convertmusic.db import get_history
+from convertmusic.db.path_index import PathIndex
+from convertmusic.tools.probe import MediaProbe
+
+
+class PathIndexTest(unittest.TestCase):
+    def test_contains(self):
+        names = ['/music/{0:04d}.mp3'.format(i) for i in range(1000)]
+        index = PathIndex(reversed(names))
+        self.assertEqual(1000, len(index))
+        for name in names:
+            self.assertIn(name, index)
+        self.assertNotIn('/music/1000.mp3', index)
+        self.assertNotIn('/music/0001.MP3', index)
+        self.assertNotIn('', index)
+
+    def test_empty(self):
+        index = PathIndex()
+        self.assertEqual(0, len(index))
+        self.assertNotIn('/music/a.mp3', index)
+
+    def test_add(self):
+        index = PathIndex(['/music/a.mp3'])
+        index.add('/music/b.mp3')
+        self.assertIn('/music/a.mp3', index)
+        self.assertIn('/music/b.mp3', index)
+        self.assertEqual(2, len(index))
+        self.assertEqual(2, index.stats()['files'])
+
+    def test_from_history(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            history = get_history(os.path.join(tmp_dir, 'media.db'))
+            try:
+                history.mark_found(MediaProbe('/music/a.mp3'))
+                index = history.load_processed_index()
+                self.assertIn('/music/a.mp3', index)
+                self.assertNotIn('/music/b.mp3', index)
+            finally:
+                history.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
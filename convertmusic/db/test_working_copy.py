@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+"""
+Tests for the working copy of the database and its lock file.
+
+Run with:
+
+    python3 -m pytest convertmusic/db/test_working_copy.py
+"""
+
+import os
+import errno
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+from convertmusic.db import get_history, working_copy
+from convertmusic.db.working_copy import DbLock, DbLockedError, WorkingCopy
+
+
+_os_open = os.open
+
+
+def _rows(filename):
+    conn = sqlite3.connect(filename)
+    try:
+        return [r[0] for r in conn.execute('SELECT v FROM T ORDER BY v')]
+    finally:
+        conn.close()
+
+
+class WorkingCopyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.published = os.path.join(self.dir, 'media.db')
+        conn = sqlite3.connect(self.published)
+        conn.execute('CREATE TABLE T (v INTEGER)')
+        conn.execute('INSERT INTO T (v) VALUES (1)')
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_publish(self):
+        wc = WorkingCopy(self.published, checkpoint_seconds=3600)
+        conn = wc.open()
+        self.assertEqual([1], [r[0] for r in conn.execute('SELECT v FROM T')])
+        conn.execute('INSERT INTO T (v) VALUES (2)')
+        conn.commit()
+        # Not due yet.
+        self.assertFalse(wc.checkpoint(conn))
+        self.assertEqual([1], _rows(self.published))
+        self.assertTrue(wc.checkpoint(conn, force=True))
+        self.assertEqual([1, 2], _rows(self.published))
+        # Nothing changed since.
+        self.assertFalse(wc.checkpoint(conn, force=True))
+        conn.execute('INSERT INTO T (v) VALUES (3)')
+        conn.commit()
+        wc.close(conn)
+        self.assertEqual([1, 2, 3], _rows(self.published))
+        self.assertEqual(2, wc.publish_count)
+        self.assertFalse(os.path.exists(self.published + '.new'))
+
+    def test_work_dir(self):
+        work_dir = os.path.join(self.dir, 'work')
+        os.mkdir(work_dir)
+        wc = WorkingCopy(self.published, work_dir)
+        conn = wc.open()
+        self.assertTrue(os.path.isfile(wc.work_file))
+        wc.close(conn)
+        self.assertEqual([], os.listdir(work_dir))
+
+    def test_exclusive(self):
+        wc = WorkingCopy(self.published)
+        conn = wc.open()
+        try:
+            self.assertRaises(DbLockedError, DbLock(self.published, False).acquire)
+            self.assertRaises(DbLockedError, WorkingCopy(self.published).open)
+        finally:
+            wc.close(conn)
+        DbLock(self.published, True).acquire().release()
+
+    def test_shared(self):
+        first = DbLock(self.published, False).acquire()
+        second = DbLock(self.published, False).acquire()
+        try:
+            self.assertRaises(DbLockedError, WorkingCopy(self.published).open)
+        finally:
+            first.release()
+            second.release()
+
+
+class ReadOnlyLockTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.published = os.path.join(self.dir, 'media.db')
+        get_history(self.published).close()
+        os.unlink(self.published + '.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _read_only(self, path, flags, mode=0o777):
+        if path.endswith('.lock'):
+            raise OSError(errno.EROFS, os.strerror(errno.EROFS), path)
+        return _os_open(path, flags, mode)
+
+    def test_direct_open_without_lock_file(self):
+        with mock.patch.object(working_copy.os, 'open', self._read_only):
+            history = get_history(self.published)
+            history.close()
+            self.assertRaises(OSError, DbLock(self.published, True).acquire)
+
+    def test_no_lock(self):
+        history = get_history(self.published, lock=False)
+        history.close()
+        self.assertEqual(['media.db'], os.listdir(self.dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
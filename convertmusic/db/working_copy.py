@@ -0,0 +1,215 @@
+"""
+Runs against a working copy of media.db on local disk or in memory, rather
+than the file in the output directory, which is usually on a USB stick
+where every page write is slow.
+
+The working copy is loaded from the published file when opened, and
+published back with sqlite's backup API at checkpoints and on close.  A
+publish writes a new file next to the published one, syncs it, then
+renames it over the old one, so a crash leaves either the old or the new
+database, never a partial one.  Changes since the last checkpoint are lost
+on a crash.
+
+A lock file (media.db.lock) keeps tools from diverging: a working copy
+holds it exclusively, since anything written to the published file in
+the meantime would be overwritten, while tools using the file directly
+share it.  A direct open on media where the lock file can't be created
+(say, a read-only mount) goes without the lock.
+
+The working copy is chosen with the CONVERTMUSIC_DB_WORK environment
+variable: `memory`, or a local directory or file name.  The checkpoint
+interval, in seconds, is CONVERTMUSIC_DB_CHECKPOINT.
+"""
+
+import os
+import time
+import errno
+import sqlite3
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+ENV_DB_WORK = 'CONVERTMUSIC_DB_WORK'
+ENV_DB_CHECKPOINT = 'CONVERTMUSIC_DB_CHECKPOINT'
+
+WORK_MEMORY = 'memory'
+DEFAULT_CHECKPOINT_SECONDS = 60.0
+
+
+class DbLockedError(Exception):
+    pass
+
+
+class DbLock(object):
+    """
+    The lock file next to a database.  Shared locks can be held together;
+    an exclusive lock can't be held with any other.  Released when the
+    process exits, however it exits.
+    """
+    def __init__(self, db_filename, exclusive):
+        object.__init__(self)
+        self.lock_file = db_filename + '.lock'
+        self.exclusive = exclusive
+        self.__fd = None
+
+    def acquire(self):
+        try:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o666)
+        except OSError as e:
+            if self.exclusive or e.errno not in (errno.EROFS, errno.EACCES, errno.EPERM):
+                raise
+            # This process can't write next to the database, so it can
+            # only read it; a working copy publishing over it just isn't
+            # seen until the next open.
+            return self
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, (self.exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        except OSError:
+            holder = os.read(fd, 64).decode('utf-8', 'ignore').strip()
+            os.close(fd)
+            raise DbLockedError('{0} is in use{1}'.format(
+                self.lock_file[:-5], holder and ' by a working copy in process ' + holder or ''))
+        if self.exclusive:
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()).encode('utf-8'))
+        self.__fd = fd
+        return self
+
+    def release(self):
+        if self.__fd is not None:
+            if self.exclusive:
+                os.ftruncate(self.__fd, 0)
+            os.close(self.__fd)
+            self.__fd = None
+
+
+class WorkingCopy(object):
+    def __init__(self, published_file, work=WORK_MEMORY, checkpoint_seconds=None):
+        """
+        published_file: the database in the output directory.
+        work: `memory`, or a local directory or file for the working copy.
+        """
+        object.__init__(self)
+        if checkpoint_seconds is None:
+            checkpoint_seconds = _env_seconds(ENV_DB_CHECKPOINT, DEFAULT_CHECKPOINT_SECONDS)
+        self.published_file = published_file
+        self.checkpoint_seconds = checkpoint_seconds
+        self.work = work
+        self.work_file = None
+        self.__remove_work_file = False
+        self.__lock = None
+        self.__published_changes = 0
+        self.__published_at = 0.0
+        self.publish_count = 0
+
+    def open(self):
+        """
+        Takes the lock, and returns a connection to the working copy, loaded
+        from the published file.
+        """
+        self.__lock = DbLock(self.published_file, True).acquire()
+        try:
+            if self.work == WORK_MEMORY:
+                self.work_file = ':memory:'
+            elif os.path.isdir(self.work):
+                fd, self.work_file = tempfile.mkstemp(prefix='media-', suffix='.db', dir=self.work)
+                os.close(fd)
+                self.__remove_work_file = True
+            else:
+                self.work_file = self.work
+            conn = sqlite3.connect(self.work_file)
+            if os.path.isfile(self.published_file):
+                src = sqlite3.connect(self.published_file)
+                try:
+                    src.backup(conn)
+                finally:
+                    src.close()
+                self.__published_changes = conn.total_changes
+            else:
+                # Publish the new database even without row changes.
+                self.__published_changes = -1
+        except:
+            self.__lock.release()
+            raise
+        self.__published_at = time.monotonic()
+        return conn
+
+    def checkpoint(self, conn, force=False):
+        """
+        Publishes the working copy if it changed and the checkpoint interval
+        has passed (or `force`).  Returns True if it was published.
+        """
+        if conn.total_changes == self.__published_changes:
+            return False
+        if not force and time.monotonic() - self.__published_at < self.checkpoint_seconds:
+            return False
+        self.publish(conn)
+        return True
+
+    def publish(self, conn):
+        tmp_file = self.published_file + '.new'
+        if os.path.lexists(tmp_file):
+            os.unlink(tmp_file)
+        dest = sqlite3.connect(tmp_file)
+        try:
+            conn.backup(dest)
+        finally:
+            dest.close()
+        fd = os.open(tmp_file, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_file, self.published_file)
+        _fsync_dir(os.path.dirname(os.path.abspath(self.published_file)))
+        self.__published_changes = conn.total_changes
+        self.__published_at = time.monotonic()
+        self.publish_count += 1
+
+    def close(self, conn):
+        try:
+            self.checkpoint(conn, force=True)
+        finally:
+            conn.close()
+            if self.__remove_work_file and os.path.isfile(self.work_file):
+                os.unlink(self.work_file)
+            if self.__lock is not None:
+                self.__lock.release()
+                self.__lock = None
+
+
+def working_copy_from_env(published_file):
+    """
+    Returns the WorkingCopy configured by CONVERTMUSIC_DB_WORK, or None to
+    use the published file directly.
+    """
+    work = os.environ.get(ENV_DB_WORK, '').strip()
+    if len(work) <= 0 or work.lower() == 'off' or published_file == ':memory:':
+        return None
+    return WorkingCopy(published_file, work)
+
+
+def _env_seconds(name, default):
+    value = os.environ.get(name)
+    if value is None or len(value.strip()) <= 0:
+        return default
+    return float(value)
+
+
+def _fsync_dir(dirname):
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not supported for directories on every file system.
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,36 @@
+"""
+Module attributes that are only imported when they're first used, so a
+tool that only reads the database doesn't load ffprobe, NumPy or libxmp.
+
+In a package's __init__:
+
+    __getattr__ = lazy_attributes(__name__, globals(), {
+        'FfProbeFactory': '.ffmpeg_bin.ffprobe',
+        ...
+    })
+"""
+
+import importlib
+
+
+def lazy_attributes(package, namespace, attributes):
+    """
+    Returns a module `__getattr__` that imports each attribute from its
+    module (relative to `package`) on first use, and keeps it in the
+    module's namespace afterwards.
+
+    attributes: name -> module, or name -> (module, attribute name); an
+        attribute name of None is the module itself.
+    """
+    def __getattr__(name):
+        source = attributes.get(name)
+        if source is None:
+            raise AttributeError('module {0!r} has no attribute {1!r}'.format(package, name))
+        if isinstance(source, str):
+            source = (source, name)
+        value = importlib.import_module(source[0], package)
+        if source[1] is not None:
+            value = getattr(value, source[1])
+        namespace[name] = value
+        return value
+    return __getattr__
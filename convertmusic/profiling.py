@@ -0,0 +1,159 @@
+"""
+Runs a tool's command under a profiler, for catching slow downs in real
+runs without changing the scripts.
+
+The tools take `--profile=cpu` or `--profile=mem` (see cmd.std_main and
+import.py), or the environment variable CONVERTMUSIC_PROFILE set to
+`cpu` or `mem`:
+
+* cpu - runs the command under cProfile, and writes the statistics to
+  `(command)-(timestamp).pstats`.  Look at them with
+  `python3 -m pstats (file)`, or snakeviz and the like.
+* mem - traces the memory allocations with tracemalloc, and writes the
+  snapshot taken at the end to `(command)-(timestamp).tracemalloc`.  Load
+  it with `tracemalloc.Snapshot.load(file)`, for example to compare it
+  with the snapshot of an older run.
+
+The files go into CONVERTMUSIC_PROFILE_DIR, or else the current
+directory.  A top 20 (the functions with the most time spent in them, or
+the lines that allocated the most memory still in use) is printed to
+stderr, so that it doesn't mix with the command's output.
+
+    with profiled('manage-data-verify', 'cpu'):
+        ...
+"""
+
+import os
+import sys
+import time
+
+
+ENV_PROFILE = 'CONVERTMUSIC_PROFILE'
+ENV_PROFILE_DIR = 'CONVERTMUSIC_PROFILE_DIR'
+
+PROFILE_CPU = 'cpu'
+PROFILE_MEMORY = 'mem'
+PROFILE_MODES = (PROFILE_CPU, PROFILE_MEMORY)
+
+TOP = 20
+# Frames kept for each traced allocation; enough to find the caller of the
+# library code that made it.
+MEMORY_FRAMES = 10
+
+
+class Profiler(object):
+    """
+    Context manager for one profiled run.  `filename` is set once the
+    profile is written.
+    """
+    def __init__(self, name, mode, out_dir=None, out=None):
+        object.__init__(self)
+        if mode not in PROFILE_MODES:
+            raise ValueError('unknown profile mode {0!r}; use one of {1}'.format(
+                mode, ', '.join(PROFILE_MODES)))
+        self.name = name
+        self.mode = mode
+        self.out_dir = out_dir or os.environ.get(ENV_PROFILE_DIR) or os.curdir
+        self.out = out or sys.stderr
+        self.filename = None
+        self.__profile = None
+        self.__start = None
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        if self.mode == PROFILE_CPU:
+            import cProfile
+            self.__profile = cProfile.Profile()
+            self.__profile.enable()
+        else:
+            import tracemalloc
+            tracemalloc.start(MEMORY_FRAMES)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.__start
+        if self.mode == PROFILE_CPU:
+            self.__profile.disable()
+            self.__write_cpu(elapsed)
+        else:
+            self.__write_memory(elapsed)
+
+    def profile_filename(self, extension):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.out_dir, '{0}-{1}{2}'.format(_safe_name(self.name), stamp, extension))
+
+    def __write_cpu(self, elapsed):
+        import pstats
+        self.filename = self.profile_filename('.pstats')
+        self.__profile.dump_stats(self.filename)
+        self.out.write('CPU profile of {0} ({1:.2f} s) written to {2}\n'.format(
+            self.name, elapsed, self.filename))
+        stats = pstats.Stats(self.__profile, stream=self.out)
+        stats.strip_dirs().sort_stats('tottime').print_stats(TOP)
+        self.out.flush()
+
+    def __write_memory(self, elapsed):
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.filename = self.profile_filename('.tracemalloc')
+        snapshot.dump(self.filename)
+        self.out.write('Memory profile of {0} ({1:.2f} s) written to {2}\n'.format(
+            self.name, elapsed, self.filename))
+        self.out.write('  in use at the end {0:.1f} MB, peak {1:.1f} MB\n'.format(
+            current / 1e6, peak / 1e6))
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ))
+        for stat in snapshot.statistics('lineno')[0:TOP]:
+            frame = stat.traceback[0]
+            self.out.write('  {0:10.1f} KB {1:8} blocks  {2}:{3}\n'.format(
+                stat.size / 1024, stat.count, frame.filename, frame.lineno))
+        self.out.flush()
+
+
+class _NotProfiled(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def profiled(name, mode=None):
+    """
+    Context manager that profiles the block as `name`, in the mode ('cpu'
+    or 'mem'), or in the mode from CONVERTMUSIC_PROFILE if mode is None.
+    Does nothing if neither asks for a profile.
+    """
+    if mode is None:
+        mode = mode_from_env()
+    if mode is None:
+        return _NotProfiled()
+    return Profiler(name, mode)
+
+
+def mode_from_env():
+    mode = os.environ.get(ENV_PROFILE)
+    if mode is None or len(mode.strip()) <= 0:
+        return None
+    mode = mode.strip().lower()
+    if mode in ('0', 'off', 'no', 'false'):
+        return None
+    return mode
+
+
+def check_mode(mode):
+    """
+    Returns an error message if the mode isn't a profile mode, or None.
+    """
+    if mode in PROFILE_MODES:
+        return None
+    return 'Unknown profile mode "{0}"; use one of {1}.'.format(mode, ', '.join(PROFILE_MODES))
+
+
+def _safe_name(name):
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
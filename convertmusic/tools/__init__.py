@@ -1,24 +1,53 @@
 
 from .unidecode import to_ascii
 from . import tag
-from .probe import MediaProbe
-from .ffmpeg_bin.ffprobe import FfProbeFactory
-from .xmp_lib.xmp_probe import XmpProbeFactory
-from .player import MediaPlayer
 from . import cli_output
-from .tag_file import set_tags_on_file
-from .transcode import transcode_correct_format
-from .filename_util import get_destdir
-from .normalize import normalize_audio
-from .trim import trim_audio
+from ..lazy_import import lazy_attributes
 
-FFMPEG_FACTORY = FfProbeFactory()
-XMP_FACTORY = XmpProbeFactory()
+# The probes, ffmpeg tools and libxmp are loaded on first use, so the tools
+# that only read the database start quickly and work without libxmp.
+__getattr__ = lazy_attributes(__name__, globals(), {
+    'MediaProbe': '.probe',
+    'FfProbeFactory': '.ffmpeg_bin.ffprobe',
+    'XmpProbeFactory': '.xmp_lib.xmp_probe',
+    'MediaPlayer': '.player',
+    'set_tags_on_file': '.tag_file',
+    'set_tags_and_hash': '.tag_file',
+    'set_tags_on_file_async': '.tag_file',
+    'TagWriterPool': '.tag_file',
+    'transcode_correct_format': '.transcode',
+    'transcode_with_digest': '.transcode',
+    'plan_transcode': '.transcode',
+    'TranscodeCache': '.transcode_cache',
+    'get_transcode_cache': '.transcode_cache',
+    'get_destdir': '.filename_util',
+    'OutputLayout': '.filename_util',
+    'normalize_audio': '.normalize',
+    'source_volume_increase': '.normalize',
+    'trim_audio': '.trim',
+    'AsyncToolRunner': '.ffmpeg_bin.async_proc',
+    'run_all': '.ffmpeg_bin.async_proc',
+})
 
-PROBE_FACTORIES = (
-    FFMPEG_FACTORY,
-    XMP_FACTORY
-)
+_PROBE_FACTORIES = None
+
+
+def _probe_factories():
+    """
+    The probe factories, in the order they're tried.  Module files aren't
+    supported if libxmp can't be loaded.
+    """
+    global _PROBE_FACTORIES
+    if _PROBE_FACTORIES is None:
+        from .ffmpeg_bin.ffprobe import FfProbeFactory
+        factories = [FfProbeFactory()]
+        try:
+            from .xmp_lib.xmp_probe import XmpProbeFactory
+            factories.append(XmpProbeFactory())
+        except ImportError as e:
+            print("*** WARNING: module files are not supported: {0}".format(e))
+        _PROBE_FACTORIES = tuple(factories)
+    return _PROBE_FACTORIES
 
 
 def is_media_file_supported(filename):
@@ -33,7 +62,7 @@ def is_media_file_supported(filename):
     except:
         print('*** ERROR: cannot handle filename {0}'.format(repr(filename)))
         raise
-    for f in PROBE_FACTORIES:
+    for f in _probe_factories():
         if f.is_supported(filename):
             return True
     return False
@@ -41,7 +70,7 @@ def is_media_file_supported(filename):
 
 def probe_media_file_err(filename):
     err = None
-    for f in PROBE_FACTORIES:
+    for f in _probe_factories():
         if f.is_supported(filename):
             try:
                 return f.probe(filename)
@@ -56,7 +85,7 @@ def probe_media_file_err(filename):
 
 def probe_media_file(filename):
     err = None
-    for f in PROBE_FACTORIES:
+    for f in _probe_factories():
         if f.is_supported(filename):
             try:
                 return f.probe(filename)
@@ -67,7 +96,25 @@ def probe_media_file(filename):
     raise Exception('No supported probe for {0}'.format(filename))
 
 
+async def probe_media_file_async(runner, filename):
+    """
+    `probe_media_file` from an event loop, with the tools run by the
+    AsyncToolRunner.
+    """
+    err = None
+    for f in _probe_factories():
+        if f.is_supported(filename):
+            try:
+                return await f.probe_async(runner, filename)
+            except Exception as e:
+                err = e
+    if err is not None:
+        raise err
+    raise Exception('No supported probe for {0}'.format(filename))
+
+
 def get_media_player():
+    from .player import MediaPlayer
     # return MediaPlayer(['vlc', '--play-and-exit', '--one-instance', '--playlist-enqueue', '{0}'])
     # return MediaPlayer(['vlc', '--play-and-stop', '--no-loop', '--one-instance', '--playlist-enqueue', '{0}'])
     return MediaPlayer(['vlc', '--play-and-stop', '--no-loop', '--one-instance', '{0}'])
@@ -0,0 +1,163 @@
+"""
+Declarative description of the formats a playback device supports.  The
+transcode decision (copy the file, remux the audio stream into another
+container, or encode it again) is made from the profile, rather than from
+hard-coded rules.
+"""
+
+from .probe import MediaProbe
+
+
+ACTION_COPY = 'copy'
+ACTION_REMUX = 'remux'
+ACTION_ENCODE = 'encode'
+ACTIONS = (ACTION_COPY, ACTION_REMUX, ACTION_ENCODE)
+
+
+class CodecRule(object):
+    """
+    One supported audio stream format, and the containers the device can
+    read it from.
+    """
+    def __init__(self, name, codecs, extension, containers, sample_rates,
+            min_bit_rate, max_bit_rate, channels=(2,)):
+        """
+        codecs: the ffprobe codec names for this format.
+        extension: file extension for the output file.
+        containers: ffprobe format names the device can read the codec from.
+        sample_rates: allowed sample rates, in Hz.
+        min_bit_rate, max_bit_rate: inclusive bit rate range, in bits/second.
+        channels: allowed channel counts.
+        """
+        object.__init__(self)
+        self.name = name
+        self.codecs = tuple(c.lower() for c in codecs)
+        self.extension = extension
+        self.containers = tuple(containers)
+        self.sample_rates = tuple(sample_rates)
+        self.min_bit_rate = min_bit_rate
+        self.max_bit_rate = max_bit_rate
+        self.channels = tuple(channels)
+
+    def matches_stream(self, probe):
+        """The audio stream itself can be played by the device."""
+        return (
+            probe.codec is not None and
+            probe.codec.lower() in self.codecs and
+            probe.sample_rate in self.sample_rates and
+            probe.bit_rate is not None and
+            self.min_bit_rate <= probe.bit_rate <= self.max_bit_rate and
+            probe.channels in self.channels
+        )
+
+    def matches_container(self, probe):
+        """The file can be copied as-is."""
+        if probe.container is None or probe.extra_streams:
+            return False
+        for c in probe.container.split(','):
+            if c.strip() in self.containers:
+                return True
+        return False
+
+
+class EncodeTarget(object):
+    """
+    The format used for files that the device can't play.
+    """
+    def __init__(self, codec, extension, sample_rates, min_bit_rate, max_bit_rate,
+            channels=2, lossless_codecs=(), lossless_sample_rate=48000,
+            lossless_bit_rate=320000):
+        object.__init__(self)
+        self.codec = codec
+        self.extension = extension
+        self.sample_rates = tuple(sorted(sample_rates))
+        self.min_bit_rate = min_bit_rate
+        self.max_bit_rate = max_bit_rate
+        self.channels = channels
+        self.lossless_codecs = tuple(c.lower() for c in lossless_codecs)
+        self.lossless_sample_rate = lossless_sample_rate
+        self.lossless_bit_rate = lossless_bit_rate
+
+    def is_lossless(self, probe):
+        codec = (probe.codec or '').lower()
+        return codec in self.lossless_codecs or codec.startswith('pcm_')
+
+    def params_for(self, probe):
+        """
+        Returns the transcode keyword arguments for the probe.
+        """
+        if self.is_lossless(probe):
+            # Best quality conversion
+            sample_rate = self.lossless_sample_rate
+            bit_rate = self.lossless_bit_rate
+        else:
+            # Convert without losing quality: the smallest supported sample
+            # rate that holds the source, and the source bit rate, clamped.
+            sample_rate = self.sample_rates[-1]
+            for sr in self.sample_rates:
+                if probe.sample_rate is not None and probe.sample_rate <= sr:
+                    sample_rate = sr
+                    break
+            bit_rate = probe.bit_rate or self.max_bit_rate
+            bit_rate = max(self.min_bit_rate, min(self.max_bit_rate, bit_rate))
+        return {
+            'sample_rate': sample_rate,
+            'bit_rate': bit_rate,
+            'channels': self.channels,
+            'codec': self.codec,
+        }
+
+
+class TranscodePlan(object):
+    def __init__(self, action, extension, rule=None, params=None):
+        object.__init__(self)
+        assert action in ACTIONS
+        self.action = action
+        self.extension = extension
+        self.rule = rule
+        self.params = params
+
+    def __repr__(self):
+        return 'TranscodePlan({0}, {1}, {2})'.format(
+            self.action, self.extension, self.params or (self.rule and self.rule.name))
+
+
+class DeviceProfile(object):
+    def __init__(self, name, rules, encode):
+        object.__init__(self)
+        self.name = name
+        self.rules = tuple(rules)
+        self.encode = encode
+
+    def plan(self, probe):
+        """
+        Decides how the probed file should be put on the device.
+        """
+        assert isinstance(probe, MediaProbe)
+        remux = None
+        for rule in self.rules:
+            if rule.matches_stream(probe):
+                if rule.matches_container(probe):
+                    return TranscodePlan(ACTION_COPY, rule.extension, rule=rule)
+                if remux is None:
+                    remux = TranscodePlan(ACTION_REMUX, rule.extension, rule=rule)
+        if remux is not None:
+            return remux
+        return TranscodePlan(ACTION_ENCODE, self.encode.extension,
+            params=self.encode.params_for(probe))
+
+
+AAC_SAMPLE_RATES = (11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000)
+
+# The car stereo.  See the README for the supported formats.
+DEFAULT_PROFILE = DeviceProfile('car', (
+    CodecRule('mp3 mpeg1 layer3', ('mp3',), 'mp3', ('mp3',),
+        (32000, 44100, 48000), 32000, 320000),
+    CodecRule('mp3 mpeg2 lsf layer3', ('mp3',), 'mp3', ('mp3',),
+        (16000, 22050, 24000), 8000, 160000),
+    CodecRule('wma v7, v8', ('wma', 'wmav1', 'wmav2'), 'wma', ('asf',),
+        (32000, 44100, 48000), 48000, 192000),
+    CodecRule('mpeg4 aac-lc', ('aac',), 'm4a', ('mov', 'mp4', 'm4a'),
+        AAC_SAMPLE_RATES, 16000, 320000),
+), EncodeTarget('aac', 'm4a', AAC_SAMPLE_RATES, 16000, 320000,
+    lossless_codecs=('flac', 'alac', 'wavpack', 'ape', 'tta')))
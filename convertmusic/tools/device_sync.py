@@ -0,0 +1,244 @@
+"""
+Mirrors the output directory onto a removable device.
+
+The master manifest comes from the TARGET_FILE records: the file name
+relative to the output directory, its size and its sha256.  The hashes are
+stored in the database with the file size and modification time, so only
+files that changed since they were last hashed are read again.
+
+The device keeps its own manifest (MANIFEST_NAME, at the top of the
+device directory) of the files it was given: their hash, and their size and
+modification time on the device.  A device file whose size and
+modification time still match its manifest entry is taken to have that
+hash, so comparing the device to the master needs no reads of the device
+files.  Files that are new or changed are copied, with large buffers and
+several at a time, and files that are no longer in the master are removed.
+"""
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from .staging import sync_filesystem
+from .file_hash import hash_file, copy_and_hash
+
+
+MANIFEST_NAME = '.convertmusic-manifest.json'
+MANIFEST_VERSION = 1
+DEFAULT_JOBS = 4
+
+
+class SyncPlan(object):
+    def __init__(self, master, device, unknown):
+        """
+        master: relative name -> [size, sha256]
+        device: relative name -> manifest entry, for the trusted device files
+        unknown: relative names of device files without a matching entry
+        """
+        object.__init__(self)
+        self.copies = []
+        self.deletes = []
+        self.unchanged = 0
+        for name, (size, sha256) in master.items():
+            entry = device.get(name)
+            if entry is not None and entry['sha256'] == sha256 and entry['size'] == size:
+                self.unchanged += 1
+            else:
+                self.copies.append(name)
+        for name in device.keys():
+            if name not in master:
+                self.deletes.append(name)
+        for name in unknown:
+            if name not in master:
+                self.deletes.append(name)
+        self.copies.sort()
+        self.deletes.sort()
+        self.copy_bytes = sum(master[n][0] for n in self.copies)
+
+
+def master_base(filenames):
+    """
+    The output directory the files were written under: each file is in a
+    bucket directory directly below it.
+    """
+    if len(filenames) <= 0:
+        return None
+    return os.path.commonpath([os.path.dirname(os.path.dirname(f)) for f in filenames])
+
+
+def build_master_manifest(records, jobs=DEFAULT_JOBS):
+    """
+    records: list of (local file name, size, modification time ns, sha256)
+        as stored; the last three may be None.
+
+    Returns (manifest, updates, missing): the manifest maps the local file
+    name to [size, sha256]; updates are the records that were hashed again,
+    to be stored; missing are the files that don't exist.
+    """
+    manifest = {}
+    missing = []
+    to_hash = []
+    for filename, size, mtime_ns, sha256 in records:
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            missing.append(filename)
+            continue
+        if sha256 is not None and size == st.st_size and mtime_ns == st.st_mtime_ns:
+            manifest[filename] = [size, sha256]
+        else:
+            to_hash.append((filename, st.st_mtime_ns))
+    updates = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = executor.map(lambda f: hash_file(f[0]), to_hash)
+        for (filename, mtime_ns), (size, sha256) in zip(to_hash, results):
+            manifest[filename] = [size, sha256]
+            updates.append((filename, size, mtime_ns, sha256))
+    return manifest, updates, missing
+
+
+def read_device_manifest(device_dir):
+    """
+    Returns the device manifest's files (relative name -> entry), or None if
+    the device has no manifest.
+    """
+    try:
+        with open(os.path.join(device_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        print("*** WARNING: ignoring the unreadable manifest on {0}".format(device_dir))
+        return {}
+    if data.get('version') != MANIFEST_VERSION:
+        return {}
+    return data.get('files', {})
+
+
+def device_manifest_for_sync(device_dir, force=False):
+    """
+    Returns the device manifest's files to sync against, or None if the
+    device has files but no manifest, and `force` isn't set: a sync would
+    remove every one of them that isn't in the output.
+    """
+    files = read_device_manifest(device_dir)
+    if files is None:
+        if len(os.listdir(device_dir)) > 0 and not force:
+            return None
+        files = {}
+    return files
+
+
+def write_device_manifest(device_dir, files):
+    manifest_file = os.path.join(device_dir, MANIFEST_NAME)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f, indent=0, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def scan_device(device_dir, manifest):
+    """
+    Lists the device files.  Returns (trusted, unknown): the manifest
+    entries whose file still has the recorded size and modification time,
+    and the relative names of all the other files.
+    """
+    trusted = {}
+    unknown = []
+    for dirpath, dirnames, filenames in os.walk(device_dir):
+        for fn in filenames:
+            full = os.path.join(dirpath, fn)
+            name = relative_name(device_dir, full)
+            if name in (MANIFEST_NAME, MANIFEST_NAME + '.tmp'):
+                continue
+            entry = manifest.get(name)
+            if entry is not None:
+                st = os.stat(full)
+                if entry.get('size') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns:
+                    trusted[name] = entry
+                    continue
+            unknown.append(name)
+    return trusted, unknown
+
+
+def copy_to_device(src_file, dest_file, sha256):
+    """
+    Copies the file through a temporary name, checking the data against the
+    expected hash on the way.  Returns the device manifest entry.
+    """
+    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+    tmp_file = dest_file + '.part'
+    try:
+        size, copied_sha256 = copy_and_hash(src_file, tmp_file)
+        if copied_sha256 != sha256:
+            raise OSError('{0} changed while it was copied; run the sync again'.format(src_file))
+        os.replace(tmp_file, dest_file)
+    except:
+        if os.path.lexists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+    st = os.stat(dest_file)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha256}
+
+
+def sync_device(base_dir, master, device_dir, plan, jobs=DEFAULT_JOBS, trusted=None, on_file=None):
+    """
+    Runs the plan: removes the deleted files, then copies the new and
+    changed ones.  The device manifest is written at the end, even if some
+    copies fail, so the finished files don't need copying again.
+
+    master: relative name -> [size, sha256]
+    on_file(action, name, error): called for each file handled.
+
+    Returns the list of (name, error) for the files that failed.
+    """
+    files = dict(trusted or {})
+    failed = []
+    for name in plan.deletes:
+        files.pop(name, None)
+        try:
+            os.unlink(os.path.join(device_dir, name))
+            _remove_empty_dirs(device_dir, os.path.dirname(os.path.join(device_dir, name)))
+            error = None
+        except OSError as e:
+            error = e
+            failed.append((name, e))
+        if on_file is not None:
+            on_file('delete', name, error)
+
+    def _copy(name):
+        return copy_to_device(os.path.join(base_dir, name),
+            os.path.join(device_dir, name), master[name][1])
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [(name, executor.submit(_copy, name)) for name in plan.copies]
+            for name, future in futures:
+                files.pop(name, None)
+                error = future.exception()
+                if error is None:
+                    files[name] = future.result()
+                else:
+                    failed.append((name, error))
+                if on_file is not None:
+                    on_file('copy', name, error)
+    finally:
+        sync_filesystem(device_dir)
+        write_device_manifest(device_dir, files)
+        sync_filesystem(device_dir)
+    return failed
+
+
+def relative_name(base_dir, filename):
+    """The file name relative to the base directory, with / separators."""
+    return os.path.relpath(filename, base_dir).replace(os.sep, '/')
+
+
+def _remove_empty_dirs(device_dir, dirname):
+    device_dir = os.path.abspath(device_dir)
+    dirname = os.path.abspath(dirname)
+    while dirname != device_dir and dirname.startswith(device_dir):
+        try:
+            os.rmdir(dirname)
+        except OSError:
+            return
+        dirname = os.path.dirname(dirname)
@@ -0,0 +1,211 @@
+"""
+Copies files with the cheapest method the file systems allow.
+
+In order, a copy tries:
+
+* `reflink`: a FICLONE clone, which shares the source's blocks and copies
+  no data (btrfs, xfs, and some NAS file systems).
+* `copy_file_range`: the kernel copies the data, or the file server does
+  for network file systems that support server side copies.
+* `sendfile`: the kernel copies the data, without it passing through this
+  process.
+* `copy`: a plain read and write loop.
+
+A method the file systems don't support fails straight away, and the next
+one is tried.  Only the plain copy sees the data, so for the others the
+copy is hashed by reading it back.
+
+The method each copy took, and how fast it went, are kept in `COPY_STATS`.
+"""
+
+import os
+import time
+import errno
+import threading
+from .file_hash import hash_file, copy_fd_and_hash
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# linux/fs.h _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Largest single copy_file_range or sendfile call.
+CHUNK_SIZE = 1024 * 1024 * 1024
+
+METHOD_REFLINK = 'reflink'
+METHOD_COPY_FILE_RANGE = 'copy_file_range'
+METHOD_SENDFILE = 'sendfile'
+METHOD_COPY = 'copy'
+
+# The errors that mean a method isn't supported for these files.
+_UNSUPPORTED = frozenset(e for e in (
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF, errno.EPERM,
+    errno.ENOTTY, errno.ETXTBSY, errno.EOPNOTSUPP,
+    getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP),
+))
+
+
+class CopyResult(object):
+    def __init__(self, method, size, sha256, seconds):
+        object.__init__(self)
+        self.method = method
+        self.size = size
+        self.sha256 = sha256
+        # Time taken by the copy itself, without hashing it afterwards.
+        self.seconds = seconds
+
+    @property
+    def digest(self):
+        return self.size, self.sha256
+
+    @property
+    def bytes_per_second(self):
+        if self.seconds <= 0:
+            return None
+        return self.size / self.seconds
+
+    def __str__(self):
+        rate = self.bytes_per_second
+        return '{0} bytes by {1}{2}'.format(self.size, self.method,
+            rate is not None and ' at {0:.1f} MB/s'.format(rate / 1e6) or '')
+
+
+class CopyStats(object):
+    """
+    Totals of the copies made, by method.  Safe to share between threads.
+    """
+    def __init__(self):
+        object.__init__(self)
+        self.__lock = threading.Lock()
+        self.__methods = {}
+
+    def add(self, result):
+        with self.__lock:
+            m = self.__methods.get(result.method)
+            if m is None:
+                m = self.__methods[result.method] = {'files': 0, 'bytes': 0, 'seconds': 0.0}
+            m['files'] += 1
+            m['bytes'] += result.size
+            m['seconds'] += result.seconds
+
+    def stats(self):
+        """
+        Returns method -> {files, bytes, seconds, bytes_per_second}.
+        """
+        ret = {}
+        with self.__lock:
+            for method, m in self.__methods.items():
+                ret[method] = dict(m)
+                ret[method]['bytes_per_second'] = (
+                    m['seconds'] > 0 and int(m['bytes'] / m['seconds']) or None)
+        return ret
+
+    def reset(self):
+        with self.__lock:
+            self.__methods = {}
+
+
+COPY_STATS = CopyStats()
+
+
+def copy_file_fast(src_file, target_file):
+    """
+    Copies the source into the target file, which is created or truncated,
+    and returns the CopyResult.
+    """
+    src_fd = os.open(src_file, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(target_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            result = None
+            for method, copier in _FAST_METHODS:
+                start = time.perf_counter()
+                if copier(src_fd, dst_fd, size):
+                    result = CopyResult(method, size, None, time.perf_counter() - start)
+                    break
+                # Start again for the next method.
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+            if result is None:
+                start = time.perf_counter()
+                copied, sha256 = copy_fd_and_hash(src_fd, dst_fd)
+                result = CopyResult(METHOD_COPY, copied, sha256, time.perf_counter() - start)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    if result.sha256 is None:
+        result.size, result.sha256 = hash_file(target_file)
+    COPY_STATS.add(result)
+    return result
+
+
+def reflink_file(src_file, target_file):
+    """
+    Makes target_file a copy-on-write clone of src_file.  Returns False,
+    without leaving a target file behind, if the file systems don't support
+    it.
+    """
+    with open(src_file, 'rb') as src:
+        with open(target_file, 'wb') as dest:
+            try:
+                if _reflink(src.fileno(), dest.fileno(), None):
+                    return True
+            except:
+                dest.close()
+                os.unlink(target_file)
+                raise
+    os.unlink(target_file)
+    return False
+
+
+def _reflink(src_fd, dst_fd, size):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def _copy_range(src_fd, dst_fd, size):
+    return _copy_loop(lambda: os.copy_file_range(src_fd, dst_fd, CHUNK_SIZE), size)
+
+
+def _sendfile(src_fd, dst_fd, size):
+    return _copy_loop(lambda: os.sendfile(dst_fd, src_fd, None, CHUNK_SIZE), size)
+
+
+def _copy_loop(copy_chunk, size):
+    """
+    Copies a chunk at a time until the end of the file.  Returns False if
+    the method isn't supported here.
+    """
+    copied = 0
+    while True:
+        try:
+            count = copy_chunk()
+        except OSError as e:
+            if e.errno in _UNSUPPORTED:
+                return False
+            raise
+        if count <= 0:
+            break
+        copied += count
+    # Some file systems report no data rather than failing.
+    return copied >= size
+
+
+_FAST_METHODS = [(METHOD_REFLINK, _reflink)]
+if hasattr(os, 'copy_file_range'):
+    _FAST_METHODS.append((METHOD_COPY_FILE_RANGE, _copy_range))
+if hasattr(os, 'sendfile'):
+    _FAST_METHODS.append((METHOD_SENDFILE, _sendfile))
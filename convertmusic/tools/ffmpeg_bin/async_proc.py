@@ -0,0 +1,219 @@
+"""
+Runs many ffmpeg and ffprobe processes at once from one asyncio event loop.
+
+The runner limits how many tools run at the same time, applies the
+timeouts from proc.py, streams stderr a line at a time (ffmpeg writes its
+progress lines with a carriage return, which also ends a line here), and
+records the resource usage of each finished tool.
+
+If the awaiting task is cancelled, including by Ctrl-C under asyncio.run,
+the tool is killed and reaped before the cancellation carries on, so no
+tools are left running.
+
+    runner = AsyncToolRunner(4)
+    results = run_all([runner.run(cmd) for cmd in cmds])
+"""
+
+import os
+import time
+import asyncio
+import subprocess
+from . import proc as tool_proc
+
+
+READ_SIZE = 64 * 1024
+# Seconds to keep reading the pipes after the tool exits.  A process the
+# tool started may still hold them open.
+PIPE_GRACE = 2.0
+
+
+class ToolResult(object):
+    def __init__(self, args, returncode, stdout, stderr, rusage, elapsed):
+        object.__init__(self)
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        # resource.struct_rusage of the finished tool.
+        self.rusage = rusage
+        self.elapsed = elapsed
+
+    @property
+    def user_seconds(self):
+        return self.rusage.ru_utime
+
+    @property
+    def system_seconds(self):
+        return self.rusage.ru_stime
+
+    @property
+    def max_rss_kb(self):
+        return self.rusage.ru_maxrss
+
+    def check_returncode(self):
+        if self.returncode != 0:
+            raise subprocess.CalledProcessError(self.returncode, self.args,
+                output=self.stdout, stderr=self.stderr)
+
+
+class AsyncToolRunner(object):
+    def __init__(self, max_concurrent=None, timeout=None):
+        """
+        max_concurrent: the most tools running at once (one per CPU if not
+            given).
+        timeout: the default time limit for each tool, in seconds (the
+            CONVERTMUSIC_FFMPEG_TIMEOUT limit if not given).
+        """
+        object.__init__(self)
+        if max_concurrent is None:
+            max_concurrent = os.cpu_count() or 1
+        self.max_concurrent = max(1, max_concurrent)
+        self.timeout = timeout
+        self.__semaphore = None
+        self.__running = set()
+
+    @property
+    def running_count(self):
+        return len(self.__running)
+
+    async def run(self, cmd, timeout=None, on_stderr=None, capture_stdout=True, check=True):
+        """
+        Runs the tool and returns its ToolResult.  `on_stderr(line)` is
+        called with each line of stderr (as bytes) as it arrives; all of
+        stderr is also kept in the result.  Raises
+        subprocess.TimeoutExpired if the tool runs too long, and (with
+        `check`) subprocess.CalledProcessError if it fails.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            timeout = tool_proc.FFMPEG_TIMEOUT
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_concurrent)
+        async with self.__semaphore:
+            result = await self.__run(cmd, timeout, on_stderr, capture_stdout)
+        if check:
+            result.check_returncode()
+        return result
+
+    def kill_all(self):
+        """Kills every tool this runner has running."""
+        for p in list(self.__running):
+            _kill(p)
+
+    async def __run(self, cmd, timeout, on_stderr, capture_stdout):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        p = subprocess.Popen(cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=capture_stdout and subprocess.PIPE or subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+        self.__running.add(p)
+        readers = []
+        reaped = False
+        try:
+            stderr_chunks = []
+            stdout_chunks = []
+            readers.append(loop.create_task(
+                _read_lines(loop, p.stderr, stderr_chunks, on_stderr)))
+            if capture_stdout:
+                readers.append(loop.create_task(
+                    _read_lines(loop, p.stdout, stdout_chunks, None)))
+            try:
+                status, rusage = await asyncio.wait_for(_wait4(loop, p.pid), timeout)
+            except asyncio.TimeoutError:
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            reaped = True
+            p.returncode = os.waitstatus_to_exitcode(status)
+            _, pending = await asyncio.wait(readers, timeout=PIPE_GRACE)
+            for r in pending:
+                r.cancel()
+            return ToolResult(cmd, p.returncode,
+                b''.join(stdout_chunks) if capture_stdout else None,
+                b''.join(stderr_chunks),
+                rusage, time.perf_counter() - start)
+        finally:
+            if not reaped:
+                _kill(p)
+                try:
+                    os.wait4(p.pid, 0)
+                except ChildProcessError:
+                    # Reaped by the waiter thread.
+                    pass
+                if p.returncode is None:
+                    p.returncode = -9
+            for r in readers:
+                r.cancel()
+            self.__running.discard(p)
+
+
+def run_all(coroutines):
+    """
+    Runs the coroutines together on a new event loop, and returns their
+    results (or the exceptions they raised) in order.
+    """
+    async def _all():
+        return await asyncio.gather(*coroutines, return_exceptions=True)
+    return asyncio.run(_all())
+
+
+def _kill(p):
+    try:
+        p.kill()
+    except ProcessLookupError:
+        pass
+
+
+async def _wait4(loop, pid):
+    """
+    Waits for the process to exit without blocking the loop, then reaps it.
+    Returns (wait status, rusage).
+    """
+    fd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            fd = os.pidfd_open(pid)
+        except OSError:
+            fd = None
+    if fd is None:
+        _, status, rusage = await loop.run_in_executor(None, os.wait4, pid, 0)
+        return status, rusage
+    exited = loop.create_future()
+    loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+    _, status, rusage = os.wait4(pid, 0)
+    return status, rusage
+
+
+async def _open_reader(loop, pipe):
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader, transport
+
+
+async def _read_lines(loop, pipe, chunks, on_line):
+    reader, transport = await _open_reader(loop, pipe)
+    try:
+        pending = b''
+        while True:
+            chunk = await reader.read(READ_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if on_line is None:
+                continue
+            pending += chunk
+            parts = pending.replace(b'\r', b'\n').split(b'\n')
+            pending = parts.pop()
+            for line in parts:
+                if len(line) > 0:
+                    on_line(line)
+        if on_line is not None and len(pending) > 0:
+            on_line(pending)
+    finally:
+        transport.close()
@@ -1,16 +1,59 @@
 
 import os
+import sys
 import subprocess
+import threading
+import time
 import re
+from . import proc as tool_proc
+from .proc import Watchdog
 
 BIN_FFMPEG = 'ffmpeg'
 
+_VERSION = None
+
+
+def get_version():
+    """
+    Returns the ffmpeg version line (e.g. "ffmpeg version 4.4.2 ..."), which
+    identifies the encoder build.
+    """
+    global _VERSION
+    if _VERSION is None:
+        cp = tool_proc.run([BIN_FFMPEG, '-version'],
+            timeout=tool_proc.PROBE_TIMEOUT,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        lines = cp.stdout.decode('utf-8', 'ignore').splitlines()
+        _VERSION = lines[0].strip() if lines else ''
+    return _VERSION
+
 
 def convert(srcfile, outfile, bit_rate, channels, sample_rate, codec, tags, volume=None, verbose=False):
     """
     Converts the source file to the outfile with the proper transformations.
     Includes the additional tags.
     """
+    cmd = _convert_cmd(srcfile, outfile, bit_rate, channels, sample_rate, codec, tags, volume, verbose)
+
+    # force bits per sample = 16.
+    tool_proc.run(cmd,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+
+
+async def convert_async(runner, srcfile, outfile, bit_rate, channels, sample_rate, codec, tags,
+        volume=None, verbose=False, on_stderr=None):
+    """
+    `convert` run by an async_proc.AsyncToolRunner.  Returns the ToolResult.
+    """
+    cmd = _convert_cmd(srcfile, outfile, bit_rate, channels, sample_rate, codec, tags, volume, verbose)
+    return await runner.run(cmd, on_stderr=on_stderr, capture_stdout=False)
+
+
+def _convert_cmd(srcfile, outfile, bit_rate, channels, sample_rate, codec, tags, volume, verbose):
     if srcfile == outfile:
         raise Exception('Does not support overwriting file')
 
@@ -33,18 +76,208 @@ def convert(srcfile, outfile, bit_rate, channels, sample_rate, codec, tags, volu
     cmd.append(outfile)
     if verbose:
         print(' '.join(cmd))
+    return cmd
 
-    # force bits per sample = 16.
-    subprocess.run(cmd,
+
+# Signed 16 bit PCM in the native byte order, the format rendered by libxmp.
+PCM_S16_NATIVE = sys.byteorder == 'little' and 's16le' or 's16be'
+
+
+def convert_pcm(write_pcm, outfile, in_sample_rate, in_channels,
+        bit_rate, channels, sample_rate, codec, tags, volume=None, verbose=False):
+    """
+    Like `convert`, but the source is raw signed 16 bit PCM audio, written by
+    the `write_pcm(stream)` callback into the stdin pipe of ffmpeg.  The
+    pipe gives back-pressure: the writes block while the encoder is behind.
+    No temporary file is used.
+    """
+    if os.path.isfile(outfile):
+        os.unlink(outfile)
+
+    cmd = [
+        BIN_FFMPEG, '-nostdin',
+        '-f', PCM_S16_NATIVE, '-ar', str(in_sample_rate), '-ac', str(in_channels),
+        '-i', 'pipe:0',
+        '-acodec', codec, '-ar', str(sample_rate),
+        '-ac', str(channels), '-b:a', str(bit_rate),
+        '-bits_per_raw_sample', '16'
+    ]
+    if volume:
+        cmd.append('-filter:a')
+        cmd.append("volume={0}".format(volume))
+    for k, v in tags.items():
+        cmd.append('-metadata')
+        cmd.append('{0}={1}'.format(k, v))
+    cmd.append(outfile)
+    if verbose:
+        print(' '.join(cmd))
+
+    _run_pcm(cmd, write_pcm)
+
+
+def _run_pcm(cmd, write_pcm):
+    """
+    Runs the ffmpeg command with `write_pcm(stream)` feeding its stdin, and
+    returns its stderr output.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+    # stderr must be read while stdin is written, or a chatty ffmpeg blocks
+    # on a full stderr pipe while we block on a full stdin pipe.
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()),
+        daemon=True)
+    reader.start()
+    try:
+        with Watchdog(proc, cmd) as watchdog:
+            try:
+                write_pcm(proc.stdin)
+            except BrokenPipeError:
+                # ffmpeg quit early; its exit code tells why.
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            retcode = tool_proc.wait(proc, start)
+    except:
+        if proc.returncode is None:
+            proc.kill()
+            tool_proc.wait(proc, start)
+        raise
+    finally:
+        reader.join()
+        proc.stderr.close()
+    watchdog.check()
+    if retcode != 0:
+        raise subprocess.CalledProcessError(retcode, cmd,
+            stderr=stderr and stderr[0] or None)
+    return stderr and stderr[0] or b''
+
+
+# Size of each block read from the decoder pipe.
+PCM_BLOCK_SIZE = 1024 * 1024
+
+
+def read_pcm(srcfile, sample_rate, channels, duration=None, block_size=PCM_BLOCK_SIZE):
+    """
+    Decodes the first audio stream of the file into signed 16 bit PCM in the
+    native byte order, and yields it in blocks of `block_size` bytes (the
+    last may be shorter, and blocks may end part way into a frame).  If
+    `duration` is given, only that many seconds are decoded.
+
+    Closing the generator early stops ffmpeg.
+    """
+    cmd = [
+        BIN_FFMPEG, '-nostdin', '-i', srcfile,
+        '-vn', '-sn', '-dn', '-map', '0:a:0'
+    ]
+    if duration is not None:
+        cmd.extend(['-t', str(duration)])
+    cmd.extend([
+        '-f', PCM_S16_NATIVE, '-acodec', 'pcm_' + PCM_S16_NATIVE,
+        '-ar', str(sample_rate), '-ac', str(channels),
+        'pipe:1'
+    ])
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()),
+        daemon=True)
+    reader.start()
+    retcode = None
+    watchdog = Watchdog(proc, cmd)
+    try:
+        with watchdog:
+            while True:
+                b = proc.stdout.read(block_size)
+                if not b:
+                    break
+                yield b
+            retcode = tool_proc.wait(proc, start)
+    finally:
+        if proc.returncode is None:
+            # Closed early, or failed.
+            proc.kill()
+            tool_proc.wait(proc, start)
+        # Close stdout first, so nothing left writing to it keeps stderr open.
+        proc.stdout.close()
+        reader.join()
+        proc.stderr.close()
+    watchdog.check()
+    if retcode != 0:
+        raise subprocess.CalledProcessError(retcode, cmd,
+            stderr=stderr and stderr[0] or None)
+
+
+def remux(srcfile, outfile, tags, verbose=False):
+    """
+    Copies the first audio stream into the container for the outfile,
+    without re-encoding it.
+    """
+    tool_proc.run(_remux_cmd(srcfile, outfile, tags, verbose),
         check=True,
         stdout=subprocess.DEVNULL,
         stderr=subprocess.PIPE)
 
 
+async def remux_async(runner, srcfile, outfile, tags, verbose=False, on_stderr=None):
+    """
+    `remux` run by an async_proc.AsyncToolRunner.  Returns the ToolResult.
+    """
+    return await runner.run(_remux_cmd(srcfile, outfile, tags, verbose),
+        on_stderr=on_stderr, capture_stdout=False)
+
+
+def _remux_cmd(srcfile, outfile, tags, verbose):
+    if srcfile == outfile:
+        raise Exception('Does not support overwriting file')
+
+    if os.path.isfile(outfile):
+        os.unlink(outfile)
+
+    cmd = [
+        BIN_FFMPEG, '-i', srcfile,
+        '-vn', '-sn', '-dn',
+        '-map', '0:a:0', '-c:a', 'copy'
+    ]
+    for k, v in tags.items():
+        cmd.append('-metadata')
+        cmd.append('{0}={1}'.format(k, v))
+    cmd.append(outfile)
+    if verbose:
+        print(' '.join(cmd))
+    return cmd
+
+
 def trim_audio(srcfile, outfile, start_time, end_time):
     """
     Trims audio.  Start and end time must be in the "hh:mm:ss.nn" format (e.g. 00:01:22.00)
     """
+    cmd = _trim_cmd(srcfile, outfile, start_time, end_time)
+    print('Running "{0}"'.format(' '.join(cmd)))
+    tool_proc.run(cmd,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+
+
+async def trim_audio_async(runner, srcfile, outfile, start_time, end_time, on_stderr=None):
+    """
+    `trim_audio` run by an async_proc.AsyncToolRunner.  Returns the ToolResult.
+    """
+    return await runner.run(_trim_cmd(srcfile, outfile, start_time, end_time),
+        on_stderr=on_stderr, capture_stdout=False)
+
+
+def _trim_cmd(srcfile, outfile, start_time, end_time):
     if srcfile == outfile:
         raise Exception('Does not support overwriting file')
 
@@ -64,12 +297,7 @@ def trim_audio(srcfile, outfile, start_time, end_time):
         cmd.extend(['-to', end_time])
 
     cmd.append(outfile)
-
-    print('Running "{0}"'.format(' '.join(cmd)))
-    subprocess.run(cmd,
-        check=True,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.PIPE)
+    return cmd
 
 
 LINE_MEAN_VOLUME = \
@@ -88,22 +316,55 @@ class VolumeLevel(object):
 def find_volume_levels(srcfile):
     """
     """
-    cmd = [
+    cmd = _volume_levels_cmd(srcfile)
+
+    # print('DEBUG running [{0}]'.format(' '.join(cmd)))
+    proc = tool_proc.run(cmd, check=True,
+        #capture_output=True,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        encoding='utf-8', errors='ignore')
+    return _parse_volume_levels(proc.stdout)
+
+
+async def find_volume_levels_async(runner, srcfile, on_stderr=None):
+    """
+    `find_volume_levels` run by an async_proc.AsyncToolRunner.
+    """
+    result = await runner.run(_volume_levels_cmd(srcfile),
+        on_stderr=on_stderr, capture_stdout=False)
+    return _parse_volume_levels(result.stderr.decode('utf-8', 'ignore'))
+
+
+def _volume_levels_cmd(srcfile):
+    return [
         BIN_FFMPEG, '-i', srcfile,
         '-af', "volumedetect",
         '-vn', '-sn', '-dn',
         '-f', 'null', os.path.devnull
     ]
 
-    # print('DEBUG running [{0}]'.format(' '.join(cmd)))
-    proc = subprocess.run(cmd, check=True,
-        #capture_output=True,
-        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-        encoding='utf-8', errors='ignore')
+
+def find_pcm_volume_levels(write_pcm, in_sample_rate, in_channels):
+    """
+    Like `find_volume_levels`, but for raw signed 16 bit PCM audio written by
+    the `write_pcm(stream)` callback, as with `convert_pcm`.
+    """
+    cmd = [
+        BIN_FFMPEG, '-nostdin',
+        '-f', PCM_S16_NATIVE, '-ar', str(in_sample_rate), '-ac', str(in_channels),
+        '-i', 'pipe:0',
+        '-af', "volumedetect",
+        '-f', 'null', os.path.devnull
+    ]
+    output = _run_pcm(cmd, write_pcm)
+    return _parse_volume_levels(output.decode('utf-8', 'ignore'))
+
+
+def _parse_volume_levels(output):
     max_volume = None
     mean_volume = None
     histogram = {}
-    for line in proc.stdout.splitlines():
+    for line in output.splitlines():
         line = line.strip()
         # print('DEBUG output [{0}]'.format(line))
         m = LINE_MEAN_VOLUME.match(line)
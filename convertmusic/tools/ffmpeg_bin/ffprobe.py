@@ -8,7 +8,11 @@ import subprocess
 import json
 import hashlib
 from ..probe import MediaProbe, ProbeFactory
-from .ffmpeg import convert
+from .ffmpeg import (
+    convert, remux, find_volume_levels, read_pcm, convert_async, remux_async,
+)
+from . import proc as tool_proc
+from ..stage_metrics import timed
 
 BIN_FFPROBE = 'ffprobe'
 
@@ -24,19 +28,25 @@ def __run(srcfile):
     # ffprobe -v quiet -hide_banner -of json -print_format json -show_format -show_streams -i "$1"
     # }
 
-    cp = subprocess.run([BIN_FFPROBE, "-v", "quiet", "-hide_banner", "-of",
-        "json", "-print_format", "json", "-show_format", "-show_streams", "-i", srcfile],
+    cp = tool_proc.run(_probe_cmd(srcfile),
+        timeout=tool_proc.PROBE_TIMEOUT,
         check=True,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE)
     return cp.stdout.decode('utf-8')
 
 
+def _probe_cmd(srcfile):
+    return [BIN_FFPROBE, "-v", "quiet", "-hide_banner", "-of",
+        "json", "-print_format", "json", "-show_format", "-show_streams", "-i", srcfile]
+
+
 def __format_run(arg):
     """
     Runs the probe operation to return the list of encoder or decoder.
     """
-    cp = subprocess.run([BIN_FFPROBE, arg, "-v", "quiet", "-hide_banner"],
+    cp = tool_proc.run([BIN_FFPROBE, arg, "-v", "quiet", "-hide_banner"],
+        timeout=tool_proc.PROBE_TIMEOUT,
         check=True,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE)
@@ -119,23 +129,89 @@ class FfProbe(MediaProbe):
     def __init__(self, filename):
         MediaProbe.__init__(self, filename)
 
-    def transcode(self, tofile, sample_rate = 44100, bit_rate = 0, channels = 2, codec = None, verbose=False):
+    def transcode(self, tofile, sample_rate = 44100, bit_rate = 0, channels = 2, codec = None, volume=None, verbose=False):
         convert(self.filename, tofile,
             bit_rate=bit_rate,
             channels=channels,
             sample_rate=sample_rate,
             codec=codec,
+            tags=self.get_tags(),
+            volume=volume,
+            verbose=verbose)
+
+    def volume_levels(self):
+        # Loads numpy; not needed until something is measured.
+        from .. import pcm_analysis
+        if pcm_analysis.available():
+            return MediaProbe.volume_levels(self)
+        return find_volume_levels(self.filename)
+
+    def decode_pcm(self, sample_rate=None, channels=None, duration=None):
+        sample_rate = sample_rate or self.sample_rate or 44100
+        channels = channels or self.channels or 2
+        return sample_rate, channels, read_pcm(self.filename, sample_rate, channels, duration)
+
+    def remux(self, tofile, verbose=False):
+        remux(self.filename, tofile,
+            tags=self.get_tags(),
+            verbose=verbose)
+
+    async def transcode_async(self, runner, tofile, sample_rate=44100, bit_rate=0, channels=2, codec=None,
+            volume=None, verbose=False):
+        await convert_async(runner, self.filename, tofile,
+            bit_rate=bit_rate,
+            channels=channels,
+            sample_rate=sample_rate,
+            codec=codec,
+            tags=self.get_tags(),
+            volume=volume,
+            verbose=verbose)
+
+    async def remux_async(self, runner, tofile, verbose=False):
+        await remux_async(runner, self.filename, tofile,
             tags=self.get_tags(),
             verbose=verbose)
 
 
+def _has_extra_streams(j):
+    audio_count = 0
+    for s in j['streams']:
+        if s.get('codec_type') == 'audio':
+            audio_count += 1
+        elif not s.get('disposition', {}).get('attached_pic'):
+            return True
+    return audio_count > 1
+
+
 def probe(srcfile):
-    j = _json_probe(srcfile)
+    return _probe_from_json(srcfile, _json_probe(srcfile))
+
+
+async def probe_async(runner, srcfile):
+    """
+    `probe` with ffprobe run by an async_proc.AsyncToolRunner.  The file
+    hashing runs in the loop's default executor.
+    """
+    import asyncio
+    result = await runner.run(_probe_cmd(srcfile), timeout=tool_proc.PROBE_TIMEOUT)
+    j = json.loads(result.stdout.decode('utf-8'))
+    return await asyncio.get_running_loop().run_in_executor(
+        None, _probe_from_json, srcfile, j)
+
+
+def _probe_from_json(srcfile, j):
     p = FfProbe(srcfile)
+    if 'format' in j:
+        p.container = j['format'].get('format_name')
+        if 'duration' in j['format']:
+            p.duration = float(j['format']['duration'])
+    p.extra_streams = _has_extra_streams(j)
     for s in j['streams']:
         if s['codec_type'] == 'audio':
             # print("DEBUG probe stream keys: {0}".format(repr(s.keys())))
-            for tag_name, tag_value in _hash_tags(srcfile).items():
+            with timed('hash'):
+                hash_tags = _hash_tags(srcfile)
+            for tag_name, tag_value in hash_tags.items():
                 p.set_tag(tag_name, tag_value)
             p.codec = s['codec_name']
             p.sample_rate = int(s['sample_rate'])
@@ -202,3 +278,6 @@ class FfProbeFactory(ProbeFactory):
 
     def probe(self, filename):
         return probe(filename)
+
+    async def probe_async(self, runner, filename):
+        return await probe_async(runner, filename)
@@ -0,0 +1,139 @@
+"""
+Runs the ffmpeg and ffprobe tools with a time limit, so a tool that hangs
+on a bad file can't stall the whole run.
+
+The limits come from the environment:
+
+* CONVERTMUSIC_PROBE_TIMEOUT - seconds for an ffprobe call (default 60).
+* CONVERTMUSIC_FFMPEG_TIMEOUT - seconds for an ffmpeg call (default 1800).
+
+The tools are reaped with os.wait4, and their run time and resource use
+are added to the current file trace (see file_trace).
+"""
+
+import os
+import time
+import threading
+import subprocess
+from .. import file_trace
+
+
+ENV_PROBE_TIMEOUT = 'CONVERTMUSIC_PROBE_TIMEOUT'
+ENV_FFMPEG_TIMEOUT = 'CONVERTMUSIC_FFMPEG_TIMEOUT'
+
+DEFAULT_PROBE_TIMEOUT = 60.0
+DEFAULT_FFMPEG_TIMEOUT = 30 * 60.0
+
+
+def _env_timeout(name, default):
+    value = os.environ.get(name)
+    if value is None or len(value.strip()) <= 0:
+        return default
+    return float(value)
+
+
+PROBE_TIMEOUT = _env_timeout(ENV_PROBE_TIMEOUT, DEFAULT_PROBE_TIMEOUT)
+FFMPEG_TIMEOUT = _env_timeout(ENV_FFMPEG_TIMEOUT, DEFAULT_FFMPEG_TIMEOUT)
+
+
+def run(cmd, timeout=None, check=False, **kwargs):
+    """
+    subprocess.run with a time limit (the ffmpeg limit if not given).  On
+    timeout the tool is killed and subprocess.TimeoutExpired is raised.
+    """
+    if timeout is None:
+        timeout = FFMPEG_TIMEOUT
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, **kwargs)
+    output = {}
+    readers = []
+    for name in ('stdout', 'stderr'):
+        pipe = getattr(proc, name)
+        if pipe is not None:
+            reader = threading.Thread(target=lambda n=name, p=pipe: output.__setitem__(n, p.read()),
+                daemon=True)
+            reader.start()
+            readers.append(reader)
+    try:
+        with Watchdog(proc, cmd, timeout) as watchdog:
+            for reader in readers:
+                reader.join()
+            wait(proc, start)
+    except:
+        if proc.returncode is None:
+            proc.kill()
+            wait(proc, start)
+        raise
+    finally:
+        for pipe in (proc.stdout, proc.stderr):
+            if pipe is not None:
+                pipe.close()
+    watchdog.check()
+    cp = subprocess.CompletedProcess(cmd, proc.returncode, output.get('stdout'), output.get('stderr'))
+    if check:
+        cp.check_returncode()
+    return cp
+
+
+def wait(proc, start=None):
+    """
+    Waits for the Popen process to exit, reaping it with os.wait4 so its
+    resource use is known, and returns its exit code.  If the start time
+    (a perf_counter) is given, the run is added to the current file trace.
+    """
+    rusage = None
+    if proc.returncode is None and hasattr(os, 'wait4'):
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            # Reaped by Popen.poll in the meantime.
+            pass
+    if proc.returncode is None:
+        proc.wait()
+    if start is not None:
+        file_trace.tool_exited(proc.args, proc.returncode, rusage, start,
+            time.perf_counter() - start)
+    return proc.returncode
+
+
+class Watchdog(object):
+    """
+    Kills a Popen process that runs longer than the timeout.  For processes
+    that are fed or read through pipes, where Popen.wait's timeout can't
+    help because the caller is blocked on the pipe instead.
+
+        with Watchdog(proc, cmd) as watchdog:
+            ...
+        watchdog.check()
+    """
+    def __init__(self, proc, cmd, timeout=None):
+        object.__init__(self)
+        if timeout is None:
+            timeout = FFMPEG_TIMEOUT
+        self.proc = proc
+        self.cmd = cmd
+        self.timeout = timeout
+        self.expired = False
+        self.__timer = threading.Timer(timeout, self.__expire)
+        self.__timer.daemon = True
+
+    def __enter__(self):
+        self.__timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__timer.cancel()
+        if self.expired and exc_type is not None and exc_type is not subprocess.TimeoutExpired:
+            # The failure was caused by the kill.
+            raise subprocess.TimeoutExpired(self.cmd, self.timeout)
+
+    def check(self):
+        """Raises subprocess.TimeoutExpired if the process was killed."""
+        if self.expired:
+            raise subprocess.TimeoutExpired(self.cmd, self.timeout)
+
+    def __expire(self):
+        if self.proc.poll() is None:
+            self.expired = True
+            self.proc.kill()
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+"""
+Tests for running the tools from an asyncio event loop.  Small Python
+scripts stand in for ffmpeg.
+
+Run with:
+
+    python3 -m pytest convertmusic/tools/ffmpeg_bin/test_async_proc.py
+"""
+
+import sys
+import time
+import asyncio
+import subprocess
+import unittest
+from convertmusic.tools.ffmpeg_bin.async_proc import AsyncToolRunner, run_all
+
+
+def _script(code):
+    return [sys.executable, '-c', code]
+
+
+class AsyncToolRunnerTest(unittest.TestCase):
+    def test_output(self):
+        lines = []
+        runner = AsyncToolRunner(2)
+        result = run_all([runner.run(_script(
+            'import sys\n'
+            'sys.stdout.write("out")\n'
+            'sys.stderr.write("frame=1\\rframe=2\\rdone\\nlast")\n'
+        ), on_stderr=lines.append)])[0]
+        self.assertEqual(0, result.returncode)
+        self.assertEqual(b'out', result.stdout)
+        self.assertEqual(b'frame=1\rframe=2\rdone\nlast', result.stderr)
+        self.assertEqual([b'frame=1', b'frame=2', b'done', b'last'], lines)
+        self.assertGreaterEqual(result.user_seconds, 0.0)
+        self.assertGreater(result.max_rss_kb, 0)
+        self.assertEqual(0, runner.running_count)
+
+    def test_no_stdout(self):
+        runner = AsyncToolRunner(1)
+        result = run_all([runner.run(_script('print("out")'), capture_stdout=False)])[0]
+        self.assertIsNone(result.stdout)
+
+    def test_failure(self):
+        runner = AsyncToolRunner(2)
+        cmd = _script('import sys; sys.exit(3)')
+        results = run_all([runner.run(cmd), runner.run(cmd, check=False)])
+        self.assertIsInstance(results[0], subprocess.CalledProcessError)
+        self.assertEqual(3, results[0].returncode)
+        self.assertEqual(3, results[1].returncode)
+
+    def test_timeout(self):
+        runner = AsyncToolRunner(1)
+        start = time.perf_counter()
+        result = run_all([runner.run(_script('import time; time.sleep(30)'), timeout=0.5)])[0]
+        self.assertIsInstance(result, subprocess.TimeoutExpired)
+        self.assertLess(time.perf_counter() - start, 10.0)
+        self.assertEqual(0, runner.running_count)
+
+    def test_cancelled(self):
+        runner = AsyncToolRunner(1)
+
+        async def _cancel():
+            task = asyncio.ensure_future(runner.run(_script('import time; time.sleep(30)')))
+            while runner.running_count <= 0:
+                await asyncio.sleep(0.05)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return runner.running_count
+
+        start = time.perf_counter()
+        self.assertEqual(0, asyncio.run(_cancel()))
+        self.assertLess(time.perf_counter() - start, 10.0)
+
+    def test_max_concurrent(self):
+        runner = AsyncToolRunner(2)
+        peak = []
+
+        async def _run():
+            return await runner.run(_script('import time; time.sleep(0.3)'))
+
+        async def _watch(tasks):
+            while not all(t.done() for t in tasks):
+                peak.append(runner.running_count)
+                await asyncio.sleep(0.02)
+
+        async def _all():
+            tasks = [asyncio.ensure_future(_run()) for i in range(4)]
+            await _watch(tasks)
+            return [t.result() for t in tasks]
+
+        results = asyncio.run(_all())
+        self.assertEqual([0, 0, 0, 0], [r.returncode for r in results])
+        self.assertEqual(2, max(peak))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Content hashes of the output files, as recorded in TARGET_FILE.
+"""
+
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def hash_file(filename, block_size=BLOCK_SIZE):
+    """
+    Returns (size, sha256 hex digest) of the file.
+    """
+    h = hashlib.sha256()
+    size = 0
+    buff = bytearray(block_size)
+    view = memoryview(buff)
+    with open(filename, 'rb', buffering=0) as inp:
+        while True:
+            count = inp.readinto(buff)
+            if not count:
+                break
+            size += count
+            h.update(view[0:count])
+    return size, h.hexdigest()
+
+
+def copy_and_hash(src_file, target_file, block_size=BLOCK_SIZE):
+    """
+    Copies the file, hashing the data on the way through.  Returns
+    (size, sha256 hex digest) of the copy.
+    """
+    with open(src_file, 'rb', buffering=0) as inp:
+        with open(target_file, 'wb', buffering=0) as out:
+            return copy_fd_and_hash(inp.fileno(), out.fileno(), block_size)
+
+
+def copy_fd_and_hash(src_fd, target_fd, block_size=BLOCK_SIZE):
+    """
+    Copies from the current position of src_fd to target_fd, hashing the
+    data on the way through.  Returns (size, sha256 hex digest).
+    """
+    h = hashlib.sha256()
+    size = 0
+    buff = bytearray(block_size)
+    view = memoryview(buff)
+    inp = open(src_fd, 'rb', buffering=0, closefd=False)
+    while True:
+        count = inp.readinto(buff)
+        if not count:
+            break
+        h.update(view[0:count])
+        size += count
+        pos = 0
+        while pos < count:
+            pos += os.write(target_fd, view[pos:count])
+    return size, h.hexdigest()
+
+
+# verify_files states.
+OK = 'ok'
+MISSING = 'missing'
+UNRECORDED = 'unrecorded'
+# The file was changed since it was recorded (its size or modification time
+# differ), such as by a tool that doesn't record the new hash.
+CHANGED = 'changed'
+# Same size and modification time, different contents.
+CORRUPT = 'corrupt'
+
+
+def verify_file(filename, size, mtime_ns, sha256):
+    """
+    Hashes the file and compares it to the recorded values, which may be
+    None.  Returns (state, size, mtime_ns, sha256) with the file's current
+    values.
+    """
+    try:
+        st = os.stat(filename)
+        actual_size, actual_sha256 = hash_file(filename)
+    except FileNotFoundError:
+        return MISSING, None, None, None
+    ret = (actual_size, st.st_mtime_ns, actual_sha256)
+    if sha256 is None:
+        return (UNRECORDED,) + ret
+    if actual_size == size and actual_sha256 == sha256:
+        return (OK,) + ret
+    if size != actual_size or mtime_ns != st.st_mtime_ns:
+        return (CHANGED,) + ret
+    return (CORRUPT,) + ret
+
+
+def verify_files(records, jobs):
+    """
+    records: list of (file name, size, modification time ns, sha256) as
+        recorded.
+
+    Hashes the files, `jobs` at a time, and yields (file name, state, size,
+    modification time ns, sha256) for each, in order.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for record, result in zip(records, executor.map(lambda r: verify_file(*r), records)):
+            yield (record[0],) + result
@@ -0,0 +1,161 @@
+"""
+A trace of the import, one JSON line per source file, for finding the
+files that take far longer than the rest.
+
+Each line has the source file, when its handling started, how long it
+took, the stages it went through (with their start offset and length),
+the decision made for it (copy, remux, encode, duplicate, ...), and every
+ffprobe and ffmpeg run for it with the run's wall time and its resource
+use from os.wait4: user and system CPU seconds and maximum RSS.
+
+The import enables a TraceLog, and starts a FileTrace for each file,
+which makes it current; the stages (see stage_metrics.timed), the tool
+runs (see ffmpeg_bin.proc) and the transcode decision report into the
+current trace from wherever they happen.  Nothing is recorded while no
+trace is current.
+
+The lines are written as each file finishes, so a trace of a run that was
+stopped part way is still usable:
+
+    jq -s 'sort_by(-.elapsed) | .[0:20]' trace.jsonl
+"""
+
+import os
+import json
+import time
+import threading
+
+
+_LOG = None
+_CURRENT = None
+
+
+class TraceLog(object):
+    def __init__(self, filename):
+        object.__init__(self)
+        self.filename = filename
+        self.__lock = threading.Lock()
+        self.__out = open(filename, 'a', encoding='utf-8')
+        self.count = 0
+
+    def start(self, source):
+        """
+        Starts the trace for the source file, and makes it current.
+        """
+        global _CURRENT
+        trace = FileTrace(self, source)
+        _CURRENT = trace
+        return trace
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self.__lock:
+            self.__out.write(line + '\n')
+            self.__out.flush()
+            self.count += 1
+
+    def close(self):
+        global _CURRENT
+        if _CURRENT is not None and _CURRENT.log is self:
+            _CURRENT = None
+        with self.__lock:
+            self.__out.close()
+
+
+class FileTrace(object):
+    def __init__(self, log, source):
+        object.__init__(self)
+        self.log = log
+        self.__lock = threading.Lock()
+        self.__start = time.perf_counter()
+        self.record = {
+            'source': source,
+            'started_at': time.time(),
+            'stages': [],
+            'tools': [],
+        }
+
+    def offset(self, when=None):
+        """Seconds from the start of the trace to `when` (a perf_counter)."""
+        if when is None:
+            when = time.perf_counter()
+        return when - self.__start
+
+    def stage(self, name, start, seconds):
+        """Records a stage that began at `start` (a perf_counter)."""
+        with self.__lock:
+            self.record['stages'].append({
+                'stage': name,
+                'start': round(self.offset(start), 6),
+                'seconds': round(seconds, 6),
+            })
+
+    def tool(self, cmd, returncode, rusage, start, elapsed):
+        """Records a finished ffprobe or ffmpeg run."""
+        entry = {
+            'tool': os.path.basename(str(cmd[0])),
+            'args': [str(a) for a in cmd[1:]],
+            'returncode': returncode,
+            'start': round(self.offset(start), 6),
+            'wall': round(elapsed, 6),
+        }
+        if rusage is not None:
+            entry['user'] = round(rusage.ru_utime, 6)
+            entry['sys'] = round(rusage.ru_stime, 6)
+            entry['max_rss_kb'] = rusage.ru_maxrss
+        with self.__lock:
+            self.record['tools'].append(entry)
+
+    def set(self, **fields):
+        with self.__lock:
+            self.record.update(fields)
+
+    def finish(self, outcome, **fields):
+        """
+        Writes the trace line, and stops it being current.
+        """
+        global _CURRENT
+        if _CURRENT is self:
+            _CURRENT = None
+        with self.__lock:
+            self.record.update(fields)
+            self.record['outcome'] = outcome
+            self.record.setdefault('decision', outcome)
+            self.record['elapsed'] = round(self.offset(), 6)
+            tools = self.record['tools']
+            self.record['tool_user'] = round(sum(t.get('user', 0.0) for t in tools), 6)
+            self.record['tool_sys'] = round(sum(t.get('sys', 0.0) for t in tools), 6)
+            record = self.record
+        self.log.write(record)
+
+
+def enable(log):
+    """Makes `start` trace into the TraceLog (or stop, with None)."""
+    global _LOG
+    _LOG = log
+
+
+def start(source):
+    """
+    Starts the current trace for the source file, if tracing is enabled.
+    """
+    if _LOG is None:
+        return None
+    return _LOG.start(source)
+
+
+def current():
+    return _CURRENT
+
+
+def note(**fields):
+    """Sets fields on the current trace, if there is one."""
+    trace = _CURRENT
+    if trace is not None:
+        trace.set(**fields)
+
+
+def tool_exited(cmd, returncode, rusage, start, elapsed):
+    trace = _CURRENT
+    if trace is not None:
+        trace.tool(cmd, returncode, rusage, start, elapsed)
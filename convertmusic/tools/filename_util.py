@@ -1,5 +1,6 @@
 
 import os
+import threading
 from .tag import (
     ARTIST_NAME,
     SONG_NAME,
@@ -26,7 +27,11 @@ def simplify_name(name_root):
     return ret
 
 
-def to_filename(history, probe, dirname, ext):
+def _base_name(probe, ext):
+    """
+    Returns the (simplified name, extension) pair for the probe, before any
+    collision suffix is added.
+    """
     while ext[0] == '.':
         ext = ext[1:]
     artist = probe.tag(ARTIST_NAME)
@@ -46,11 +51,20 @@ def to_filename(history, probe, dirname, ext):
     # Maximum name length is 32 (roughly), so trim it down to 28 for the
     # extension.
     name = simplify_name(name)[0:31 - len(ext)]
+    return name, ext
+
+
+def _indexed_name(name, ext, index):
+    n = '-{0}'.format(index)
+    return name[0:31 - len(ext) - len(n)] + n + '.' + ext
+
+
+def to_filename(history, probe, dirname, ext):
+    name, ext = _base_name(probe, ext)
     bn = os.path.join(dirname, name + '.' + ext)
     index = 0
     while os.path.isfile(bn) and history.is_transcoded_filename(bn):
-        n = '-{0}'.format(index)
-        bn = os.path.join(dirname, name[0:31 - len(ext) - len(n)] + n + '.' + ext)
+        bn = os.path.join(dirname, _indexed_name(name, ext, index))
         index += 1
 
     return bn
@@ -66,3 +80,93 @@ def get_destdir(base_destdir):
     if os.path.isdir(dn) and len(os.listdir(dn)) > MAX_FILES_PER_DIR:
         dn = os.path.join(base_destdir, '{0:06d}'.format(biggest + 1))
     return dn
+
+
+class OutputLayout(object):
+    """
+    In-memory version of `get_destdir` and `to_filename`.  The output
+    directory is listed once, and each bucket directory is listed at most
+    once, the first time it is used.  After that, bucket selection and
+    name allocation are answered from memory.
+
+    All allocations are made under a lock, so several transcode workers can
+    share one layout without handing out the same name twice.  Names are
+    compared case-insensitively, because the output is usually a FAT file
+    system.
+    """
+    def __init__(self, base_destdir):
+        object.__init__(self)
+        self.__base_destdir = base_destdir
+        self.__lock = threading.Lock()
+        # normalized directory name -> set of lower case entry names
+        self.__names = {}
+        biggest = 0
+        if os.path.isdir(base_destdir):
+            for f in os.listdir(base_destdir):
+                if f.isdigit() and int(f) > biggest and os.path.isdir(os.path.join(base_destdir, f)):
+                    biggest = int(f)
+        self.__bucket = biggest
+
+    @property
+    def base_destdir(self):
+        return self.__base_destdir
+
+    def get_destdir(self):
+        """
+        Returns the bucket directory new files should be placed into.  Like
+        `get_destdir`, a new bucket is started once the current one holds
+        more than MAX_FILES_PER_DIR entries.
+        """
+        with self.__lock:
+            dn = self.__bucket_dir(self.__bucket)
+            if len(self.__load(dn)) > MAX_FILES_PER_DIR:
+                self.__bucket += 1
+                dn = self.__bucket_dir(self.__bucket)
+            return dn
+
+    def to_filename(self, probe, dirname, ext):
+        """
+        Reserves and returns a file name in the directory for the probe.
+        The reservation counts against the bucket size immediately, even
+        before the file is written.
+        """
+        name, ext = _base_name(probe, ext)
+        bn = name + '.' + ext
+        with self.__lock:
+            names = self.__load(dirname)
+            index = 0
+            while bn.lower() in names:
+                bn = _indexed_name(name, ext, index)
+                index += 1
+            names.add(bn.lower())
+        return os.path.join(dirname, bn)
+
+    def reserve(self, filename):
+        """
+        Marks an existing or externally created file as used.
+        """
+        with self.__lock:
+            self.__load(os.path.dirname(filename)).add(
+                os.path.basename(filename).lower())
+
+    def release(self, filename):
+        """
+        Returns a reserved name, such as when the transcode into it failed.
+        """
+        with self.__lock:
+            self.__load(os.path.dirname(filename)).discard(
+                os.path.basename(filename).lower())
+
+    def __bucket_dir(self, index):
+        return os.path.join(self.__base_destdir, '{0:06d}'.format(index))
+
+    def __load(self, dirname):
+        key = os.path.normpath(dirname)
+        names = self.__names.get(key)
+        if names is None:
+            names = set()
+            if os.path.isdir(dirname):
+                for f in os.listdir(dirname):
+                    names.add(f.lower())
+            self.__names[key] = names
+        return names
@@ -0,0 +1,208 @@
+"""
+Acoustic fingerprints, for finding the same recording in different
+encodings (say, a 320k MP3 and a FLAC rip) when the tags don't agree.
+
+A few seconds of audio, after any leading silence, are cut into short
+overlapping frames.  Each frame's spectrum is folded into a 12 note chroma
+vector, and the vector is reduced to a 24 bit code: one bit for each note
+louder than the next note up, and one for each note louder than the
+frame's average.  The codes only depend on the coarse shape of the
+spectrum below 2kHz, so they survive lossy encoding and resampling.
+
+Two fingerprints are compared by the fraction of matching bits, at the
+best small time offset.  To find candidates quickly, every distinct frame
+code is stored as an index key; files sharing a good part of the codes
+are compared in full.  Some codes (near silence, noise, a held chord)
+turn up in most files, so codes stored for too many files aren't used
+for the lookup.  Only files of about the same length can match, since
+the fingerprint only covers the start of the audio.
+
+Needs numpy (see pcm_analysis).
+"""
+
+import math
+from .pcm_analysis import Analyzer, analyze_blocks, numpy
+
+
+# Analyse this much audio after the leading silence.
+FINGERPRINT_SECONDS = 20.0
+# Decode at most this much, to allow for the leading silence.
+DECODE_SECONDS = 40.0
+# Decoding rate, when the decoder can resample.
+DECODE_RATE = 11025
+FRAME_SECONDS = 0.372
+MIN_FREQUENCY = 55.0
+MAX_FREQUENCY = 2000.0
+SILENCE_LEVEL = 0.001
+# Fingerprints with fewer frames aren't useful.
+MIN_FRAMES = 16
+# Frames that two fingerprints may be shifted by.
+MAX_OFFSET = 4
+# Minimum fraction of matching bits for two files to be the same recording.
+MATCH_SIMILARITY = 0.85
+# Minimum shared frame codes for a stored file to be a candidate, as a
+# fraction of the file's usable codes, but at least MIN_KEY_HITS; and the
+# most candidates compared in full.
+MIN_KEY_HIT_FRACTION = 0.25
+MIN_KEY_HITS = 3
+MAX_CANDIDATES = 20
+# Codes stored for more than this fraction of the fingerprinted files (and
+# more than COMMON_KEY_MIN_FILES files) are too common to find candidates.
+COMMON_KEY_FRACTION = 0.05
+COMMON_KEY_MIN_FILES = 10
+# Two files can only be the same recording if their lengths differ by at
+# most the larger of these.
+DURATION_TOLERANCE_SECONDS = 2.0
+DURATION_TOLERANCE_FRACTION = 0.02
+
+
+class Fingerprint(object):
+    def __init__(self, codes):
+        """codes: numpy uint32 array, one code per frame."""
+        object.__init__(self)
+        self.codes = codes
+
+    def keys(self):
+        """The distinct non-silent frame codes, for the lookup index."""
+        return sorted(set(int(c) for c in self.codes if c != 0))
+
+    def to_hex(self):
+        return self.codes.astype('>u4').tobytes().hex()
+
+    @staticmethod
+    def from_hex(text):
+        return Fingerprint(numpy.frombuffer(bytes.fromhex(text), dtype='>u4').astype(numpy.uint32))
+
+    def similarity(self, other):
+        """
+        The fraction of matching bits (0 to 1) at the best offset of up to
+        MAX_OFFSET frames.  Unrelated audio usually scores 0.5 to 0.7.
+        """
+        best = 0.0
+        for offset in range(-MAX_OFFSET, MAX_OFFSET + 1):
+            if offset >= 0:
+                a = self.codes[offset:]
+                b = other.codes
+            else:
+                a = self.codes
+                b = other.codes[-offset:]
+            count = min(len(a), len(b))
+            if count < MIN_FRAMES:
+                continue
+            diff = numpy.bitwise_xor(a[0:count], b[0:count])
+            errors = int(numpy.unpackbits(diff.view(numpy.uint8)).sum())
+            best = max(best, 1.0 - errors / float(count * 24))
+        return best
+
+
+def common_key_limit(fingerprint_count):
+    """
+    The most files a frame code may be stored for, out of the
+    fingerprint_count fingerprinted files, and still be used for finding
+    candidates.
+    """
+    return max(COMMON_KEY_MIN_FILES, int(fingerprint_count * COMMON_KEY_FRACTION))
+
+
+def min_key_hits(key_count):
+    """
+    The shared frame codes a stored file needs to be a candidate, for a
+    lookup with key_count usable codes.
+    """
+    return max(MIN_KEY_HITS, int(math.ceil(key_count * MIN_KEY_HIT_FRACTION)))
+
+
+def duration_range(duration):
+    """
+    The (shortest, longest) lengths, in seconds, of the files that may be
+    the same recording as a file of this length; that is, the lengths b
+    where abs(duration - b) is at most DURATION_TOLERANCE_SECONDS or
+    DURATION_TOLERANCE_FRACTION of the longer of the two.
+    """
+    return (
+        min(duration - DURATION_TOLERANCE_SECONDS, duration * (1.0 - DURATION_TOLERANCE_FRACTION)),
+        max(duration + DURATION_TOLERANCE_SECONDS, duration / (1.0 - DURATION_TOLERANCE_FRACTION))
+    )
+
+
+class FingerprintAnalyzer(Analyzer):
+    """
+    Collects the mono audio for the fingerprint.  Works at any sample rate,
+    so it can share the decode with the other analyzers.
+    """
+    def start(self, sample_rate, channels):
+        Analyzer.start(self, sample_rate, channels)
+        self.__wanted = int(FINGERPRINT_SECONDS * sample_rate)
+        self.__parts = []
+        self.__have = 0
+        self.__started = False
+
+    def update(self, samples):
+        if self.__have >= self.__wanted:
+            return
+        mono = samples.astype(numpy.float32).mean(axis=1) / 32768.0
+        if not self.__started:
+            loud = numpy.flatnonzero(numpy.abs(mono) > SILENCE_LEVEL)
+            if loud.size <= 0:
+                return
+            mono = mono[int(loud[0]):]
+            self.__started = True
+        mono = mono[0:self.__wanted - self.__have]
+        self.__parts.append(mono)
+        self.__have += mono.size
+
+    def result(self):
+        if self.__have <= 0:
+            return {'fingerprint': None}
+        return {'fingerprint': compute_fingerprint(
+            numpy.concatenate(self.__parts), self.sample_rate)}
+
+
+def compute_fingerprint(mono, sample_rate):
+    """
+    Returns the Fingerprint of the mono float audio, or None if it's too
+    short.
+    """
+    frame_size = 2 ** int(round(math.log2(sample_rate * FRAME_SECONDS)))
+    hop = frame_size // 2
+    frame_count = (mono.size - frame_size) // hop + 1
+    if frame_count < MIN_FRAMES:
+        return None
+    frames = numpy.lib.stride_tricks.as_strided(mono,
+        shape=(frame_count, frame_size),
+        strides=(mono.strides[0] * hop, mono.strides[0]))
+    spectrum = numpy.abs(numpy.fft.rfft(frames * numpy.hanning(frame_size), axis=1)) ** 2
+
+    freqs = numpy.arange(spectrum.shape[1]) * (sample_rate / float(frame_size))
+    used = numpy.flatnonzero((freqs >= MIN_FREQUENCY) & (freqs <= MAX_FREQUENCY))
+    notes = numpy.round(12 * numpy.log2(freqs[used] / 440.0)).astype(numpy.intp) % 12
+    fold = numpy.zeros((used.size, 12), dtype=numpy.float64)
+    fold[numpy.arange(used.size), notes] = 1.0
+    chroma = spectrum[:, used] @ fold
+
+    energy = chroma.sum(axis=1)
+    quiet = energy <= frame_size * (SILENCE_LEVEL ** 2)
+    chroma = chroma / numpy.maximum(energy, 1e-12)[:, None]
+
+    weights = (1 << numpy.arange(12)).astype(numpy.uint32)
+    step_bits = (chroma > numpy.roll(chroma, -1, axis=1)).astype(numpy.uint32) @ weights
+    mean_bits = (chroma > (1.0 / 12)).astype(numpy.uint32) @ weights
+    codes = (step_bits | (mean_bits << 12)).astype(numpy.uint32)
+    codes[quiet] = 0
+    return Fingerprint(codes)
+
+
+def fingerprint_probe(probe):
+    """
+    Decodes the start of the probed file and returns its Fingerprint, or
+    None if the audio is too short or silent.
+    """
+    analyzer = FingerprintAnalyzer()
+    sample_rate, channels, blocks = probe.decode_pcm(
+        sample_rate=DECODE_RATE, channels=1, duration=DECODE_SECONDS)
+    try:
+        analyze_blocks(blocks, sample_rate, channels, [analyzer])
+    finally:
+        if hasattr(blocks, 'close'):
+            blocks.close()
+    return analyzer.result()['fingerprint']
@@ -0,0 +1,515 @@
+"""
+Writes tags directly into MP3 (ID3v2) and M4A (MP4 `ilst`) files, without
+running the audio through ffmpeg.
+
+The writers only change the file in place: the ID3v2 tag must already
+exist and have enough padding for the new frames, and the MP4 `moov` box
+must either have free space next to it or be the last box in the file (the
+ffmpeg default), so that no audio data moves.  If the file can't be
+changed that way, the writers return False and the caller is expected to
+fall back to a full rewrite.
+
+Like the ffmpeg `-metadata` option, only the given tags are replaced; all
+other tags in the file are left alone.  A tag value of None removes it.
+"""
+
+import os
+import struct
+
+
+class UnsupportedTagLayout(Exception):
+    """The file's tag structure can't be edited natively."""
+    pass
+
+
+def write_tags(filename, new_tags):
+    """
+    Writes the tags into the file in place.  Returns True if the tags were
+    written, or False if the file type or layout isn't supported natively.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if os.stat(filename).st_nlink > 1:
+        # Editing in place would change the other links too (such as a
+        # transcode cache entry).
+        return False
+    try:
+        if ext == '.mp3':
+            return write_id3v2_tags(filename, new_tags)
+        if ext in ('.m4a', '.mp4', '.m4b'):
+            return write_mp4_tags(filename, new_tags)
+    except UnsupportedTagLayout:
+        return False
+    return False
+
+
+# ---------------------------------------------------------------------------
+# ID3v2
+
+# ffmpeg metadata key -> ID3v2 text frame, shared by v2.3 and v2.4.
+ID3_TEXT_FRAMES = {
+    'album': b'TALB',
+    'composer': b'TCOM',
+    'genre': b'TCON',
+    'copyright': b'TCOP',
+    'encoded_by': b'TENC',
+    'title': b'TIT2',
+    'language': b'TLAN',
+    'artist': b'TPE1',
+    'album_artist': b'TPE2',
+    'performer': b'TPE3',
+    'disc': b'TPOS',
+    'publisher': b'TPUB',
+    'track': b'TRCK',
+    'encoder': b'TSSE',
+    'compilation': b'TCMP',
+    'grouping': b'TIT1',
+}
+ID3_V24_TEXT_FRAMES = {
+    'date': b'TDRC',
+    'year': b'TDRC',
+}
+ID3_V23_TEXT_FRAMES = {
+    'date': b'TYER',
+    'year': b'TYER',
+}
+
+ID3_HEADER = struct.Struct('>3sBBB4s')
+ID3_FLAG_UNSYNC = 0x80
+ID3_FLAG_EXTENDED = 0x40
+ID3_FLAG_FOOTER = 0x10
+
+ENC_LATIN1 = 0
+ENC_UTF16 = 1
+ENC_UTF8 = 3
+
+
+def _syncsafe_decode(b):
+    return (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+
+
+def _syncsafe_encode(v):
+    if v >= (1 << 28):
+        raise UnsupportedTagLayout('frame too large')
+    return bytes(((v >> 21) & 0x7f, (v >> 14) & 0x7f, (v >> 7) & 0x7f, v & 0x7f))
+
+
+def _id3_text_frame_for(key, version):
+    key = key.lower()
+    if key in ID3_TEXT_FRAMES:
+        return ID3_TEXT_FRAMES[key]
+    if version == 4:
+        return ID3_V24_TEXT_FRAMES.get(key)
+    return ID3_V23_TEXT_FRAMES.get(key)
+
+
+def _id3_encoding(values, version):
+    for v in values:
+        try:
+            v.encode('latin-1')
+        except UnicodeEncodeError:
+            return version == 4 and ENC_UTF8 or ENC_UTF16
+    return ENC_LATIN1
+
+
+def _id3_encode(text, encoding, terminate=True):
+    """Encodes the text, optionally with its terminator."""
+    if encoding == ENC_LATIN1:
+        ret = text.encode('latin-1')
+    elif encoding == ENC_UTF8:
+        ret = text.encode('utf-8')
+    else:
+        ret = text.encode('utf-16')
+    if terminate:
+        ret += encoding == ENC_UTF16 and b'\x00\x00' or b'\x00'
+    return ret
+
+
+def _id3_decode_desc(data, encoding):
+    """Decodes the terminated description at the start of the data."""
+    if encoding in (ENC_LATIN1, ENC_UTF8):
+        p = data.find(b'\x00')
+        if p < 0:
+            p = len(data)
+        return data[0:p].decode(encoding == ENC_UTF8 and 'utf-8' or 'latin-1', 'replace')
+    p = 0
+    while p + 1 < len(data) and data[p:p + 2] != b'\x00\x00':
+        p += 2
+    codec = encoding == ENC_UTF16 and 'utf-16' or 'utf-16-be'
+    return data[0:p].decode(codec, 'replace')
+
+
+def _id3_frame(frame_id, payload, version):
+    if version == 4:
+        size = _syncsafe_encode(len(payload))
+    else:
+        size = struct.pack('>I', len(payload))
+    return frame_id + size + b'\x00\x00' + payload
+
+
+def _id3_frames_for(key, value, version):
+    text_id = _id3_text_frame_for(key, version)
+    if key.lower() in ('comment', 'lyrics'):
+        encoding = _id3_encoding((value,), version)
+        payload = bytes((encoding,)) + b'eng' + _id3_encode('', encoding) + _id3_encode(value, encoding, False)
+        return _id3_frame(key.lower() == 'comment' and b'COMM' or b'USLT', payload, version)
+    if text_id is not None:
+        encoding = _id3_encoding((value,), version)
+        payload = bytes((encoding,)) + _id3_encode(value, encoding, False)
+        return _id3_frame(text_id, payload, version)
+    encoding = _id3_encoding((key, value), version)
+    payload = bytes((encoding,)) + _id3_encode(key, encoding) + _id3_encode(value, encoding, False)
+    return _id3_frame(b'TXXX', payload, version)
+
+
+def _id3_frame_matches(frame_id, payload, key, version):
+    k = key.lower()
+    if k == 'comment':
+        return frame_id == b'COMM'
+    if k == 'lyrics':
+        return frame_id == b'USLT'
+    text_id = _id3_text_frame_for(k, version)
+    if text_id is not None:
+        return frame_id == text_id
+    if frame_id == b'TXXX' and len(payload) > 0:
+        return _id3_decode_desc(payload[1:], payload[0]).lower() == k
+    return False
+
+
+def _read_id3v2(inp):
+    """
+    Returns (version, flags, tag size, list of (frame id, raw frame, payload))
+    for the tag at the start of the file.
+    """
+    header = inp.read(ID3_HEADER.size)
+    if len(header) < ID3_HEADER.size:
+        raise UnsupportedTagLayout('no ID3v2 tag')
+    magic, version, revision, flags, size = ID3_HEADER.unpack(header)
+    if magic != b'ID3':
+        raise UnsupportedTagLayout('no ID3v2 tag')
+    if version not in (3, 4):
+        raise UnsupportedTagLayout('ID3v2.{0} not supported'.format(version))
+    if flags & (ID3_FLAG_UNSYNC | ID3_FLAG_EXTENDED | ID3_FLAG_FOOTER):
+        raise UnsupportedTagLayout('ID3v2 flags {0:#x} not supported'.format(flags))
+    tag_size = _syncsafe_decode(size)
+    body = inp.read(tag_size)
+    if len(body) < tag_size:
+        raise UnsupportedTagLayout('truncated ID3v2 tag')
+    frames = []
+    pos = 0
+    while pos + 10 <= tag_size:
+        frame_id = body[pos:pos + 4]
+        if frame_id[0] == 0:
+            # Padding.
+            break
+        if not frame_id.isalnum():
+            raise UnsupportedTagLayout('bad ID3v2 frame id {0}'.format(repr(frame_id)))
+        if version == 4:
+            frame_size = _syncsafe_decode(body[pos + 4:pos + 8])
+        else:
+            frame_size = struct.unpack('>I', body[pos + 4:pos + 8])[0]
+        end = pos + 10 + frame_size
+        if end > tag_size:
+            raise UnsupportedTagLayout('ID3v2 frame overruns tag')
+        frames.append((frame_id, body[pos:end], body[pos + 10:end]))
+        pos = end
+    return version, flags, tag_size, frames
+
+
+def write_id3v2_tags(filename, new_tags):
+    """
+    Replaces the tags in the file's ID3v2 tag, if the existing tag has
+    enough room for them.
+    """
+    with open(filename, 'r+b') as f:
+        version, flags, tag_size, frames = _read_id3v2(f)
+        kept = []
+        for frame_id, raw, payload in frames:
+            replaced = False
+            for k in new_tags.keys():
+                if _id3_frame_matches(frame_id, payload, k, version):
+                    replaced = True
+                    break
+            if not replaced:
+                kept.append(raw)
+        for k, v in new_tags.items():
+            if v is not None and len(str(v)) > 0:
+                kept.append(_id3_frames_for(k, str(v), version))
+        body = b''.join(kept)
+        if len(body) > tag_size:
+            return False
+        f.seek(0)
+        f.write(ID3_HEADER.pack(b'ID3', version, 0, flags, _syncsafe_encode(tag_size)))
+        f.write(body)
+        f.write(b'\x00' * (tag_size - len(body)))
+    return True
+
+
+# ---------------------------------------------------------------------------
+# MP4
+
+# ffmpeg metadata key -> ilst item type, as written by the ffmpeg mov muxer.
+MP4_TEXT_ITEMS = {
+    'title': b'\xa9nam',
+    'artist': b'\xa9ART',
+    'album_artist': b'aART',
+    'composer': b'\xa9wrt',
+    'album': b'\xa9alb',
+    'date': b'\xa9day',
+    'year': b'\xa9day',
+    'encoder': b'\xa9too',
+    'comment': b'\xa9cmt',
+    'genre': b'\xa9gen',
+    'copyright': b'cprt',
+    'grouping': b'\xa9grp',
+    'lyrics': b'\xa9lyr',
+    'description': b'desc',
+    'synopsis': b'ldes',
+}
+MP4_PAIR_ITEMS = {
+    'track': b'trkn',
+    'disc': b'disk',
+}
+MP4_FREEFORM_MEAN = b'com.apple.iTunes'
+
+# Boxes larger than this aren't read into memory.
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+
+def _box(kind, payload):
+    return struct.pack('>I', len(payload) + 8) + kind + payload
+
+
+def _boxes(data, start, end):
+    """
+    Yields (kind, offset, header size, total size) for each box in the
+    data range.
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise UnsupportedTagLayout('bad box {0} at {1}'.format(repr(kind), pos))
+        yield kind, pos, header, size
+        pos += size
+
+
+def _top_level_boxes(f, file_size):
+    """Same as _boxes, but reads only the box headers from the file."""
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        head = f.read(16)
+        size, kind = struct.unpack('>I4s', head[0:8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', head[8:16])[0]
+            header = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header or pos + size > file_size:
+            raise UnsupportedTagLayout('bad box {0} at {1}'.format(repr(kind), pos))
+        yield kind, pos, header, size
+        pos += size
+
+
+def _data_box(type_code, payload):
+    return _box(b'data', struct.pack('>II', type_code, 0) + payload)
+
+
+def _mp4_item_for(key, value):
+    k = key.lower()
+    if k in MP4_TEXT_ITEMS:
+        return _box(MP4_TEXT_ITEMS[k], _data_box(1, value.encode('utf-8')))
+    if k in MP4_PAIR_ITEMS:
+        parts = value.split('/', 1)
+        try:
+            number = int(parts[0].strip() or 0)
+            total = len(parts) > 1 and int(parts[1].strip() or 0) or 0
+        except ValueError:
+            number = None
+        if number is not None and 0 <= number < 0x10000 and 0 <= total < 0x10000:
+            payload = struct.pack('>HHH', 0, number, total)
+            if k == 'track':
+                payload += b'\x00\x00'
+            return _box(MP4_PAIR_ITEMS[k], _data_box(0, payload))
+    return _box(b'----',
+        _box(b'mean', b'\x00\x00\x00\x00' + MP4_FREEFORM_MEAN) +
+        _box(b'name', b'\x00\x00\x00\x00' + key.encode('utf-8')) +
+        _data_box(1, value.encode('utf-8')))
+
+
+def _mp4_freeform_name(item, start, end):
+    for kind, pos, header, size in _boxes(item, start, end):
+        if kind == b'name':
+            return item[pos + header + 4:pos + size].decode('utf-8', 'replace')
+    return None
+
+
+def _mp4_item_matches(item_kind, item, start, end, key):
+    k = key.lower()
+    if k in MP4_TEXT_ITEMS and item_kind == MP4_TEXT_ITEMS[k]:
+        return True
+    if k in MP4_PAIR_ITEMS and item_kind == MP4_PAIR_ITEMS[k]:
+        return True
+    if item_kind == b'----':
+        name = _mp4_freeform_name(item, start, end)
+        return name is not None and name.lower() == k
+    return False
+
+
+def _new_ilst_payload(ilst, start, end, new_tags):
+    kept = []
+    if ilst is not None:
+        for kind, pos, header, size in _boxes(ilst, start, end):
+            replaced = False
+            for k in new_tags.keys():
+                if _mp4_item_matches(kind, ilst, pos + header, pos + size, k):
+                    replaced = True
+                    break
+            if not replaced:
+                kept.append(ilst[pos:pos + size])
+    for k, v in new_tags.items():
+        if v is not None and len(str(v)) > 0:
+            kept.append(_mp4_item_for(k, str(v)))
+    return b''.join(kept)
+
+
+def _itunes_hdlr():
+    return _box(b'hdlr', struct.pack('>II4s4sII', 0, 0, b'mdir', b'appl', 0, 0) + b'\x00')
+
+
+def _find_child(data, start, end, kind):
+    for k, pos, header, size in _boxes(data, start, end):
+        if k == kind:
+            return pos, header, size
+    return None
+
+
+def _rebuild_moov(moov, header, new_tags):
+    """
+    Returns the moov box bytes with the ilst replaced, creating the
+    udta / meta / ilst boxes if they don't exist.
+    """
+    udta = _find_child(moov, header, len(moov), b'udta')
+    if udta is None:
+        meta_payload = b'\x00\x00\x00\x00' + _itunes_hdlr() + _box(
+            b'ilst', _new_ilst_payload(None, 0, 0, new_tags))
+        return _box(b'moov', moov[header:] + _box(b'udta', _box(b'meta', meta_payload)))
+    u_pos, u_header, u_size = udta
+    meta = _find_child(moov, u_pos + u_header, u_pos + u_size, b'meta')
+    if meta is None:
+        meta_payload = b'\x00\x00\x00\x00' + _itunes_hdlr() + _box(
+            b'ilst', _new_ilst_payload(None, 0, 0, new_tags))
+        new_udta = _box(b'udta', moov[u_pos + u_header:u_pos + u_size] + _box(b'meta', meta_payload))
+    else:
+        m_pos, m_header, m_size = meta
+        # meta is a full box; the version and flags come before the children.
+        children_start = m_pos + m_header + 4
+        parts = [moov[m_pos + m_header:children_start]]
+        found_ilst = False
+        for kind, pos, c_header, size in _boxes(moov, children_start, m_pos + m_size):
+            if kind == b'ilst':
+                found_ilst = True
+                parts.append(_box(b'ilst', _new_ilst_payload(
+                    moov, pos + c_header, pos + size, new_tags)))
+            else:
+                parts.append(moov[pos:pos + size])
+        if not found_ilst:
+            parts.append(_box(b'ilst', _new_ilst_payload(None, 0, 0, new_tags)))
+        new_meta = _box(b'meta', b''.join(parts))
+        new_udta = _box(b'udta', moov[u_pos + u_header:m_pos] + new_meta + moov[m_pos + m_size:u_pos + u_size])
+    return _box(b'moov', moov[header:u_pos] + new_udta + moov[u_pos + u_size:])
+
+
+def _free_box(size):
+    return struct.pack('>I', size) + b'free' + b'\x00' * (size - 8)
+
+
+def _write_ilst_over_free(f, moov_offset, moov, header, new_tags):
+    """
+    Writes the new ilst over the existing ilst and the free box that
+    directly follows it inside the meta box, if there's enough room.
+    """
+    udta = _find_child(moov, header, len(moov), b'udta')
+    if udta is None:
+        return False
+    u_pos, u_header, u_size = udta
+    meta = _find_child(moov, u_pos + u_header, u_pos + u_size, b'meta')
+    if meta is None:
+        return False
+    m_pos, m_header, m_size = meta
+    children = list(_boxes(moov, m_pos + m_header + 4, m_pos + m_size))
+    for i in range(len(children)):
+        kind, pos, c_header, size = children[i]
+        if kind != b'ilst':
+            continue
+        room = size
+        if i + 1 < len(children) and children[i + 1][0] in (b'free', b'skip'):
+            room += children[i + 1][3]
+        new_ilst = _box(b'ilst', _new_ilst_payload(moov, pos + c_header, pos + size, new_tags))
+        left = room - len(new_ilst)
+        if left != 0 and left < 8:
+            return False
+        f.seek(moov_offset + pos)
+        f.write(new_ilst)
+        if left > 0:
+            f.write(_free_box(left))
+        return True
+    return False
+
+
+def write_mp4_tags(filename, new_tags):
+    """
+    Replaces the tags in the file's `moov/udta/meta/ilst` box, as long as
+    no audio data needs to move.
+    """
+    file_size = os.path.getsize(filename)
+    with open(filename, 'r+b') as f:
+        top = list(_top_level_boxes(f, file_size))
+        for i in range(len(top)):
+            kind, pos, header, size = top[i]
+            if kind != b'moov':
+                continue
+            if size > MAX_MOOV_SIZE:
+                return False
+            f.seek(pos)
+            moov = f.read(size)
+            # The in-place write needs the offsets of the box as it is in
+            # the file, so try it before any change to the header.
+            if _write_ilst_over_free(f, pos, moov, header, new_tags):
+                return True
+            if header != 8:
+                # Normalize a 64-bit size header into a 32-bit one; the
+                # box is written whole from here on.
+                moov = _box(b'moov', moov[header:])
+                header = 8
+
+            # Rewrite the whole moov box, if the space after it can absorb
+            # any change in size.
+            room = size
+            is_last = i + 1 == len(top)
+            if not is_last and top[i + 1][0] in (b'free', b'skip'):
+                room += top[i + 1][3]
+                is_last = i + 2 == len(top)
+            new_moov = _rebuild_moov(moov, header, new_tags)
+            left = room - len(new_moov)
+            if is_last:
+                # Nothing follows, so the moov box can grow or shrink.
+                f.seek(pos)
+                f.write(new_moov)
+                f.truncate(pos + len(new_moov))
+                return True
+            if left == 0 or left >= 8:
+                f.seek(pos)
+                f.write(new_moov)
+                if left > 0:
+                    f.write(_free_box(left))
+                return True
+            return False
+    return False
@@ -40,7 +40,28 @@ def normalize_audio(audio_file, dest_file, headroom=0.1):
     volume_levels = ffmpeg.find_volume_levels(audio_file)
     if volume_levels is None:
         raise Exception('Could not read volume levels for {0}'.format(audio_file))
-    
+    increase = volume_increase(volume_levels, headroom)
+    if increase is None:
+        return None
+
+    ffmpeg.convert(audio_file, dest_file,
+        bit_rate=probe.bit_rate,
+        channels=probe.channels,
+        sample_rate=probe.sample_rate,
+        codec=probe.codec,
+        tags=probe.get_tags(),
+        volume=volume_filter(increase))
+    return increase
+
+
+def volume_increase(volume_levels, headroom=0.1):
+    """
+    Returns the volume adjustment, in dB, that brings the peak level up to
+    `headroom` below 0, or None if the audio shouldn't be adjusted (see
+    `normalize_audio`).
+    """
+    if headroom < 0:
+        return None
     # Now estimate the right peak level.  Peak level is the
     # amount *below* 0, so these are negative numbers.
     max_peak = volume_levels.max
@@ -53,15 +74,30 @@ def normalize_audio(audio_file, dest_file, headroom=0.1):
     if -headroom < volume_levels.mean:
         # Just too loud!  Too much!
         return None
-    
+
     # Find the increase that will give us our headroom.
-    increase = abs(max_peak) - headroom
+    return abs(max_peak) - headroom
 
-    ffmpeg.convert(audio_file, dest_file,
-        bit_rate=probe.bit_rate,
-        channels=probe.channels,
-        sample_rate=probe.sample_rate,
-        codec=probe.codec,
-        tags=probe.get_tags(),
-        volume="{0:#.1f}dB".format(increase))
-    return increase
+
+def source_volume_increase(history, probe, headroom=0.1):
+    """
+    Like `volume_increase`, but for the source file, so that the adjustment
+    can be made while transcoding instead of with a second encode of the
+    transcoded file.  The levels are measured once and kept in the history,
+    so a different headroom doesn't need another analysis pass.
+    """
+    volume_levels = None
+    if history is not None:
+        volume_levels = history.get_volume_levels(probe)
+    if volume_levels is None:
+        volume_levels = probe.volume_levels()
+        if volume_levels is None:
+            raise Exception('Could not read volume levels for {0}'.format(probe.filename))
+        if history is not None:
+            history.set_volume_levels(probe, volume_levels)
+    return volume_increase(volume_levels, headroom)
+
+
+def volume_filter(increase):
+    """The ffmpeg volume filter value for the dB adjustment."""
+    return "{0:#.1f}dB".format(increase)
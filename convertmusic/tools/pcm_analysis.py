@@ -0,0 +1,197 @@
+"""
+Analyses decoded audio with NumPy.
+
+The audio is decoded once, as signed 16 bit PCM, and each block is handed
+to every analyzer in turn, so finding the levels, the silence and anything
+else costs one decode.  The decode is an ffmpeg pipe for sampled audio, or
+the libxmp renderer for modules (see MediaProbe.decode_pcm).
+
+NumPy is optional; `available()` tells whether the analysis can be used.
+"""
+
+import math
+from .ffmpeg_bin.ffmpeg import VolumeLevel
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+FULL_SCALE = 32768.0
+# The quietest level a 16 bit sample can have, in dB.
+MIN_DB = 20 * math.log10(1 / FULL_SCALE)
+# Histogram bins, by whole dB below full scale.
+HISTOGRAM_BINS = 91
+DEFAULT_SILENCE_DB = -60.0
+
+
+def available():
+    return numpy is not None
+
+
+class Analyzer(object):
+    """
+    Gets each block of audio in order; `update` is given an int16 array of
+    (frames, channels).  `result` returns a dict of the found values.
+    """
+    def start(self, sample_rate, channels):
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    def update(self, samples):
+        raise NotImplementedError()
+
+    def result(self):
+        raise NotImplementedError()
+
+
+class LevelAnalyzer(Analyzer):
+    """
+    Peak and RMS level, the level histogram and the clipped sample count.
+    The levels match what ffmpeg's volumedetect filter reports.
+    """
+    def start(self, sample_rate, channels):
+        Analyzer.start(self, sample_rate, channels)
+        self.peak = 0
+        self.square_sum = 0.0
+        self.count = 0
+        self.clipped = 0
+        self.histogram = numpy.zeros(HISTOGRAM_BINS, dtype=numpy.int64)
+        # Sample magnitude -> histogram bin.
+        levels = numpy.maximum(numpy.arange(32769), 1)
+        self.__bins = numpy.minimum(
+            numpy.floor(-20 * numpy.log10(levels / FULL_SCALE)),
+            HISTOGRAM_BINS - 1).astype(numpy.intp)
+
+    def update(self, samples):
+        if samples.size <= 0:
+            return
+        flat = samples.reshape(-1).astype(numpy.int32)
+        mag = numpy.abs(flat)
+        self.peak = max(self.peak, int(mag.max()))
+        self.square_sum += float(numpy.dot(flat, flat.astype(numpy.float64)))
+        self.count += flat.size
+        self.clipped += int(numpy.count_nonzero(mag >= 32767))
+        self.histogram += numpy.bincount(self.__bins[mag], minlength=HISTOGRAM_BINS)
+
+    def result(self):
+        if self.count <= 0:
+            return {'peak_db': MIN_DB, 'rms_db': MIN_DB, 'clipped_samples': 0, 'histogram': {}}
+        rms = self.square_sum / self.count / (FULL_SCALE * FULL_SCALE)
+        return {
+            'peak_db': 20 * math.log10(max(self.peak, 1) / FULL_SCALE),
+            'rms_db': rms > 0 and 10 * math.log10(rms) or MIN_DB,
+            'clipped_samples': self.clipped,
+            'histogram': dict(
+                (str(i), int(c)) for i, c in enumerate(self.histogram) if c > 0),
+        }
+
+
+class SilenceAnalyzer(Analyzer):
+    """
+    The duration, and the leading and trailing silence, in seconds.  Audio
+    quieter than `threshold_db` in every channel counts as silence.
+    """
+    def __init__(self, threshold_db=DEFAULT_SILENCE_DB):
+        Analyzer.__init__(self)
+        self.threshold = int(FULL_SCALE * 10 ** (threshold_db / 20))
+
+    def start(self, sample_rate, channels):
+        Analyzer.start(self, sample_rate, channels)
+        self.frames = 0
+        self.first = None
+        self.last = None
+
+    def update(self, samples):
+        loud = numpy.flatnonzero(
+            numpy.abs(samples.astype(numpy.int32)).max(axis=1) > self.threshold)
+        if loud.size > 0:
+            if self.first is None:
+                self.first = self.frames + int(loud[0])
+            self.last = self.frames + int(loud[-1])
+        self.frames += samples.shape[0]
+
+    def result(self):
+        rate = float(self.sample_rate)
+        if self.first is None:
+            return {
+                'duration': self.frames / rate,
+                'leading_silence': self.frames / rate,
+                'trailing_silence': 0.0,
+            }
+        return {
+            'duration': self.frames / rate,
+            'leading_silence': self.first / rate,
+            'trailing_silence': (self.frames - self.last - 1) / rate,
+        }
+
+
+class AudioAnalysis(object):
+    def __init__(self, values):
+        object.__init__(self)
+        self.duration = values.get('duration')
+        self.peak_db = values.get('peak_db')
+        self.rms_db = values.get('rms_db')
+        self.clipped_samples = values.get('clipped_samples')
+        self.leading_silence = values.get('leading_silence')
+        self.trailing_silence = values.get('trailing_silence')
+        self.histogram = values.get('histogram') or {}
+        # Set if a FingerprintAnalyzer was run.
+        self.fingerprint = values.get('fingerprint')
+
+    def volume_levels(self):
+        return VolumeLevel(self.rms_db, self.peak_db, self.histogram)
+
+    def as_dict(self):
+        return {
+            'duration': self.duration,
+            'peak_db': self.peak_db,
+            'rms_db': self.rms_db,
+            'clipped_samples': self.clipped_samples,
+            'leading_silence': self.leading_silence,
+            'trailing_silence': self.trailing_silence,
+            'histogram': self.histogram,
+        }
+
+
+def default_analyzers():
+    return [LevelAnalyzer(), SilenceAnalyzer()]
+
+
+def analyze_blocks(blocks, sample_rate, channels, analyzers):
+    """
+    Feeds the PCM blocks (bytes-like, native signed 16 bit) to each analyzer.
+    Blocks don't need to end on a frame boundary.
+    """
+    if numpy is None:
+        raise Exception('PCM analysis needs numpy')
+    for a in analyzers:
+        a.start(sample_rate, channels)
+    frame_bytes = 2 * channels
+    pending = b''
+    for block in blocks:
+        if len(pending) > 0:
+            block = pending + bytes(block)
+        usable = len(block) - len(block) % frame_bytes
+        samples = numpy.frombuffer(block, dtype=numpy.int16, count=usable // 2)
+        samples = samples.reshape(-1, channels)
+        for a in analyzers:
+            a.update(samples)
+        # The block may be a reused buffer, so keep a copy of the tail.
+        pending = bytes(block[usable:])
+
+
+def analyze_probe(probe, analyzers=None):
+    """
+    Decodes the probed file once and runs all the analyzers over it.
+    Returns the AudioAnalysis, built from the merged analyzer results.
+    """
+    if analyzers is None:
+        analyzers = default_analyzers()
+    sample_rate, channels, blocks = probe.decode_pcm()
+    analyze_blocks(blocks, sample_rate, channels, analyzers)
+    values = {}
+    for a in analyzers:
+        values.update(a.result())
+    return AudioAnalysis(values)
@@ -2,6 +2,8 @@
 Basic definition for a file probe, for inspecting the fields.
 """
 
+import functools
+
 
 class MediaProbe(object):
     def __init__(self, filename):
@@ -12,6 +14,13 @@ class MediaProbe(object):
         self.bit_rate = None
         self.channels = None
         self.codec = None
+        # The file format name(s), as reported by ffprobe.
+        self.container = None
+        # True if the file has streams other than the single audio stream
+        # (cover art doesn't count).
+        self.extra_streams = False
+        # Length of the audio in seconds, if the probe knows it.
+        self.duration = None
 
     @property
     def filename(self):
@@ -43,9 +52,50 @@ class MediaProbe(object):
     def get_tags(self):
         return dict(self.__tags)
 
-    def transcode(self, tofile, sample_rate=44100, bit_rate=0, channels=2, codec=None, verbose=False):
+    def transcode(self, tofile, sample_rate=44100, bit_rate=0, channels=2, codec=None, volume=None, verbose=False):
+        """
+        Encodes the audio into tofile.  `volume` is an ffmpeg volume filter
+        adjustment (such as "3.5dB") applied while encoding.
+        """
         raise NotImplementedError()
 
+    def volume_levels(self):
+        """
+        Measures the peak and mean volume of the audio.  Returns an ffmpeg
+        VolumeLevel, or None if the levels couldn't be found.
+        """
+        from .pcm_analysis import analyze_probe, LevelAnalyzer
+        return analyze_probe(self, [LevelAnalyzer()]).volume_levels()
+
+    def decode_pcm(self, sample_rate=None, channels=None, duration=None):
+        """
+        Decodes the audio into signed 16 bit PCM, in the native byte order.
+        Returns (sample rate, channels, iterable of blocks).  The decoder may
+        not honor the requested sample rate and channels; the returned ones
+        describe the blocks.
+        """
+        raise NotImplementedError()
+
+    def remux(self, tofile, verbose=False):
+        """
+        Copies the audio stream, without re-encoding it, into the container
+        matching the tofile extension.
+        """
+        raise NotImplementedError()
+
+    async def transcode_async(self, runner, tofile, sample_rate=44100, bit_rate=0, channels=2, codec=None,
+            volume=None, verbose=False):
+        """
+        `transcode` from an event loop, with any tools run by the
+        async_proc.AsyncToolRunner.  By default, runs `transcode` in the
+        loop's default executor.
+        """
+        await _in_executor(self.transcode, tofile, sample_rate=sample_rate, bit_rate=bit_rate,
+            channels=channels, codec=codec, volume=volume, verbose=verbose)
+
+    async def remux_async(self, runner, tofile, verbose=False):
+        await _in_executor(self.remux, tofile, verbose=verbose)
+
 
 class ProbeFactory(object):
     """
@@ -62,3 +112,17 @@ class ProbeFactory(object):
         Returns a MediaProbe for the filename.
         """
         raise NotImplementedError()
+
+    async def probe_async(self, runner, filename):
+        """
+        `probe` from an event loop, with any tools run by the
+        async_proc.AsyncToolRunner.  By default, runs `probe` in the loop's
+        default executor.
+        """
+        return await _in_executor(self.probe, filename)
+
+
+async def _in_executor(func, *args, **kwargs):
+    import asyncio
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,294 @@
+"""
+Times each stage of an import for every file, and sums up the run.
+
+The import makes a StageMetrics and enables it; the stages time themselves
+with `timed(stage)`, which does nothing while no metrics are enabled, so the
+tools can be timed from wherever the work happens.  The stages are also
+recorded in the current file trace, if there is one (see file_trace).  Some stages run inside
+others: `hash` (of the source) is part of `probe`, and `copy`, `remux` and
+`encode` are part of `transcode`.
+
+Each timing costs a couple of clock reads and an append, so the metrics
+are cheap enough to always keep.  The run summary has, for each stage, the
+count, total, p50/p95/p99 and maximum time, and for the run the files by
+outcome, the bytes read and written, and the throughput.  It can be
+written as JSON or as a Prometheus textfile (for node_exporter's textfile
+collector).
+
+    metrics = StageMetrics()
+    enable(metrics)
+    with timed('probe'):
+        ...
+    metrics.write('import.prom')
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import threading
+from array import array
+from . import file_trace
+
+
+QUANTILES = (0.5, 0.95, 0.99)
+PROMETHEUS_PREFIX = 'convertmusic_import'
+# Seconds between redraws of the progress line.
+PROGRESS_INTERVAL = 1.0
+
+_ACTIVE = None
+
+
+class StageMetrics(object):
+    def __init__(self):
+        object.__init__(self)
+        self.__lock = threading.Lock()
+        # stage -> array of seconds, one entry per timing.
+        self.__stages = {}
+        self.__files = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.started_at = time.time()
+        self.__start = time.perf_counter()
+
+    def add(self, stage, seconds):
+        with self.__lock:
+            times = self.__stages.get(stage)
+            if times is None:
+                times = self.__stages[stage] = array('d')
+            times.append(seconds)
+
+    def file_done(self, outcome, bytes_read=0, bytes_written=0):
+        """
+        Counts a finished file, by its outcome ('transcoded', 'duplicate',
+        'failed', ...).
+        """
+        with self.__lock:
+            self.__files[outcome] = self.__files.get(outcome, 0) + 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    @property
+    def files_done(self):
+        with self.__lock:
+            return sum(self.__files.values())
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.__start
+
+    def summary(self):
+        elapsed = self.elapsed
+        with self.__lock:
+            stages = dict((k, sorted(v)) for k, v in self.__stages.items())
+            files = dict(self.__files)
+            bytes_read = self.bytes_read
+            bytes_written = self.bytes_written
+        file_count = sum(files.values())
+        ret = {
+            'started_at': self.started_at,
+            'elapsed': elapsed,
+            'files': file_count,
+            'outcomes': files,
+            'bytes_read': bytes_read,
+            'bytes_written': bytes_written,
+            'files_per_second': elapsed > 0 and file_count / elapsed or 0.0,
+            'bytes_read_per_second': elapsed > 0 and bytes_read / elapsed or 0.0,
+            'bytes_written_per_second': elapsed > 0 and bytes_written / elapsed or 0.0,
+            'stages': {},
+        }
+        for stage, times in stages.items():
+            total = sum(times)
+            s = {
+                'count': len(times),
+                'total': total,
+                'max': times[-1],
+                'share': elapsed > 0 and total / elapsed or 0.0,
+            }
+            for q in QUANTILES:
+                s['p{0}'.format(int(q * 100))] = _quantile(times, q)
+            ret['stages'][stage] = s
+        return ret
+
+    def write(self, filename):
+        """
+        Writes the summary; a file name ending in .prom gets the Prometheus
+        textfile format, anything else JSON.  The file is replaced whole, so
+        a collector never reads half of it.
+        """
+        summary = self.summary()
+        if filename.endswith('.prom'):
+            text = prometheus_text(summary)
+        else:
+            text = json.dumps(summary, indent=2, sort_keys=True) + '\n'
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_file, filename)
+
+
+class _Timer(object):
+    __slots__ = ('metrics', 'trace', 'stage', 'start')
+
+    def __init__(self, metrics, trace, stage):
+        self.metrics = metrics
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        if self.metrics is not None:
+            self.metrics.add(self.stage, seconds)
+        if self.trace is not None:
+            self.trace.stage(self.stage, self.start, seconds)
+
+
+class _NoTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def enable(metrics):
+    """Makes `timed` record into the metrics (or stop, with None)."""
+    global _ACTIVE
+    _ACTIVE = metrics
+
+
+def active():
+    return _ACTIVE
+
+
+def timed(stage):
+    """
+    Context manager that times the stage into the enabled StageMetrics, and
+    the current file trace.
+    """
+    metrics = _ACTIVE
+    trace = file_trace.current()
+    if metrics is None and trace is None:
+        return _NO_TIMER
+    return _Timer(metrics, trace, stage)
+
+
+def timed_iter(stage, iterable):
+    """
+    Yields the items of the iterable, timing how long each one takes to
+    produce as the stage.
+    """
+    it = iter(iterable)
+    while True:
+        with timed(stage):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+class ProgressLine(object):
+    """
+    A one line progress report on stderr, redrawn in place at most once a
+    second: files done out of the total, the rate and the time left.
+    """
+    def __init__(self, metrics, total, stream=None):
+        object.__init__(self)
+        self.metrics = metrics
+        self.total = total
+        self.stream = stream or sys.stderr
+        self.__start = time.perf_counter()
+        self.__last = 0.0
+        self.__width = 0
+
+    def update(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.__last < PROGRESS_INTERVAL:
+            return
+        self.__last = now
+        done = self.metrics.files_done
+        rate = now > self.__start and done / (now - self.__start) or 0.0
+        if self.total > 0:
+            line = '{0}/{1} files ({2:.1f}%)'.format(done, self.total, 100.0 * done / self.total)
+        else:
+            line = '{0} files'.format(done)
+        line += ', {0:.2f} files/s, {1:.1f} MB written, elapsed {2}'.format(
+            rate, self.metrics.bytes_written / 1e6, _duration(self.metrics.elapsed))
+        if rate > 0 and self.total > done:
+            line += ', ETA {0}'.format(_duration((self.total - done) / rate))
+        self.__write(line)
+
+    def close(self):
+        self.update(force=True)
+        self.stream.write('\n')
+        self.stream.flush()
+
+    def __write(self, line):
+        pad = max(0, self.__width - len(line))
+        self.__width = len(line)
+        self.stream.write('\r' + line + ' ' * pad)
+        self.stream.flush()
+
+
+def prometheus_text(summary, prefix=PROMETHEUS_PREFIX):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append('# HELP {0}_{1} {2}'.format(prefix, name, help_text))
+        lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+        for suffix, labels, value in samples:
+            label_text = ''
+            if labels:
+                label_text = '{' + ','.join(
+                    '{0}="{1}"'.format(k, v) for k, v in labels) + '}'
+            lines.append('{0}_{1}{2}{3} {4}'.format(prefix, name, suffix, label_text, _prometheus_value(value)))
+
+    samples = []
+    for stage, s in sorted(summary['stages'].items()):
+        for q in QUANTILES:
+            samples.append(('', (('stage', stage), ('quantile', str(q))),
+                s['p{0}'.format(int(q * 100))]))
+        samples.append(('_sum', (('stage', stage),), s['total']))
+        samples.append(('_count', (('stage', stage),), s['count']))
+    metric('stage_seconds', 'summary', 'Time spent in each import stage, per file.', samples)
+    metric('files_total', 'counter', 'Files handled by the import, by outcome.',
+        [('', (('outcome', k),), v) for k, v in sorted(summary['outcomes'].items())])
+    metric('bytes_total', 'counter', 'Bytes of media read and written by the import.', [
+        ('', (('direction', 'read'),), summary['bytes_read']),
+        ('', (('direction', 'written'),), summary['bytes_written']),
+    ])
+    metric('run_seconds', 'gauge', 'Length of the import run.', [('', (), summary['elapsed'])])
+    metric('last_run_timestamp_seconds', 'gauge', 'When the import run started.',
+        [('', (), summary['started_at'])])
+    return '\n'.join(lines) + '\n'
+
+
+def _prometheus_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _quantile(sorted_values, q):
+    """Nearest rank quantile of the sorted values."""
+    if len(sorted_values) <= 0:
+        return 0.0
+    # The rank is ceil(q * n); the slack keeps products such as 0.07 * 100
+    # (7.000000000000001) from rounding up a rank.
+    rank = int(math.ceil(q * len(sorted_values) - 1e-9))
+    index = min(len(sorted_values) - 1, max(0, rank - 1))
+    return sorted_values[index]
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    return '{0}:{1:02d}:{2:02d}'.format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
@@ -0,0 +1,289 @@
+"""
+Local staging area for the output files.
+
+The transcodes write into a directory on fast local disk (or tmpfs), and a
+single writer thread moves the finished files to the output directory,
+usually a FAT USB stick, one after another in large sequential writes.
+Each target file is preallocated to its full size before it's written.
+
+The writes are grouped into buckets; at the end of each bucket the output
+file system is synced once, rather than once per file.  Only then are the
+files reported as flushed, so the caller records them (such as in
+TARGET_FILE) only once they're safely on the device.
+
+The flushed and failed callbacks run in the caller's thread, from `drain`
+(and `flush` and `close`), so they can use the database connection.
+
+    staging = StagingArea()
+    outfile = staging.stage_path(destfile)
+    ... write outfile ...
+    staging.submit(destfile, on_flushed=...)
+    staging.drain()
+    ...
+    staging.close()
+"""
+
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+try:
+    import ctypes
+    _LIBC = ctypes.CDLL(None, use_errno=True)
+    _syncfs = getattr(_LIBC, 'syncfs', None)
+except (ImportError, OSError):
+    _syncfs = None
+
+
+# Sync the output after this much has been written.
+DEFAULT_BUCKET_BYTES = 64 * 1024 * 1024
+# Also sync if nothing new arrives for this long, in seconds.
+IDLE_FLUSH_SECONDS = 2.0
+# Staged bytes allowed to wait for the writer before `submit` blocks.
+DEFAULT_MAX_PENDING_BYTES = 1024 * 1024 * 1024
+WRITE_BLOCK_SIZE = 4 * 1024 * 1024
+
+_STOP = object()
+_FLUSH = object()
+
+
+class StagingArea(object):
+    def __init__(self, stage_dir=None, bucket_bytes=DEFAULT_BUCKET_BYTES,
+            max_pending_bytes=DEFAULT_MAX_PENDING_BYTES):
+        """
+        stage_dir: local directory for the staged files; a new temporary
+            directory (removed on close) if not given.
+        """
+        object.__init__(self)
+        self.__remove_dir = stage_dir is None
+        if stage_dir is None:
+            stage_dir = tempfile.mkdtemp(prefix='convertmusic-stage-')
+        os.makedirs(stage_dir, exist_ok=True)
+        self.__stage_dir = stage_dir
+        self.bucket_bytes = bucket_bytes
+        self.max_pending_bytes = max_pending_bytes
+        self.__lock = threading.Condition()
+        self.__counter = 0
+        # destfile -> staged file
+        self.__staged = {}
+        self.__pending_bytes = 0
+        self.__pending_count = 0
+        # (staged, destfile, on_flushed, on_failed, error) finished by the
+        # writer.  The staged file is already removed if it was written.
+        self.__done = []
+        self.__queue = queue.Queue()
+        self.__stats = {'files': 0, 'bytes': 0, 'buckets': 0, 'failed': 0}
+        self.__writer = threading.Thread(target=self.__write_loop,
+            name='staging-writer', daemon=True)
+        self.__writer.start()
+
+    @property
+    def stage_dir(self):
+        return self.__stage_dir
+
+    def stage_path(self, destfile):
+        """
+        Returns the local file to write in place of destfile.
+        """
+        with self.__lock:
+            self.__counter += 1
+            staged = os.path.join(self.__stage_dir, '{0:08d}-{1}'.format(
+                self.__counter, os.path.basename(destfile)))
+            self.__staged[destfile] = staged
+        return staged
+
+    def discard(self, destfile):
+        """
+        Forgets the staged file for destfile, such as when writing it failed.
+        """
+        with self.__lock:
+            staged = self.__staged.pop(destfile, None)
+        if staged is not None and os.path.lexists(staged):
+            os.unlink(staged)
+
+    def submit(self, destfile, on_flushed=None, on_failed=None):
+        """
+        Queues the staged file to be moved to destfile.  `on_flushed()` is
+        called once it's synced to the output, or `on_failed(error)` if it
+        could not be written.  Blocks while too much is waiting to be
+        written.
+        """
+        with self.__lock:
+            staged = self.__staged.pop(destfile)
+            size = os.path.getsize(staged)
+            while (self.__pending_count > 0 and
+                    self.__pending_bytes + size > self.max_pending_bytes):
+                self.__lock.wait()
+            self.__pending_bytes += size
+            self.__pending_count += 1
+        self.__queue.put((staged, destfile, size, on_flushed, on_failed))
+
+    def drain(self):
+        """
+        Runs the callbacks for the files flushed (or failed) so far.
+        Returns the number of files handled.
+        """
+        with self.__lock:
+            done = self.__done
+            self.__done = []
+        for staged, destfile, on_flushed, on_failed, error in done:
+            if error is None:
+                if on_flushed is not None:
+                    on_flushed()
+                continue
+            try:
+                if on_failed is not None:
+                    on_failed(error)
+                else:
+                    print("*** ERROR: could not write {0}: {1}".format(destfile, error))
+            finally:
+                _remove(staged)
+        return len(done)
+
+    def flush(self):
+        """
+        Waits until everything submitted is on the output, then drains.
+        """
+        self.__queue.put(_FLUSH)
+        with self.__lock:
+            while self.__pending_count > 0:
+                self.__lock.wait()
+        self.drain()
+
+    def stats(self):
+        with self.__lock:
+            ret = dict(self.__stats)
+            ret['pending_files'] = self.__pending_count
+            ret['pending_bytes'] = self.__pending_bytes
+        return ret
+
+    def close(self):
+        self.flush()
+        self.__queue.put(_STOP)
+        self.__writer.join()
+        for destfile in list(self.__staged.keys()):
+            self.discard(destfile)
+        if self.__remove_dir:
+            shutil.rmtree(self.__stage_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __write_loop(self):
+        bucket = []
+        bucket_bytes = 0
+        while True:
+            try:
+                item = self.__queue.get(timeout=IDLE_FLUSH_SECONDS)
+            except queue.Empty:
+                item = _FLUSH
+            if item is _STOP or item is _FLUSH:
+                self.__end_bucket(bucket)
+                bucket = []
+                bucket_bytes = 0
+                if item is _STOP:
+                    return
+                continue
+            staged, destfile, size, on_flushed, on_failed = item
+            error = None
+            try:
+                _write_file(staged, destfile, size)
+            except Exception as e:
+                error = e
+            bucket.append((staged, destfile, size, on_flushed, on_failed, error))
+            bucket_bytes += size
+            if bucket_bytes >= self.bucket_bytes:
+                self.__end_bucket(bucket)
+                bucket = []
+                bucket_bytes = 0
+
+    def __end_bucket(self, bucket):
+        if len(bucket) <= 0:
+            return
+        sync_error = None
+        written = [b[1] for b in bucket if b[5] is None]
+        if len(written) > 0:
+            try:
+                sync_filesystem(os.path.dirname(written[0]))
+            except OSError as e:
+                sync_error = e
+        done = []
+        for staged, destfile, size, on_flushed, on_failed, error in bucket:
+            error = error or sync_error
+            if error is None:
+                _remove(staged)
+            done.append((staged, destfile, on_flushed, on_failed, error))
+        with self.__lock:
+            self.__done.extend(done)
+            for staged, destfile, size, on_flushed, on_failed, error in bucket:
+                self.__pending_bytes -= size
+                self.__pending_count -= 1
+            self.__stats['buckets'] += 1
+            for staged, destfile, on_flushed, on_failed, error in done:
+                if error is None:
+                    self.__stats['files'] += 1
+                else:
+                    self.__stats['failed'] += 1
+            self.__stats['bytes'] += sum(b[2] for b in bucket if b[5] is None)
+            self.__lock.notify_all()
+
+
+def _remove(staged):
+    try:
+        os.unlink(staged)
+    except OSError:
+        pass
+
+
+def _write_file(staged, destfile, size):
+    """
+    Writes the staged file to destfile, preallocated to its final size.
+    An existing destfile is removed first, as with `transcode.copy_file`.
+    """
+    if os.path.lexists(destfile):
+        os.unlink(destfile)
+    buff = bytearray(min(WRITE_BLOCK_SIZE, max(size, 1)))
+    view = memoryview(buff)
+    fd = os.open(destfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                # Not supported by the file system.
+                pass
+        with open(staged, 'rb', buffering=0) as inp:
+            while True:
+                count = inp.readinto(buff)
+                if not count:
+                    break
+                pos = 0
+                while pos < count:
+                    pos += os.write(fd, view[pos:count])
+    except:
+        os.close(fd)
+        os.unlink(destfile)
+        raise
+    os.close(fd)
+
+
+def sync_filesystem(path):
+    """
+    Syncs the file system holding path: syncfs where the C library has it,
+    otherwise a full sync.  This also covers the directory entries, which
+    matter on FAT.
+    """
+    if _syncfs is not None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if _syncfs(fd) == 0:
+                return
+        finally:
+            os.close(fd)
+    if hasattr(os, 'sync'):
+        os.sync()
@@ -2,39 +2,143 @@
 import subprocess
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from .native_tags import write_tags
+from .file_hash import hash_file
+from .ffmpeg_bin import proc as tool_proc
 
 BIN_FFMPEG = 'ffmpeg'
 
+# Padding to leave in the metadata header when ffmpeg rewrites the file, so
+# that later tag edits can be written in place.
+METADATA_HEADER_PADDING = 4096
+
+
 def set_tags_on_file(filename, new_tags):
     """
     Assigns the given tags to the file.  Any existing tags are ignored.
+
+    The tags are written in place if the file format and its existing tag
+    layout allow it; otherwise, the file is rewritten by ffmpeg.
+    """
+    if write_tags(filename, new_tags):
+        return
+    _ffmpeg_set_tags_on_file(filename, new_tags)
+
+
+def set_tags_and_hash(filename, new_tags):
+    """
+    `set_tags_on_file`, then returns the new (size, sha256) of the file, to
+    record for an output file (see MediaFileHistory.set_transcoded_digest).
+    """
+    set_tags_on_file(filename, new_tags)
+    return hash_file(filename)
+
+
+async def set_tags_on_file_async(runner, filename, new_tags):
     """
+    `set_tags_on_file` from an event loop.  An ffmpeg rewrite is run by the
+    async_proc.AsyncToolRunner.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, write_tags, filename, new_tags):
+        return
+    old_file = _find_nonexist(filename)
+    try:
+        os.rename(filename, old_file)
+        await runner.run(_ffmpeg_tags_cmd(old_file, filename, new_tags), capture_stdout=False)
+        os.unlink(old_file)
+    except BaseException:
+        _restore(old_file, filename)
+        raise
+
+
+def _ffmpeg_set_tags_on_file(filename, new_tags):
     old_file = _find_nonexist(filename)
     try:
         os.rename(filename, old_file)
-        cmd = [
-            BIN_FFMPEG, '-i', old_file,
-            '-vn', '-acodec', 'copy'
-        ]
-        for k, v in new_tags.items():
-            cmd.append('-metadata')
-            cmd.append('{0}={1}'.format(k, v))
-        cmd.append(filename)
+        cmd = _ffmpeg_tags_cmd(old_file, filename, new_tags)
 
         # force bits per sample = 16.
-        subprocess.run(cmd,
+        tool_proc.run(cmd,
             check=True,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE)
 
         os.unlink(old_file)
     except:
-        if os.path.isfile(old_file):
-            if os.path.isfile(filename):
-                os.unlink(filename)
-            os.rename(old_file, filename)
+        _restore(old_file, filename)
         raise
 
+
+def _ffmpeg_tags_cmd(old_file, filename, new_tags):
+    cmd = [
+        BIN_FFMPEG, '-i', old_file,
+        '-vn', '-acodec', 'copy',
+        '-metadata_header_padding', str(METADATA_HEADER_PADDING)
+    ]
+    for k, v in new_tags.items():
+        cmd.append('-metadata')
+        cmd.append('{0}={1}'.format(k, v is None and '' or v))
+    cmd.append(filename)
+    return cmd
+
+
+def _restore(old_file, filename):
+    if os.path.isfile(old_file):
+        if os.path.isfile(filename):
+            os.unlink(filename)
+        os.rename(old_file, filename)
+
+
+class TagWriterPool(object):
+    """
+    Writes tags on many files in parallel.  Use `submit` for each file, then
+    `wait` to find out which ones failed.  The new digests of the files
+    submitted with `rehash` are in `digests` after the wait.
+    """
+    def __init__(self, workers=4):
+        object.__init__(self)
+        self.__executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.__pending = []
+        # filename -> (size, sha256) of each rehashed file written.
+        self.digests = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, filename, new_tags, rehash=False):
+        """
+        rehash: hash the file once it's written, such as for an output file
+            whose digest is recorded.
+        """
+        writer = rehash and set_tags_and_hash or set_tags_on_file
+        self.__pending.append((filename, self.__executor.submit(
+            writer, filename, dict(new_tags))))
+
+    def wait(self):
+        """
+        Waits for all the submitted files to be written.  Returns a list of
+        (filename, exception) for each file that could not be written.
+        """
+        failed = []
+        for filename, future in self.__pending:
+            e = future.exception()
+            if e is not None:
+                failed.append((filename, e))
+            elif future.result() is not None:
+                self.digests[filename] = future.result()
+        self.__pending = []
+        return failed
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+
+
 def _find_nonexist(filename):
     index = 0
     fn = filename
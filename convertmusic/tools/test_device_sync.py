@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+"""
+Tests for mirroring the output directory onto a device.
+
+Run with:
+
+    python3 -m pytest convertmusic/tools/test_device_sync.py
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from convertmusic.tools import device_sync
+from convertmusic.tools.device_sync import MANIFEST_NAME, SyncPlan
+from convertmusic.tools.file_hash import hash_file
+
+
+class SyncPlanTest(unittest.TestCase):
+    def test_copies_and_deletes(self):
+        master = {
+            'a/same.mp3': [10, 'aaa'],
+            'a/changed.mp3': [10, 'bbb'],
+            'a/resized.mp3': [12, 'ccc'],
+            'b/new.mp3': [20, 'ddd'],
+            'b/unknown.mp3': [30, 'eee'],
+        }
+        device = {
+            'a/same.mp3': {'size': 10, 'sha256': 'aaa'},
+            'a/changed.mp3': {'size': 10, 'sha256': 'old'},
+            'a/resized.mp3': {'size': 10, 'sha256': 'ccc'},
+            'a/gone.mp3': {'size': 5, 'sha256': 'fff'},
+        }
+        plan = SyncPlan(master, device, ['b/unknown.mp3', 'c/stray.txt'])
+        self.assertEqual(1, plan.unchanged)
+        self.assertEqual(['a/changed.mp3', 'a/resized.mp3', 'b/new.mp3', 'b/unknown.mp3'], plan.copies)
+        self.assertEqual(['a/gone.mp3', 'c/stray.txt'], plan.deletes)
+        self.assertEqual(10 + 12 + 20 + 30, plan.copy_bytes)
+
+
+class DeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.dir, 'output')
+        self.device = os.path.join(self.dir, 'device')
+        os.mkdir(self.output)
+        os.mkdir(self.device)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, base, name, data):
+        filename = os.path.join(base, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def _master(self, files):
+        master = {}
+        for name, data in files.items():
+            master[name] = list(hash_file(self._write(self.output, name, data)))
+        return master
+
+    def test_scan_device(self):
+        kept = self._write(self.device, '000001/kept.mp3', b'kept')
+        touched = self._write(self.device, '000001/touched.mp3', b'touched')
+        self._write(self.device, '000002/stray.mp3', b'stray')
+        manifest = {}
+        for fn in (kept, touched):
+            st = os.stat(fn)
+            manifest[device_sync.relative_name(self.device, fn)] = {
+                'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': 'x'}
+        st = os.stat(touched)
+        os.utime(touched, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        device_sync.write_device_manifest(self.device, manifest)
+
+        trusted, unknown = device_sync.scan_device(self.device, device_sync.read_device_manifest(self.device))
+        self.assertEqual(['000001/kept.mp3'], sorted(trusted.keys()))
+        self.assertEqual(['000001/touched.mp3', '000002/stray.mp3'], sorted(unknown))
+
+    def test_sync_then_resync(self):
+        master = self._master({'000001/a.mp3': b'a' * 100, '000001/b.mp3': b'b' * 200})
+        self._write(self.device, '000009/stray.mp3', b'stray')
+        files = device_sync.device_manifest_for_sync(self.device, force=True)
+        trusted, unknown = device_sync.scan_device(self.device, files)
+        plan = SyncPlan(master, trusted, unknown)
+        self.assertEqual([], device_sync.sync_device(self.output, master, self.device, plan, jobs=2))
+        self.assertFalse(os.path.exists(os.path.join(self.device, '000009')))
+        with open(os.path.join(self.device, '000001', 'b.mp3'), 'rb') as f:
+            self.assertEqual(b'b' * 200, f.read())
+
+        trusted, unknown = device_sync.scan_device(self.device, device_sync.read_device_manifest(self.device))
+        plan = SyncPlan(master, trusted, unknown)
+        self.assertEqual(2, plan.unchanged)
+        self.assertEqual([], plan.copies)
+        self.assertEqual([], plan.deletes)
+
+    def test_manifest_after_partial_failure(self):
+        master = self._master({'000001/a.mp3': b'a' * 100, '000001/b.mp3': b'b' * 200})
+        # The output file went away after it was hashed.
+        os.unlink(os.path.join(self.output, '000001', 'b.mp3'))
+        plan = SyncPlan(master, {}, [])
+        failed = device_sync.sync_device(self.output, master, self.device, plan)
+        self.assertEqual(['000001/b.mp3'], [f[0] for f in failed])
+        with open(os.path.join(self.device, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            files = json.load(f)['files']
+        self.assertEqual(['000001/a.mp3'], list(files.keys()))
+        self.assertEqual(master['000001/a.mp3'][1], files['000001/a.mp3']['sha256'])
+        self.assertFalse(os.path.exists(os.path.join(self.device, '000001', 'b.mp3.part')))
+
+        # The next sync only copies the failed file.
+        self._write(self.output, '000001/b.mp3', b'b' * 200)
+        trusted, unknown = device_sync.scan_device(self.device, device_sync.read_device_manifest(self.device))
+        self.assertEqual(['000001/b.mp3'], SyncPlan(master, trusted, unknown).copies)
+
+    def test_refuses_unmanaged_device(self):
+        self.assertEqual({}, device_sync.device_manifest_for_sync(self.device))
+        self._write(self.device, 'music/mine.mp3', b'mine')
+        self.assertIsNone(device_sync.device_manifest_for_sync(self.device))
+        self.assertEqual({}, device_sync.device_manifest_for_sync(self.device, force=True))
+        device_sync.write_device_manifest(self.device, {})
+        self.assertEqual({}, device_sync.device_manifest_for_sync(self.device))
+
+
+if __name__ == '__main__':
+    unittest.main()
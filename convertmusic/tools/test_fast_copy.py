@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+"""
+Tests for copying files with the cheapest method available.
+
+Run with:
+
+    python3 -m pytest convertmusic/tools/test_fast_copy.py
+"""
+
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from convertmusic.tools import fast_copy
+from convertmusic.tools.fast_copy import CopyStats, copy_file_fast, reflink_file
+from convertmusic.tools.file_hash import hash_file
+
+
+DATA = bytes(range(256)) * 4096
+
+
+def _unsupported(src_fd, dst_fd, size):
+    # Leaves some junk behind, as a method failing part way might.
+    os.write(dst_fd, b'junk')
+    return False
+
+
+def _failing_ioctl(error):
+    def ioctl(fd, request, arg):
+        raise OSError(error, os.strerror(error))
+    return ioctl
+
+
+class FastCopyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src.mp3')
+        self.target = os.path.join(self.dir, 'target.mp3')
+        with open(self.src, 'wb') as f:
+            f.write(DATA)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_copy(self):
+        with open(self.target, 'wb') as f:
+            f.write(b'an older and much longer file' * 100000)
+        result = copy_file_fast(self.src, self.target)
+        self.assertEqual(DATA, self._read(self.target))
+        self.assertEqual(hash_file(self.src), result.digest)
+        self.assertIn(result.method, (fast_copy.METHOD_REFLINK, fast_copy.METHOD_COPY_FILE_RANGE,
+            fast_copy.METHOD_SENDFILE, fast_copy.METHOD_COPY))
+
+    def test_plain_copy_fallback(self):
+        methods = [('first', _unsupported), ('second', _unsupported)]
+        with mock.patch.object(fast_copy, '_FAST_METHODS', methods):
+            result = copy_file_fast(self.src, self.target)
+        self.assertEqual(fast_copy.METHOD_COPY, result.method)
+        self.assertEqual(DATA, self._read(self.target))
+        self.assertEqual(hash_file(self.src), result.digest)
+
+    def test_empty_file(self):
+        with open(self.src, 'wb'):
+            pass
+        result = copy_file_fast(self.src, self.target)
+        self.assertEqual(b'', self._read(self.target))
+        self.assertEqual(0, result.size)
+
+    def test_stats(self):
+        stats = CopyStats()
+        stats.add(fast_copy.CopyResult('copy', 100, None, 0.5))
+        stats.add(fast_copy.CopyResult('copy', 300, None, 1.5))
+        stats.add(fast_copy.CopyResult('reflink', 100, None, 0.0))
+        self.assertEqual({
+            'copy': {'files': 2, 'bytes': 400, 'seconds': 2.0, 'bytes_per_second': 200},
+            'reflink': {'files': 1, 'bytes': 100, 'seconds': 0.0, 'bytes_per_second': None},
+        }, stats.stats())
+        stats.reset()
+        self.assertEqual({}, stats.stats())
+
+    def test_reflink_unsupported(self):
+        with mock.patch.object(fast_copy.fcntl, 'ioctl', _failing_ioctl(errno.EOPNOTSUPP)):
+            self.assertFalse(reflink_file(self.src, self.target))
+        self.assertFalse(os.path.exists(self.target))
+
+    def test_reflink_error(self):
+        with mock.patch.object(fast_copy.fcntl, 'ioctl', _failing_ioctl(errno.EIO)):
+            self.assertRaises(OSError, reflink_file, self.src, self.target)
+        self.assertFalse(os.path.exists(self.target))
+
+    def test_reflink(self):
+        with mock.patch.object(fast_copy.fcntl, 'ioctl', lambda fd, request, arg: 0):
+            self.assertTrue(reflink_file(self.src, self.target))
+        self.assertTrue(os.path.exists(self.target))
+
+
+if __name__ == '__main__':
+    unittest.main()
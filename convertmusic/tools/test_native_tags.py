@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+"""
+Tests for writing the MP4 tags in place.
+
+Run with:
+
+    python3 -m pytest convertmusic/tools/test_native_tags.py
+"""
+
+import os
+import struct
+import tempfile
+import unittest
+from convertmusic.tools import native_tags
+from convertmusic.tools.native_tags import (_box, _boxes, _free_box, write_mp4_tags)
+
+
+AUDIO = bytes(range(256)) * 16
+
+
+def _box64(kind, payload):
+    return struct.pack('>I4sQ', 1, kind, len(payload) + 16) + payload
+
+
+def _meta(ilst_payload, free_size):
+    payload = b'\x00\x00\x00\x00' + native_tags._itunes_hdlr() + _box(b'ilst', ilst_payload)
+    if free_size > 0:
+        payload += _free_box(free_size)
+    return _box(b'meta', payload)
+
+
+def _title_item(title):
+    return native_tags._mp4_item_for('title', title)
+
+
+def _mp4(moov_last, free_size):
+    ftyp = _box(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42isom')
+    moov = _box64(b'moov', _box(b'mvhd', b'\x00' * 100) +
+        _box(b'udta', _meta(_title_item('old title'), free_size)))
+    mdat = _box(b'mdat', AUDIO)
+    if moov_last:
+        return ftyp + mdat + moov
+    return ftyp + moov + mdat
+
+
+def _parse(data):
+    """Returns {kind: (offset, header, size)} of the top level boxes, and
+    checks that every box down to the ilst items parses."""
+    top = {}
+    for kind, pos, header, size in _boxes(data, 0, len(data)):
+        top[kind] = (pos, header, size)
+    pos, header, size = top[b'moov']
+    moov = data[pos:pos + size]
+    udta = native_tags._find_child(moov, header, len(moov), b'udta')
+    meta = native_tags._find_child(moov, udta[0] + udta[1], udta[0] + udta[2], b'meta')
+    ilst = native_tags._find_child(moov, meta[0] + meta[1] + 4, meta[0] + meta[2], b'ilst')
+    items = {}
+    for kind, i_pos, i_header, i_size in _boxes(moov, ilst[0] + ilst[1], ilst[0] + ilst[2]):
+        data_box = native_tags._find_child(moov, i_pos + i_header, i_pos + i_size, b'data')
+        items[kind] = moov[data_box[0] + data_box[1] + 8:data_box[0] + data_box[2]].decode('utf-8')
+    return top, items
+
+
+class WriteMp4TagsTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.m4a')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def _write_and_check(self, data, title):
+        with open(self.filename, 'wb') as f:
+            f.write(data)
+        self.assertTrue(write_mp4_tags(self.filename, {'title': title, 'artist': 'an artist'}))
+        with open(self.filename, 'rb') as f:
+            written = f.read()
+        top, items = _parse(written)
+        self.assertEqual(title, items[b'\xa9nam'])
+        self.assertEqual('an artist', items[b'\xa9ART'])
+        pos, header, size = top[b'mdat']
+        self.assertEqual(AUDIO, written[pos + header:pos + size])
+        return written
+
+    def test_64bit_moov_ilst_over_free(self):
+        data = _mp4(False, 200)
+        written = self._write_and_check(data, 'new title')
+        # Written in place: nothing moved, and the moov kept its header.
+        self.assertEqual(len(data), len(written))
+        top, items = _parse(written)
+        self.assertEqual(16, top[b'moov'][1])
+        self.assertEqual(data[0:top[b'moov'][0] + 16], written[0:top[b'moov'][0] + 16])
+
+    def test_64bit_moov_rebuilt_at_end(self):
+        self._write_and_check(_mp4(True, 0), 'a much longer title than the old one had')
+
+    def test_64bit_moov_without_room(self):
+        data = _mp4(False, 0)
+        with open(self.filename, 'wb') as f:
+            f.write(data)
+        self.assertFalse(write_mp4_tags(self.filename, {'title': 'a much longer title than before'}))
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
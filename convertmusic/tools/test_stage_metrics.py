@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""
+Tests for the import stage timings and their summary.
+
+Run with:
+
+    python3 -m pytest convertmusic/tools/test_stage_metrics.py
+"""
+
+import unittest
+from convertmusic.tools import stage_metrics
+from convertmusic.tools.stage_metrics import StageMetrics, _quantile, prometheus_text
+
+
+class QuantileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, _quantile(values, 0.5))
+        self.assertEqual(95, _quantile(values, 0.95))
+        self.assertEqual(99, _quantile(values, 0.99))
+        self.assertEqual(7, _quantile(values, 0.07))
+        self.assertEqual(100, _quantile(values, 1.0))
+        self.assertEqual(1, _quantile(values, 0.0))
+
+    def test_rounds_rank_up(self):
+        values = list(range(1, 13))
+        # 0.95 * 12 = 11.4, so the 12th value.
+        self.assertEqual(12, _quantile(values, 0.95))
+        self.assertEqual(6, _quantile(values, 0.5))
+        self.assertEqual(2, _quantile([1, 2, 3], 0.5))
+
+    def test_few_values(self):
+        self.assertEqual(0.0, _quantile([], 0.5))
+        self.assertEqual(3.0, _quantile([3.0], 0.99))
+
+
+class StageMetricsTest(unittest.TestCase):
+    def tearDown(self):
+        stage_metrics.enable(None)
+
+    def test_summary(self):
+        metrics = StageMetrics()
+        for i in range(1, 21):
+            metrics.add('probe', i / 10.0)
+        metrics.add('encode', 2.0)
+        metrics.file_done('transcoded', 100, 50)
+        metrics.file_done('transcoded', 100, 50)
+        metrics.file_done('duplicate', 10)
+        summary = metrics.summary()
+        self.assertEqual(3, summary['files'])
+        self.assertEqual({'transcoded': 2, 'duplicate': 1}, summary['outcomes'])
+        self.assertEqual((210, 100), (summary['bytes_read'], summary['bytes_written']))
+        probe = summary['stages']['probe']
+        self.assertEqual(20, probe['count'])
+        self.assertAlmostEqual(21.0, probe['total'])
+        self.assertEqual((1.0, 1.9, 2.0, 2.0), (probe['p50'], probe['p95'], probe['p99'], probe['max']))
+        self.assertEqual(1, summary['stages']['encode']['count'])
+
+    def test_timed(self):
+        with stage_metrics.timed('probe'):
+            pass
+        metrics = StageMetrics()
+        stage_metrics.enable(metrics)
+        with stage_metrics.timed('probe'):
+            pass
+        self.assertEqual([1, 2, 3], list(stage_metrics.timed_iter('hash', [1, 2, 3])))
+        stages = metrics.summary()['stages']
+        self.assertEqual(1, stages['probe']['count'])
+        # One timing for each item, and one for the end.
+        self.assertEqual(4, stages['hash']['count'])
+
+    def test_prometheus_text(self):
+        metrics = StageMetrics()
+        metrics.add('probe', 0.5)
+        metrics.file_done('transcoded', 100, 50)
+        text = prometheus_text(metrics.summary())
+        self.assertIn('convertmusic_import_stage_seconds{stage="probe",quantile="0.95"} 0.5\n', text)
+        self.assertIn('convertmusic_import_stage_seconds_count{stage="probe"} 1\n', text)
+        self.assertIn('convertmusic_import_files_total{outcome="transcoded"} 1\n', text)
+        self.assertIn('convertmusic_import_bytes_total{direction="written"} 50\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
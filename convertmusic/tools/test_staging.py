@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""
+Tests for the local staging area of the output files.
+
+Run with:
+
+    python3 -m pytest convertmusic/tools/test_staging.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from convertmusic.tools.staging import StagingArea
+
+
+class StagingAreaTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.dir, 'output')
+        os.mkdir(self.output)
+        self.staging = StagingArea(os.path.join(self.dir, 'stage'), bucket_bytes=1000)
+        self.flushed = []
+        self.failed = []
+
+    def tearDown(self):
+        self.staging.close()
+        shutil.rmtree(self.dir)
+
+    def _stage(self, name, data):
+        destfile = os.path.join(self.output, name)
+        staged = self.staging.stage_path(destfile)
+        with open(staged, 'wb') as f:
+            f.write(data)
+        self.staging.submit(destfile,
+            on_flushed=lambda: self.flushed.append(destfile),
+            on_failed=lambda e: self.failed.append((destfile, e)))
+        return destfile, staged
+
+    def test_flushed(self):
+        a, a_staged = self._stage('a.mp3', b'a' * 600)
+        b, b_staged = self._stage('b.mp3', b'b' * 600)
+        self.staging.flush()
+        self.assertEqual([a, b], self.flushed)
+        self.assertEqual([], self.failed)
+        with open(b, 'rb') as f:
+            self.assertEqual(b'b' * 600, f.read())
+        self.assertFalse(os.path.exists(a_staged))
+        self.assertFalse(os.path.exists(b_staged))
+        stats = self.staging.stats()
+        self.assertEqual(2, stats['files'])
+        self.assertEqual(1200, stats['bytes'])
+        self.assertEqual(0, stats['pending_files'])
+
+    def test_replaces_existing(self):
+        destfile = os.path.join(self.output, 'a.mp3')
+        with open(destfile, 'wb') as f:
+            f.write(b'old and longer')
+        self._stage('a.mp3', b'new')
+        self.staging.flush()
+        with open(destfile, 'rb') as f:
+            self.assertEqual(b'new', f.read())
+
+    def test_failed(self):
+        ok, ok_staged = self._stage('ok.mp3', b'ok')
+        bad, bad_staged = self._stage(os.path.join('no such dir', 'bad.mp3'), b'bad')
+        self.staging.flush()
+        self.assertEqual([ok], self.flushed)
+        self.assertEqual([bad], [f[0] for f in self.failed])
+        self.assertFalse(os.path.exists(bad_staged))
+        self.assertEqual(1, self.staging.stats()['failed'])
+
+    def test_discard(self):
+        destfile = os.path.join(self.output, 'a.mp3')
+        staged = self.staging.stage_path(destfile)
+        with open(staged, 'wb') as f:
+            f.write(b'partial')
+        self.staging.discard(destfile)
+        self.assertFalse(os.path.exists(staged))
+        self.staging.flush()
+        self.assertFalse(os.path.exists(destfile))
+
+    def test_temporary_dir_removed(self):
+        with StagingArea() as staging:
+            stage_dir = staging.stage_dir
+            self.assertTrue(os.path.isdir(stage_dir))
+        self.assertFalse(os.path.exists(stage_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
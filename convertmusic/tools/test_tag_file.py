@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+"""
+Tests that retagging an output file keeps its recorded hash current.
+
+Run with:
+
+    python3 -m pytest convertmusic/tools/test_tag_file.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from convertmusic.db import get_history
+from convertmusic.tools.probe import MediaProbe
+from convertmusic.tools import file_hash
+from convertmusic.tools.file_hash import hash_file
+from convertmusic.tools.native_tags import ID3_HEADER, _syncsafe_encode
+from convertmusic.tools.tag_file import TagWriterPool, set_tags_and_hash
+
+
+# An ID3v2.3 tag with room for the new tags, then some "audio".
+TAG_SIZE = 1024
+AUDIO = b'\xff\xfb\x90\x00' + bytes(range(256)) * 8
+
+
+def _write_mp3(filename):
+    with open(filename, 'wb') as f:
+        f.write(ID3_HEADER.pack(b'ID3', 3, 0, 0, _syncsafe_encode(TAG_SIZE)))
+        f.write(b'\x00' * TAG_SIZE)
+        f.write(AUDIO)
+
+
+class RetagThenVerifyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.history = get_history(os.path.join(self.dir, 'media.db'))
+        self.target = os.path.join(self.dir, 'target.mp3')
+        _write_mp3(self.target)
+        probe = MediaProbe(os.path.join(self.dir, 'source.mp3'))
+        probe.set_tag('title', 'a title')
+        self.history.mark_found(probe)
+        self.history.transcoded_to(probe, self.target, hash_file(self.target))
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.dir)
+
+    def _verify(self):
+        records = self.history.get_transcoded_file_hashes()
+        return [r[1] for r in file_hash.verify_files(records, 1)]
+
+    def test_recorded(self):
+        self.assertEqual([file_hash.OK], self._verify())
+
+    def test_retag_without_recording(self):
+        set_tags_and_hash(self.target, {'title': 'another title'})
+        self.assertNotEqual([file_hash.OK], self._verify())
+
+    def test_retag_then_verify(self):
+        digest = set_tags_and_hash(self.target, {'title': 'another title'})
+        self.history.set_transcoded_digest(self.target, digest)
+        self.assertEqual([file_hash.OK], self._verify())
+
+    def test_pool_retag_then_verify(self):
+        with TagWriterPool() as writers:
+            writers.submit(self.target, {'title': 'another title', 'genre': 'Rock'}, rehash=True)
+            self.assertEqual([], writers.wait())
+        self.history.set_transcoded_digest(self.target, writers.digests[self.target])
+        self.assertEqual([file_hash.OK], self._verify())
+        with open(self.target, 'rb') as f:
+            self.assertEqual(AUDIO, f.read()[-len(AUDIO):])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""
+Tests for the cache of transcoded files.
+
+Run with:
+
+    python3 -m pytest convertmusic/tools/test_transcode_cache.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from convertmusic.tools import transcode_cache
+from convertmusic.tools.probe import MediaProbe
+from convertmusic.tools.transcode_cache import (
+    TranscodeCache, LINK_COPY, LINK_HARDLINK, LINK_REFLINK
+)
+
+
+class TranscodeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        patcher = mock.patch.object(transcode_cache, 'get_ffmpeg_version', lambda: 'ffmpeg test')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _file(self, name, data):
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def _read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def _probe(self, sha256='aa', title='a title'):
+        probe = MediaProbe(os.path.join(self.dir, 'source.flac'))
+        probe.set_tag('sha256', sha256)
+        probe.set_tag('title', title)
+        return probe
+
+    def test_key(self):
+        cache = TranscodeCache(self.cache_dir)
+        params = {'codec': 'mp3', 'bit_rate': '320k'}
+        key = cache.key(self._probe(), '.mp3', params)
+        self.assertEqual(key, cache.key(self._probe(), 'MP3', dict(params, unrelated=1)))
+        self.assertNotEqual(key, cache.key(self._probe(sha256='bb'), '.mp3', params))
+        self.assertNotEqual(key, cache.key(self._probe(title='other'), '.mp3', params))
+        self.assertNotEqual(key, cache.key(self._probe(), '.mp3', dict(params, bit_rate='256k')))
+        self.assertNotEqual(key, cache.key(self._probe(), '.m4a', params))
+        self.assertIsNone(cache.key(MediaProbe('no-hash.flac'), '.mp3', params))
+
+    def test_store_and_fetch(self):
+        for link_mode in (LINK_REFLINK, LINK_HARDLINK, LINK_COPY):
+            cache = TranscodeCache(os.path.join(self.cache_dir, link_mode), link_mode=link_mode)
+            target = os.path.join(self.dir, link_mode + '.mp3')
+            self.assertFalse(cache.fetch('ab' * 32, target))
+            cache.store('ab' * 32, self._file('out.mp3', b'transcoded'))
+            self._file(link_mode + '.mp3', b'an older file')
+            self.assertTrue(cache.fetch('ab' * 32, target))
+            self.assertEqual(b'transcoded', self._read(target))
+            stats = cache.stats()
+            self.assertEqual((1, 1, 1, 1), (stats['entries'], stats['hits'], stats['misses'], stats['stores']))
+
+    def test_reload(self):
+        cache = TranscodeCache(self.cache_dir)
+        cache.store('ab' * 32, self._file('out.mp3', b'transcoded'))
+        self._file(os.path.join('cache', 'ab', 'left.mp3.1.tmp'), b'partial')
+        cache = TranscodeCache(self.cache_dir)
+        self.assertEqual(1, cache.stats()['entries'])
+        self.assertEqual(len(b'transcoded'), cache.stats()['total_bytes'])
+        self.assertTrue(cache.fetch('ab' * 32, os.path.join(self.dir, 'target.mp3')))
+
+    def test_evicts_least_recently_used(self):
+        cache = TranscodeCache(self.cache_dir)
+        for i, key in enumerate(('aa' * 32, 'bb' * 32, 'cc' * 32)):
+            cache.store(key, self._file('out.mp3', bytes([i]) * 100))
+            # Used in the order stored, well apart.
+            os.utime(os.path.join(self.cache_dir, key[0:2], key + '.mp3'), (1000 + i, 1000 + i))
+        cache = TranscodeCache(self.cache_dir, max_bytes=250)
+        self.assertEqual((1, 100), cache.prune())
+        target = os.path.join(self.dir, 'target.mp3')
+        self.assertFalse(cache.fetch('aa' * 32, target))
+        # Now bb was used last.
+        self.assertTrue(cache.fetch('bb' * 32, target))
+        self.assertEqual((1, 100), cache.prune(100))
+        self.assertFalse(cache.fetch('cc' * 32, target))
+        self.assertTrue(cache.fetch('bb' * 32, target))
+
+    def test_entry_removed_before_fetch(self):
+        cache = TranscodeCache(self.cache_dir, link_mode=LINK_COPY)
+        cache.store('ab' * 32, self._file('out.mp3', b'transcoded'))
+        os.unlink(os.path.join(self.cache_dir, 'ab', 'ab' * 32 + '.mp3'))
+        target = os.path.join(self.dir, 'target.mp3')
+        self.assertFalse(cache.fetch('ab' * 32, target))
+        stats = cache.stats()
+        self.assertEqual((0, 0, 0, 1), (stats['entries'], stats['total_bytes'], stats['hits'], stats['misses']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,81 +1,182 @@
 import os
-import shutil
 from .probe import MediaProbe
+from .file_hash import hash_file
+from .fast_copy import copy_file_fast
+from .stage_metrics import timed
+from . import file_trace
 from .filename_util import to_filename
+from .transcode_cache import get_transcode_cache
+from .normalize import volume_filter
+from .device_profile import (
+    DEFAULT_PROFILE,
+    ACTION_COPY,
+    ACTION_REMUX,
+    ACTION_ENCODE,
+    TranscodePlan,
+)
 
 
-def copy_file(src_file, target_file):
-    shutil.copyfile(src_file, target_file)
-
-
-def transcode_correct_format(history, probe, dest_dir, verbose=False):
-    # Supported formats:
-    # If the format is not exactly one of these, then re-encode it.
-    #   MP3
-    #     mpeg1 layer3
-    #        frequencies: 32k, 44.1k, 48k
-    #        bit rates: 32-320 kbps
-    #     mpeg2 lsf layer3
-    #        frequencies: 16k, 22.05k, 24k
-    #        bit rates: 8-160 kbps
-    #   WMA
-    #     version 7, 8, 9
-    #     frequencies: 32k, 44.1k, 48k
-    #     v7,8 bit rates: 48-192 kbps
-    #     v9 bit rates: 48-320 kbps
-    #   AAC
-    #     mpeg4/aac-lc
-    #     frequencies: 11.025, 12, 16, 22.05, 24, 32, 44.1, 48
-    #     bit rates: 16-320 kbps
+def copy_file(src_file, target_file, verbose=False):
+    """
+    Copies the source into a new target file, with a reflink or an in-kernel
+    copy where the file systems allow it.  An existing target is removed
+    first rather than written over, so that any other hard link to it (such
+    as a transcode cache entry) keeps its contents.
 
+    Returns (size, sha256) of the copy.
+    """
+    if os.path.lexists(target_file):
+        os.unlink(target_file)
+    result = copy_file_fast(src_file, target_file)
+    if verbose:
+        print("Transcode: copied {0}".format(result))
+    return result.digest
+
+
+def _to_filename(history, probe, dest_dir, ext, layout):
+    if layout is not None:
+        return layout.to_filename(probe, dest_dir, ext)
+    return to_filename(history, probe, dest_dir, ext)
+
+
+def _output_file(destfile, staging):
+    if staging is not None:
+        return staging.stage_path(destfile)
+    return destfile
+
+
+def _release(destfile, layout, staging):
+    if layout is not None:
+        layout.release(destfile)
+    if staging is not None:
+        staging.discard(destfile)
+
+
+def _copy(history, probe, dest_dir, ext, layout, verbose, staging=None):
+    destfile = _to_filename(history, probe, dest_dir, ext, layout)
+    if verbose:
+        print("Transcode: copying original file.")
+    try:
+        with timed('copy'):
+            digest = copy_file(probe.filename, _output_file(destfile, staging), verbose)
+    except:
+        _release(destfile, layout, staging)
+        raise
+    return destfile, digest
+
+
+def _transcode(history, probe, dest_dir, ext, layout, verbose, cache=None, staging=None, **kwargs):
+    destfile = _to_filename(history, probe, dest_dir, ext, layout)
+    outfile = _output_file(destfile, staging)
+    try:
+        key = None
+        if cache is not None:
+            key = cache.key(probe, ext, kwargs)
+            if key is not None and cache.fetch(key, outfile):
+                if verbose:
+                    print("Transcode: using cached output {0}".format(key))
+                file_trace.note(cached=True)
+                return destfile, hash_file(outfile)
+        with timed('encode'):
+            probe.transcode(outfile, verbose=verbose, **kwargs)
+        # Hashed straight after ffmpeg closes it, while it's still cached.
+        digest = hash_file(outfile)
+        if key is not None:
+            try:
+                cache.store(key, outfile)
+            except OSError as e:
+                # The transcode itself worked.
+                print("*** WARNING: could not cache {0}: {1}".format(destfile, e))
+    except:
+        _release(destfile, layout, staging)
+        raise
+    return destfile, digest
+
+
+def _remux(history, probe, dest_dir, ext, layout, verbose, staging=None):
+    destfile = _to_filename(history, probe, dest_dir, ext, layout)
+    if verbose:
+        print("Transcode: copying the audio stream into a new container.")
+    try:
+        outfile = _output_file(destfile, staging)
+        with timed('remux'):
+            probe.remux(outfile, verbose=verbose)
+        digest = hash_file(outfile)
+    except:
+        _release(destfile, layout, staging)
+        raise
+    return destfile, digest
+
+
+def plan_transcode(probe, profile=None):
+    """
+    Returns the TranscodePlan for putting the probed file on the device.
+    """
+    if profile is None:
+        profile = DEFAULT_PROFILE
+    return profile.plan(probe)
+
+
+def _reencode_plan(probe, plan):
+    """
+    Turns a copy or remux plan into an encode that keeps the source's own
+    format, for when the audio must change (such as its volume).
+    """
+    if plan.action == ACTION_ENCODE:
+        return plan
+    return TranscodePlan(ACTION_ENCODE, plan.extension, plan.rule, {
+        'codec': probe.codec,
+        'sample_rate': probe.sample_rate,
+        'bit_rate': probe.bit_rate,
+        'channels': probe.channels,
+    })
+
+
+def transcode_correct_format(history, probe, dest_dir, verbose=False, layout=None, profile=None,
+        volume=None, staging=None):
+    """
+    Like `transcode_with_digest`, but only returns the new file name.
+    """
+    return transcode_with_digest(history, probe, dest_dir, verbose, layout, profile,
+        volume, staging)[0]
+
+
+def transcode_with_digest(history, probe, dest_dir, verbose=False, layout=None, profile=None,
+        volume=None, staging=None):
+    """
+    Copies, remuxes or transcodes the probed file into the destination
+    directory, as decided by the device profile.  Returns the new file name
+    and its (size, sha256), hashed as it was written.  If an OutputLayout
+    is given, the file name is allocated from it, rather than by inspecting
+    the directory.
+
+    If `volume` is given, the audio level is adjusted by that many dB while
+    encoding (see `normalize.source_volume_increase`); files that would be
+    copied are then encoded in their own format.
+
+    Encoded files go through the shared transcode cache, if it's turned on.
+
+    If a StagingArea is given, the file is written into it instead, and the
+    caller must pass the returned name to `staging.submit` to have it moved
+    to the destination; the digest is of the staged file, which the move
+    copies unchanged.
+    """
     assert isinstance(probe, MediaProbe)
     os.makedirs(dest_dir, exist_ok=True)
     assert os.path.isdir(dest_dir)
 
-    if probe.codec.lower() == 'mp3':
-        if (probe.sample_rate in (32000, 44100, 48000) and
-                (probe.bit_rate >= 32000 and probe.bit_rate <= 320000) and
-                probe.channels == 2):
-            destfile = to_filename(history, probe, dest_dir, '.mp3')
-            if verbose:
-                print("Transcode: copying original file.")
-            copy_file(probe.filename, destfile)
-            return destfile
-    if probe.codec.lower() == 'wma':
-        if (probe.sample_rate in (32000, 44100, 48000) and
-                (probe.bit_rate >= 48000 and probe.bit_rate <= 192000) and
-                probe.channels == 2):
-            destfile = to_filename(history, probe, dest_dir, 'wma')
-            if verbose:
-                print("Transcode: copying original file.")
-            copy_file(probe.filename, destfile)
-            return destfile
-    if probe.codec.lower() == 'aac':
-        if (probe.sample_rate in (11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000) and
-                (probe.bit_rate >= 16000 and probe.bit_rate <= 32000) and
-                probe.channels == 2):
-            destfile = to_filename(history, probe, dest_dir, '.m4a')
-            if verbose:
-                print("Transcode: copying original file.")
-            copy_file(probe.filename, destfile)
-            return destfile
-    if probe.codec.lower() == 'flac':
-        # Best quality AAC conversion
-        destfile = to_filename(history, probe, dest_dir, '.m4a')
-        probe.transcode(destfile, sample_rate=48000, bit_rate=320000, channels=2, codec='aac', verbose=verbose)
-        return destfile
-
-    # Convert to aac, without losing quality.
-    bit_rate = probe.bit_rate
-    sample_rate = probe.sample_rate
-    for sr in (11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000):
-        if sample_rate < sr:
-            sample_rate = sr
-            break
-    if bit_rate < 16000:
-        bit_rate = 16000
-    if bit_rate > 320000:
-        bit_rate = 320000
-    destfile = to_filename(history, probe, dest_dir, 'm4a')
-    probe.transcode(destfile, sample_rate=sample_rate, bit_rate=bit_rate, channels=2, codec='aac', verbose=verbose)
-    return destfile
+    plan = plan_transcode(probe, profile)
+    if volume is not None:
+        plan = _reencode_plan(probe, plan)
+    file_trace.note(decision=plan.action, extension=plan.extension)
+    if volume is not None:
+        params = dict(plan.params)
+        params['volume'] = volume_filter(volume)
+        return _transcode(history, probe, dest_dir, plan.extension, layout, verbose,
+            cache=get_transcode_cache(), staging=staging, **params)
+    if plan.action == ACTION_COPY:
+        return _copy(history, probe, dest_dir, plan.extension, layout, verbose, staging)
+    if plan.action == ACTION_REMUX:
+        return _remux(history, probe, dest_dir, plan.extension, layout, verbose, staging)
+    return _transcode(history, probe, dest_dir, plan.extension, layout, verbose,
+        cache=get_transcode_cache(), staging=staging, **plan.params)
@@ -0,0 +1,264 @@
+"""
+Content-addressed cache of transcoded files.
+
+Each entry is keyed by the source file's sha256, the transcode parameters,
+the tags written into the file and the ffmpeg version, so a hit is byte for
+byte what a new transcode would produce.  On a hit, the stored file is
+placed at the destination by a reflink (copy-on-write clone), a plain copy,
+or, if asked for, a hard link.
+
+The least recently used entries are removed when the cache grows past its
+size limit.  Entry use is tracked by the entry file's modification time.
+"""
+
+import os
+import json
+import errno
+import shutil
+import hashlib
+import threading
+from .ffmpeg_bin.ffmpeg import get_version as get_ffmpeg_version
+from .fast_copy import reflink_file
+
+
+ENV_CACHE_DIR = 'CONVERTMUSIC_TRANSCODE_CACHE'
+ENV_CACHE_SIZE_MB = 'CONVERTMUSIC_TRANSCODE_CACHE_MB'
+ENV_CACHE_LINK = 'CONVERTMUSIC_TRANSCODE_CACHE_LINK'
+
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'convertmusic', 'transcode')
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+LINK_REFLINK = 'reflink'
+LINK_HARDLINK = 'hardlink'
+LINK_COPY = 'copy'
+LINK_MODES = (LINK_REFLINK, LINK_HARDLINK, LINK_COPY)
+
+# Keys of the transcode keyword arguments that change the output.
+PARAM_KEYS = ('codec', 'sample_rate', 'bit_rate', 'channels', 'volume')
+
+
+class TranscodeCache(object):
+    """
+    The cache directory holds the entries in `(2 hex digits)/(key).(ext)`
+    files.
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, link_mode=LINK_REFLINK):
+        object.__init__(self)
+        assert link_mode in LINK_MODES
+        self.__dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.link_mode = link_mode
+        self.__lock = threading.Lock()
+        # key -> [file name, size, last use time]; loaded on first use.
+        self.__entries = None
+        self.__total = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @property
+    def cache_dir(self):
+        return self.__dir
+
+    def key(self, probe, ext, params):
+        """
+        Returns the cache key for transcoding the probed file into the ext
+        file type with the given transcode keyword arguments, or None if the
+        source can't be cached.
+        """
+        source_hash = probe.tag('sha256')
+        if source_hash is None:
+            return None
+        desc = {
+            'source': source_hash,
+            'ext': ext.lstrip('.').lower(),
+            'ffmpeg': get_ffmpeg_version(),
+            'tags': probe.get_tags(),
+        }
+        for k in PARAM_KEYS:
+            desc[k] = params.get(k)
+        text = json.dumps(desc, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def fetch(self, key, target_file):
+        """
+        Puts the cached output for the key at target_file.  Returns True on a
+        hit, False if the key isn't cached.
+        """
+        with self.__lock:
+            self.__load()
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False
+        # The file is placed without the lock, so a store or eviction in
+        # another thread can remove it after the lookup.
+        try:
+            self.__place(entry[0], target_file)
+        except FileNotFoundError:
+            with self.__lock:
+                if self.__entries.get(key) is entry:
+                    self.__forget(key)
+                self.misses += 1
+            return False
+        try:
+            os.utime(entry[0])
+            last_use = os.stat(entry[0]).st_mtime
+        except FileNotFoundError:
+            # Removed since it was placed; the target is still whole.
+            last_use = None
+        with self.__lock:
+            if last_use is not None:
+                entry[2] = last_use
+            self.hits += 1
+        return True
+
+    def store(self, key, output_file):
+        """
+        Adds a newly transcoded file to the cache, then evicts old entries
+        if the cache is over its size limit.
+        """
+        ext = os.path.splitext(output_file)[1]
+        entry_file = os.path.join(self.__dir, key[0:2], key + ext)
+        os.makedirs(os.path.dirname(entry_file), exist_ok=True)
+        tmp_file = '{0}.{1}.tmp'.format(entry_file, threading.get_ident())
+        try:
+            if not reflink_file(output_file, tmp_file):
+                shutil.copyfile(output_file, tmp_file)
+            os.replace(tmp_file, entry_file)
+        except:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+            raise
+        st = os.stat(entry_file)
+        with self.__lock:
+            self.__load()
+            self.__forget(key)
+            self.__entries[key] = [entry_file, st.st_size, st.st_mtime]
+            self.__total += st.st_size
+            self.stores += 1
+            self.__evict(self.max_bytes)
+
+    def prune(self, max_bytes=None):
+        """
+        Removes the least recently used entries until the cache is no larger
+        than max_bytes (the cache limit if not given).  Returns the
+        (removed entry count, removed bytes).
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        with self.__lock:
+            self.__load()
+            return self.__evict(max_bytes)
+
+    def stats(self):
+        with self.__lock:
+            self.__load()
+            times = [e[2] for e in self.__entries.values()]
+            return {
+                'cache_dir': self.__dir,
+                'link_mode': self.link_mode,
+                'entries': len(self.__entries),
+                'total_bytes': self.__total,
+                'max_bytes': self.max_bytes,
+                'oldest_use': min(times) if times else None,
+                'newest_use': max(times) if times else None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+            }
+
+    def __place(self, entry_file, target_file):
+        if os.path.exists(target_file):
+            os.unlink(target_file)
+        if self.link_mode == LINK_HARDLINK:
+            try:
+                os.link(entry_file, target_file)
+                return
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    raise FileNotFoundError(e.errno, e.strerror, entry_file)
+                # Probably a different device; fall back to a copy.
+        if self.link_mode != LINK_COPY and reflink_file(entry_file, target_file):
+            return
+        shutil.copyfile(entry_file, target_file)
+
+    def __load(self):
+        if self.__entries is not None:
+            return
+        self.__entries = {}
+        self.__total = 0
+        if not os.path.isdir(self.__dir):
+            return
+        for sub in os.listdir(self.__dir):
+            subdir = os.path.join(self.__dir, sub)
+            if len(sub) != 2 or not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                fqn = os.path.join(subdir, name)
+                if name.endswith('.tmp'):
+                    continue
+                st = os.stat(fqn)
+                key = os.path.splitext(name)[0]
+                self.__entries[key] = [fqn, st.st_size, st.st_mtime]
+                self.__total += st.st_size
+
+    def __forget(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__total -= entry[1]
+
+    def __evict(self, max_bytes):
+        removed_count = 0
+        removed_bytes = 0
+        if self.__total <= max_bytes:
+            return removed_count, removed_bytes
+        by_age = sorted(self.__entries.items(), key=lambda ke: ke[1][2])
+        for key, entry in by_age:
+            if self.__total <= max_bytes:
+                break
+            try:
+                os.unlink(entry[0])
+            except FileNotFoundError:
+                pass
+            self.__forget(key)
+            removed_count += 1
+            removed_bytes += entry[1]
+        return removed_count, removed_bytes
+
+
+_DEFAULT_CACHE = None
+_DEFAULT_CACHE_LOADED = False
+
+
+def get_transcode_cache():
+    """
+    Returns the shared transcode cache, as configured by the environment, or
+    None if caching is turned off (CONVERTMUSIC_TRANSCODE_CACHE=off).
+    """
+    global _DEFAULT_CACHE, _DEFAULT_CACHE_LOADED
+    if not _DEFAULT_CACHE_LOADED:
+        _DEFAULT_CACHE = _cache_from_env()
+        _DEFAULT_CACHE_LOADED = True
+    return _DEFAULT_CACHE
+
+
+def set_transcode_cache(cache):
+    """Replaces the shared transcode cache; None turns caching off."""
+    global _DEFAULT_CACHE, _DEFAULT_CACHE_LOADED
+    assert cache is None or isinstance(cache, TranscodeCache)
+    _DEFAULT_CACHE = cache
+    _DEFAULT_CACHE_LOADED = True
+
+
+def _cache_from_env():
+    cache_dir = os.environ.get(ENV_CACHE_DIR, DEFAULT_CACHE_DIR)
+    if cache_dir.strip().lower() in ('', 'off', 'none', '0'):
+        return None
+    max_bytes = DEFAULT_MAX_BYTES
+    if ENV_CACHE_SIZE_MB in os.environ:
+        max_bytes = int(os.environ[ENV_CACHE_SIZE_MB]) * 1024 * 1024
+    link_mode = os.environ.get(ENV_CACHE_LINK, LINK_REFLINK).strip().lower()
+    if link_mode not in LINK_MODES:
+        raise Exception('{0} must be one of {1}'.format(ENV_CACHE_LINK, ', '.join(LINK_MODES)))
+    return TranscodeCache(os.path.expanduser(cache_dir), max_bytes, link_mode)
@@ -0,0 +1,137 @@
+"""
+Benchmarks module rendering: the per-frame render (xmp_play_frame with a
+copy of each frame) against the large buffer render (xmp_play_buffer into
+reused buffers), and the large buffer render on a RenderPool with one job
+per CPU.
+
+Run with:
+
+    python3 -m convertmusic.tools.xmp_lib.bench_render [module file ...]
+
+If no module file is given, a generated 4 channel ProTracker module is
+used.  The results are reported as the realtime multiple: seconds of audio
+rendered per second of wall time.
+"""
+
+import os
+import sys
+import time
+import math
+import struct
+import tempfile
+from .xmp_wav import (
+    render_frames, render_buffers,
+    OPT_FREQUENCY, OPT_CHANNEL_COUNT, OPT_SAMPLE_WIDTH,
+)
+from .render_pool import RenderPool
+
+
+# Amiga periods for C-2 to B-3.
+PERIODS = (
+    428, 404, 381, 360, 340, 320, 302, 285, 269, 254, 240, 226,
+    214, 202, 190, 180, 170, 160, 151, 143, 135, 127, 120, 113,
+)
+
+
+def make_test_module(pattern_count=16):
+    """
+    Returns the bytes of a ProTracker (M.K.) module with a few looped
+    synthetic instruments and busy patterns on all 4 channels.  Each pattern
+    is 64 rows at the default speed, about 7.7 seconds.
+    """
+    samples = []
+    # sine, saw, square and noise-ish, each one looped cycle
+    samples.append(bytes(
+        int(100 * math.sin(2 * math.pi * i / 64)) & 0xff for i in range(64)))
+    samples.append(bytes((i * 4 - 128) & 0xff for i in range(64)))
+    samples.append(bytes((i < 32 and 100 or -100) & 0xff for i in range(64)))
+    samples.append(bytes((i * 73 + 41) * 97 % 251 - 125 & 0xff for i in range(256)))
+
+    out = bytearray()
+    out += b'bench render'.ljust(20, b'\0')
+    for i in range(31):
+        if i < len(samples):
+            words = len(samples[i]) // 2
+            out += 'synth {0}'.format(i + 1).encode('ascii').ljust(22, b'\0')
+            out += struct.pack('>HBBHH', words, 0, 64, 0, words)
+        else:
+            out += b'\0' * 22 + struct.pack('>HBBHH', 0, 0, 0, 0, 1)
+    out += struct.pack('>BB', pattern_count, 127)
+    out += bytes(range(pattern_count)).ljust(128, b'\0')
+    out += b'M.K.'
+    for pat in range(pattern_count):
+        for row in range(64):
+            for chn in range(4):
+                if (row + chn) % 2 == 0:
+                    ins = chn + 1
+                    period = PERIODS[(pat * 5 + row * 3 + chn * 7) % len(PERIODS)]
+                else:
+                    ins = 0
+                    period = 0
+                out += struct.pack('>BBBB',
+                    (ins & 0xf0) | (period >> 8), period & 0xff,
+                    (ins & 0x0f) << 4, 0)
+    for s in samples:
+        out += s
+    return bytes(out)
+
+
+def _time_render(render, filename):
+    start = time.perf_counter()
+    size = 0
+    for b in render(filename):
+        size += len(b)
+    elapsed = time.perf_counter() - start
+    seconds = size / (OPT_FREQUENCY * OPT_CHANNEL_COUNT * OPT_SAMPLE_WIDTH)
+    return seconds, elapsed
+
+
+def _time_pool(filename):
+    jobs = os.cpu_count() or 1
+    with RenderPool(jobs) as pool:
+        start = time.perf_counter()
+        futures = [pool.submit(filename, lambda b: None) for i in range(jobs)]
+        size = sum(f.result() for f in futures)
+        elapsed = time.perf_counter() - start
+    seconds = size / (OPT_FREQUENCY * OPT_CHANNEL_COUNT * OPT_SAMPLE_WIDTH)
+    return seconds, elapsed
+
+
+def _report(name, seconds, elapsed):
+    print('{0:8} {1:8.1f}s audio  {2:8.3f}s wall  {3:8.1f}x realtime'.format(
+        name, seconds, elapsed, seconds / max(elapsed, 1e-9)))
+
+
+def bench(filename, repeat=3):
+    for name, timer in (
+            ('frames', lambda: _time_render(render_frames, filename)),
+            ('buffer', lambda: _time_render(render_buffers, filename)),
+            ('pool', lambda: _time_pool(filename))):
+        best = None
+        for i in range(repeat):
+            seconds, elapsed = timer()
+            if best is None or elapsed < best:
+                best = elapsed
+        _report(name, seconds, best)
+
+
+def main(args):
+    files = args[1:]
+    tmp = None
+    if len(files) <= 0:
+        fd, tmp = tempfile.mkstemp(suffix='.mod')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(make_test_module())
+        files = [tmp]
+    try:
+        for filename in files:
+            print(tmp == filename and '(generated module)' or filename)
+            bench(filename)
+    finally:
+        if tmp is not None:
+            os.unlink(tmp)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1121,6 +1121,12 @@ if hasattr(_libs['xmp'], 'xmp_load_module_from_file'):
     xmp_load_module_from_file.restype = c_int
     xmp_load_module_from_file.argtypes = [xmp_context, POINTER(None), c_long]
 
+# libxmp/include/xmp.h (4.5): 350
+if hasattr(_libs['xmp'], 'xmp_test_module_from_memory'):
+    xmp_test_module_from_memory = _libs['xmp'].xmp_test_module_from_memory
+    xmp_test_module_from_memory.restype = c_int
+    xmp_test_module_from_memory.argtypes = [POINTER(None), c_long, POINTER(struct_xmp_test_info)]
+
 # libxmp/include/xmp.h: 348
 if hasattr(_libs['xmp'], 'xmp_start_smix'):
     xmp_start_smix = _libs['xmp'].xmp_start_smix
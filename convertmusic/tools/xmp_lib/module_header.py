@@ -0,0 +1,105 @@
+"""
+Reads the instrument names straight from the module file headers, without
+loading (and decoding the samples of) the whole module.
+
+Handles the common formats: 31 instrument MOD, XM, S3M and IT.  For other
+formats, or if the header doesn't look right, `read_instrument_names`
+returns None and the caller should load the module with libxmp instead.
+"""
+
+import re
+import struct
+
+
+MOD_SIGNATURE = re.compile(rb'^(M\.K\.|M!K!|M&K!|N\.T\.|FLT[48]|EXO[48]|\dCHN|\d\dCH|\d\dCN|CD61|CD81|OKTA|OCTA|TDZ\d)$')
+
+
+def read_instrument_names(data):
+    """
+    Returns the list of instrument names (as bytes, with the padding
+    removed), in instrument order, or None if the format isn't handled.
+    """
+    try:
+        if data[0:17] == b'Extended Module: ':
+            return _xm_names(data)
+        if data[0:4] == b'IMPM':
+            return _it_names(data)
+        if data[44:48] == b'SCRM':
+            return _s3m_names(data)
+        if MOD_SIGNATURE.match(data[1080:1084]):
+            return _mod_names(data)
+    except (struct.error, IndexError):
+        # Truncated or not really this format.
+        pass
+    return None
+
+
+def _name(data, offset, size):
+    """
+    Reads the name the same way libxmp does: up to the first NUL, with
+    unprintable characters turned into '.' and trailing spaces removed.
+    """
+    if offset + size > len(data):
+        raise IndexError(offset)
+    name = data[offset:offset + size].split(b'\0', 1)[0]
+    return bytes(
+        (32 <= c < 127) and c or 0x2e for c in name
+    ).rstrip(b' ')
+
+
+def _mod_names(data):
+    return [_name(data, 20 + 30 * i, 22) for i in range(31)]
+
+
+def _xm_names(data):
+    header_size, = struct.unpack_from('<I', data, 60)
+    pattern_count, instrument_count = struct.unpack_from('<HH', data, 70)
+    pos = 60 + header_size
+    for i in range(pattern_count):
+        pattern_header, = struct.unpack_from('<I', data, pos)
+        packed_size, = struct.unpack_from('<H', data, pos + 7)
+        pos += pattern_header + packed_size
+    names = []
+    for i in range(instrument_count):
+        instrument_size, = struct.unpack_from('<I', data, pos)
+        names.append(_name(data, pos + 4, 22))
+        sample_count, = struct.unpack_from('<H', data, pos + 27)
+        sample_header_size = 40
+        if sample_count > 0:
+            sample_header_size, = struct.unpack_from('<I', data, pos + 29)
+        pos += instrument_size
+        sample_data = 0
+        for s in range(sample_count):
+            length, = struct.unpack_from('<I', data, pos)
+            sample_data += length
+            pos += sample_header_size
+        pos += sample_data
+    return names
+
+
+def _s3m_names(data):
+    order_count, instrument_count = struct.unpack_from('<HH', data, 0x20)
+    names = []
+    for i in range(instrument_count):
+        para, = struct.unpack_from('<H', data, 0x60 + order_count + 2 * i)
+        names.append(_name(data, para * 16 + 0x30, 28))
+    return names
+
+
+def _it_names(data):
+    order_count, instrument_count, sample_count = struct.unpack_from('<HHH', data, 0x20)
+    flags, = struct.unpack_from('<H', data, 0x2c)
+    table = 0xc0 + order_count
+    names = []
+    if flags & 0x04:
+        # Instrument mode
+        for i in range(instrument_count):
+            offset, = struct.unpack_from('<I', data, table + 4 * i)
+            names.append(_name(data, offset + 0x20, 26))
+    else:
+        # Sample mode; libxmp makes an instrument for each sample.
+        table += 4 * instrument_count
+        for i in range(sample_count):
+            offset, = struct.unpack_from('<I', data, table + 4 * i)
+            names.append(_name(data, offset + 0x14, 26))
+    return names
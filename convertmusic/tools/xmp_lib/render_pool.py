@@ -0,0 +1,103 @@
+"""
+Renders many modules at once, on threads.
+
+ctypes releases the GIL while libxmp renders, so threads can use every
+core.  Each worker has its own xmp context, and each job carries its own
+RenderOptions, so jobs don't share any player state.
+
+The module transcodes render on the shared pool (`get_render_pool`), so
+their contexts are reused, and no more modules render at once than there
+are workers however many threads transcode.
+"""
+
+import os
+import queue
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .xmp_wav import (
+    RenderOptions, create_context, free_context, render_buffers, convert,
+)
+
+
+class RenderPool(object):
+    """
+    Use `submit` to render a module through a callback, or `submit_wav` to
+    render it into a wav file.  Both return a Future.
+    """
+    def __init__(self, workers=None):
+        object.__init__(self)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, workers)
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        # One context per worker.  A job takes a context for as long as it
+        # runs, so no context is ever used by two threads at once.
+        self.__contexts = queue.Queue()
+        self.__all_contexts = []
+        for i in range(workers):
+            xc = create_context()
+            self.__all_contexts.append(xc)
+            self.__contexts.put(xc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, inp_file, write, options=None, loop_count=0):
+        """
+        Renders the module, calling `write(block)` from the worker thread for
+        each block of PCM data (see xmp_wav.render_buffers).  The future's
+        result is the number of bytes rendered.
+        """
+        assert options is None or isinstance(options, RenderOptions)
+        return self.__executor.submit(self.__render, inp_file, write, options, loop_count)
+
+    def submit_wav(self, inp_file, outp_file, options=None, loop_count=0):
+        """
+        Renders the module into a wav file.
+        """
+        assert options is None or isinstance(options, RenderOptions)
+        return self.__executor.submit(self.__convert, inp_file, outp_file, options, loop_count)
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+        for xc in self.__all_contexts:
+            free_context(xc)
+        self.__all_contexts = []
+
+    def __render(self, inp_file, write, options, loop_count):
+        xc = self.__contexts.get()
+        try:
+            total = 0
+            for b in render_buffers(inp_file, loop_count, options=options, xc=xc):
+                write(b)
+                total += len(b)
+            return total
+        finally:
+            self.__contexts.put(xc)
+
+    def __convert(self, inp_file, outp_file, options, loop_count):
+        xc = self.__contexts.get()
+        try:
+            convert(inp_file, outp_file, loop_count, options=options, xc=xc)
+        finally:
+            self.__contexts.put(xc)
+
+
+_SHARED = None
+_SHARED_LOCK = threading.Lock()
+
+
+def get_render_pool():
+    """
+    The shared pool, used by the module transcodes.
+    """
+    global _SHARED
+    with _SHARED_LOCK:
+        if _SHARED is None:
+            _SHARED = RenderPool()
+            atexit.register(_SHARED.close)
+        return _SHARED
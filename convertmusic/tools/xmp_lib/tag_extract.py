@@ -6,16 +6,47 @@ import hashlib
 import gzip
 import lzma
 
-def file_checksums(src_filename):
+def open_unpacked(src_filename):
+    """
+    Opens the file for reading, decompressing it if it has a .bz2, .gz, .z
+    or .xz extension.
+    """
     fn = src_filename.lower()
     if fn.endswith('.bz2'):
-        inp = bz2.open(src_filename, 'rb')
+        return bz2.open(src_filename, 'rb')
     elif fn.endswith('.gz') or fn.endswith('.z'):
-        inp = gzip.open(src_filename, 'rb')
+        return gzip.open(src_filename, 'rb')
     elif fn.endswith('.xz'):
-        inp = lzma.open(src_filename, 'rb')
-    else:
-        inp = open(src_filename, 'rb')
+        return lzma.open(src_filename, 'rb')
+    return open(src_filename, 'rb')
+
+
+def is_packed(src_filename):
+    fn = src_filename.lower()
+    return fn.endswith('.bz2') or fn.endswith('.gz') or fn.endswith('.z') or fn.endswith('.xz')
+
+
+def read_unpacked(src_filename):
+    """
+    Returns the (decompressed) contents of the file.
+    """
+    with open_unpacked(src_filename) as inp:
+        return inp.read()
+
+
+def data_checksums(data):
+    """
+    The same as file_checksums, for file contents that are already read.
+    """
+    return {
+        'sha1': hashlib.sha1(data).hexdigest(),
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'size_bytes': len(data),
+    }
+
+
+def file_checksums(src_filename):
+    inp = open_unpacked(src_filename)
     hashes = {
         'sha1': hashlib.sha1(),
         'sha256': hashlib.sha256()
@@ -27,6 +58,7 @@ def file_checksums(src_filename):
         for h in hashes.values():
             h.update(buff)
         buff = inp.read(4096)
+    inp.close()
     tags = {}
     for k,h in hashes.items():
         tags[k] = h.hexdigest()
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+"""
+Tests that a spilled module file outlives its eviction while it's in use.
+
+Run with:
+
+    python3 -m pytest convertmusic/tools/xmp_lib/test_unpack_cache.py
+"""
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from convertmusic.tools.xmp_lib.unpack_cache import UnpackCache
+
+
+MODULE = bytes(range(256)) * 64
+
+
+class UnpackCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.spill_dir = os.path.join(self.dir, 'spill')
+        os.mkdir(self.spill_dir)
+        # Everything spills to a file, and only one file fits.
+        self.cache = UnpackCache(max_file_bytes=len(MODULE), memory_entry_bytes=0,
+            spill_dir=self.spill_dir)
+
+    def tearDown(self):
+        self.cache.clear()
+        shutil.rmtree(self.dir)
+
+    def _module(self, name):
+        filename = os.path.join(self.dir, name + '.mod.gz')
+        with gzip.open(filename, 'wb') as f:
+            f.write(MODULE)
+        return filename
+
+    def test_shared(self):
+        filename = self._module('a')
+        with self.cache.open(filename) as first:
+            with self.cache.open(filename) as second:
+                self.assertIs(first, second)
+        self.assertEqual(1, self.cache.unpack_count)
+        self.assertEqual(1, self.cache.hits)
+
+    def test_evicted_while_pinned(self):
+        a = self.cache.open(self._module('a'))
+        self.assertFalse(a.in_memory)
+        with self.cache.open(self._module('b')) as b:
+            # a was dropped for b, but is still in use.
+            self.assertTrue(os.path.isfile(a.path))
+            self.assertEqual(MODULE, a.data)
+            a.release()
+            self.assertFalse(os.path.exists(a.path))
+            self.assertTrue(os.path.isfile(b.path))
+        # b is still cached, so releasing it keeps the file.
+        self.assertTrue(os.path.isfile(b.path))
+
+    def test_evicted_after_release(self):
+        with self.cache.open(self._module('a')) as a:
+            pass
+        with self.cache.open(self._module('b')):
+            self.assertFalse(os.path.exists(a.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+"""
+Keeps decompressed .gz/.bz2/.xz module files around, so that a packed
+module is decompressed once and then shared by the checksums, the probe
+and the render.
+
+Small modules are kept in memory.  Larger ones are written to a file in
+tmpfs (/dev/shm, if there is one), which libxmp can load directly.  Each
+tier has a size budget, and the least recently used entries are dropped
+when a budget is exceeded.
+
+An opened entry is pinned until it's released (use it as a context
+manager), so that dropping it doesn't remove the tmpfs file while another
+thread still reads or loads it; the file is removed on the last release.
+"""
+
+import os
+import atexit
+import tempfile
+import threading
+from collections import OrderedDict
+from .tag_extract import is_packed, open_unpacked
+
+
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+DEFAULT_FILE_BYTES = 1024 * 1024 * 1024
+# Modules larger than this go to a file instead of memory.
+DEFAULT_MEMORY_ENTRY_BYTES = 32 * 1024 * 1024
+
+TMPFS_DIR = '/dev/shm'
+
+
+class UnpackedFile(object):
+    """
+    The decompressed contents of a module file.  `data` is the contents,
+    as bytes.  `path` is a file with the decompressed contents that libxmp
+    can load, or None if the contents are only in memory.  Both are only
+    valid until the file is released.
+    """
+    def __init__(self, filename, data=None, path=None, size=None, cache=None):
+        object.__init__(self)
+        self.filename = filename
+        self.__data = data
+        self.path = path
+        self.__size = size
+        self.__cache = cache
+        # Opens not yet released, and whether the cache dropped the entry
+        # while it was pinned; only changed with the cache's lock held.
+        self.pins = 0
+        self.evicted = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self):
+        if self.__cache is not None:
+            self.__cache.release(self)
+
+    @property
+    def in_memory(self):
+        return self.__data is not None
+
+    @property
+    def data(self):
+        if self.__data is not None:
+            return self.__data
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    @property
+    def size(self):
+        if self.__data is not None:
+            return len(self.__data)
+        if self.__size is None:
+            self.__size = os.path.getsize(self.path)
+        return self.__size
+
+
+class UnpackCache(object):
+    def __init__(self, max_memory_bytes=DEFAULT_MEMORY_BYTES,
+            max_file_bytes=DEFAULT_FILE_BYTES,
+            memory_entry_bytes=DEFAULT_MEMORY_ENTRY_BYTES,
+            spill_dir=None):
+        object.__init__(self)
+        self.max_memory_bytes = max_memory_bytes
+        self.max_file_bytes = max_file_bytes
+        self.memory_entry_bytes = memory_entry_bytes
+        if spill_dir is None:
+            spill_dir = os.access(TMPFS_DIR, os.W_OK) and TMPFS_DIR or tempfile.gettempdir()
+        self.__spill_dir = spill_dir
+        self.__lock = threading.Lock()
+        # (filename, mtime, size) -> UnpackedFile, least recently used first
+        self.__memory = OrderedDict()
+        self.__files = OrderedDict()
+        self.__memory_total = 0
+        self.__file_total = 0
+        # Keys being decompressed right now, so that two threads wanting the
+        # same file only decompress it once.
+        self.__loading = {}
+        self.unpack_count = 0
+        self.hits = 0
+
+    def open(self, filename):
+        """
+        Returns the UnpackedFile for the file, pinned until it's released.
+        Files that aren't packed are returned as-is, and are not kept.
+        """
+        if not is_packed(filename):
+            return UnpackedFile(filename, path=filename)
+        st = os.stat(filename)
+        key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+        while True:
+            with self.__lock:
+                entry = self.__lookup(key)
+                if entry is not None:
+                    self.hits += 1
+                    entry.pins += 1
+                    return entry
+                loading = self.__loading.get(key)
+                if loading is None:
+                    loading = threading.Event()
+                    self.__loading[key] = loading
+                    break
+            loading.wait()
+        try:
+            entry = self.__unpack(filename)
+            with self.__lock:
+                self.unpack_count += 1
+                entry.pins += 1
+                self.__add(key, entry)
+            return entry
+        finally:
+            with self.__lock:
+                del self.__loading[key]
+            loading.set()
+
+    def release(self, entry):
+        """
+        Unpins the entry returned by open.  If the entry was dropped while
+        pinned, its file is removed with the last release.
+        """
+        with self.__lock:
+            entry.pins -= 1
+            if entry.pins > 0 or not entry.evicted:
+                return
+        _remove(entry.path)
+
+    def clear(self):
+        with self.__lock:
+            self.__memory_total -= self.__evict(self.__memory, self.__memory_total, False, 0)
+            self.__file_total -= self.__evict(self.__files, self.__file_total, True, 0)
+
+    def __lookup(self, key):
+        for entries in (self.__memory, self.__files):
+            entry = entries.get(key)
+            if entry is not None:
+                entries.move_to_end(key)
+                return entry
+        return None
+
+    def __unpack(self, filename):
+        with open_unpacked(filename) as inp:
+            data = inp.read(self.memory_entry_bytes + 1)
+            if len(data) <= self.memory_entry_bytes:
+                return UnpackedFile(filename, data=data, cache=self)
+            fd, path = tempfile.mkstemp(
+                suffix='-' + os.path.basename(filename)[0:-len(os.path.splitext(filename)[1])],
+                dir=self.__spill_dir)
+            size = 0
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    while len(data) > 0:
+                        out.write(data)
+                        size += len(data)
+                        data = inp.read(1024 * 1024)
+            except:
+                os.unlink(path)
+                raise
+            return UnpackedFile(filename, path=path, size=size, cache=self)
+
+    def __add(self, key, entry):
+        if entry.in_memory:
+            self.__memory[key] = entry
+            self.__memory_total += entry.size
+            self.__memory_total -= self.__evict(self.__memory,
+                self.__memory_total - self.max_memory_bytes, False)
+        else:
+            self.__files[key] = entry
+            self.__file_total += entry.size
+            self.__file_total -= self.__evict(self.__files,
+                self.__file_total - self.max_file_bytes, True)
+
+    def __evict(self, entries, excess, remove_files, keep=1):
+        """
+        Drops the oldest entries until `excess` bytes are freed, keeping at
+        least the `keep` newest entries.  Returns the bytes freed.
+        """
+        freed = 0
+        while freed < excess and len(entries) > keep:
+            key, entry = entries.popitem(last=False)
+            freed += entry.size
+            if remove_files:
+                if entry.pins > 0:
+                    entry.evicted = True
+                else:
+                    _remove(entry.path)
+        return freed
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+_SHARED = None
+_SHARED_LOCK = threading.Lock()
+
+
+def get_unpack_cache():
+    """
+    The shared cache, used by the module probe and the renderer.
+    """
+    global _SHARED
+    with _SHARED_LOCK:
+        if _SHARED is None:
+            _SHARED = UnpackCache()
+            atexit.register(_SHARED.clear)
+        return _SHARED
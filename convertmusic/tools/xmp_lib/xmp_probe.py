@@ -1,15 +1,25 @@
 
 from ..probe import MediaProbe, ProbeFactory
 from ..tag import *
-from .libxmp import Module
+from .libxmp import (
+    Module, Player, ModuleInfo, TestInfo,
+    xmp_test_module, xmp_load_module_from_memory, xmp_get_module_info,
+    xmp_release_module,
+)
+from . import libxmp
+from .module_header import read_instrument_names
+from .unpack_cache import get_unpack_cache
+from .render_pool import get_render_pool
 from .xmp_wav import (
-    convert,
+    render_buffers,
 
     OPT_FREQUENCY, OPT_CHANNEL_COUNT, OPT_BITS_PER_SAMPLE
 )
 from ..ffmpeg_bin import ffmpeg
 from .tag_extract import *
 import os
+import ctypes
+import threading
 
 
 FORMATS = (
@@ -80,43 +90,163 @@ def comment_tag_extract(probe, song_name, comment_lines):
         probe.set_tag(COMMENT, '\n'.join(comment_lines))
 
 
+class ModuleMetadata(object):
+    def __init__(self, name, type, instrument_names):
+        object.__init__(self)
+        self.name = name
+        self.type = type
+        self.instrument_names = instrument_names
+
+
+_THREAD_STATE = threading.local()
+
+
+def _thread_player():
+    """
+    One xmp context per thread, reused for every module that has to be
+    fully loaded.
+    """
+    player = getattr(_THREAD_STATE, 'player', None)
+    if player is None:
+        player = Player()
+        _THREAD_STATE.player = player
+    return player
+
+
+def _test_module(unpacked):
+    """
+    Returns the TestInfo (module name and format) for the unpacked module, or
+    None if libxmp doesn't recognize it or can't test it without
+    decompressing it again.
+    """
+    info = TestInfo()
+    if hasattr(libxmp, 'xmp_test_module_from_memory') and unpacked.in_memory:
+        rc = libxmp.xmp_test_module_from_memory(unpacked.data, unpacked.size, ctypes.pointer(info))
+    elif unpacked.path is not None and not is_packed(unpacked.path):
+        rc = xmp_test_module(unpacked.path.encode('utf-8'), ctypes.pointer(info))
+    else:
+        return None
+    if rc != 0:
+        return None
+    return info
+
+
+def _load_from_memory(data):
+    xc = _thread_player().get_context()
+    rc = xmp_load_module_from_memory(xc, data, len(data))
+    if rc < 0:
+        return None
+    try:
+        info = ModuleInfo()
+        xmp_get_module_info(xc, ctypes.pointer(info))
+        mod = info.mod[0]
+        return ModuleMetadata(mod.name, mod.type,
+            [mod.xxi[i].name for i in range(mod.ins)])
+    finally:
+        xmp_release_module(xc)
+
+
+def _load_from_file(filename):
+    # Lets libxmp handle the packers that Python can't.
+    mod = Module(filename, _thread_player())
+    try:
+        return ModuleMetadata(mod.name, mod.type,
+            [mod.xxi[i].name for i in range(mod.ins)])
+    finally:
+        mod.release()
+
+
+def read_module_metadata(unpacked, data):
+    """
+    Finds the module name, format and instrument names from the
+    UnpackedFile and its contents.  Where possible, this only tests the
+    module and reads the names from the header; other modules are fully
+    loaded.
+    """
+    info = _test_module(unpacked)
+    if info is not None:
+        names = read_instrument_names(data)
+        if names is not None:
+            return ModuleMetadata(info.name, info.type, names)
+    meta = None
+    if unpacked.in_memory:
+        meta = _load_from_memory(data)
+    if meta is None:
+        meta = _load_from_file(unpacked.path or unpacked.filename)
+    return meta
+
+
 class XmpProbe(MediaProbe):
     def __init__(self, filename):
         MediaProbe.__init__(self, filename)
-        for tag_name, tag_value in file_checksums(filename).items():
-            self.set_tag(tag_name, str(tag_value))
-        MediaProbe.__init__(self, filename)
-        mod = Module(filename)
+        # Packed modules are decompressed just once, and shared by the
+        # checksums, the metadata and the render.
+        with get_unpack_cache().open(filename) as unpacked:
+            data = unpacked.data
+            for tag_name, tag_value in data_checksums(data).items():
+                self.set_tag(tag_name, str(tag_value))
+            meta = read_module_metadata(unpacked, data)
         self.sample_rate = OPT_FREQUENCY
         self.bit_rate = OPT_BITS_PER_SAMPLE * OPT_FREQUENCY
         self.channels = OPT_CHANNEL_COUNT
-        self.codec = mod.type.decode('ascii', 'ignore')
+        self.codec = meta.type.decode('ascii', 'ignore')
         # Instruments usually are the comments...
         comment_lines = []
-        for i in range(mod.ins):
-            ins = mod.xxi[i]
-            iname = ins.name.decode('ascii', 'ignore')
+        for name in meta.instrument_names:
+            iname = name.decode('ascii', 'ignore')
             if len(iname.rstrip()) > 0:
                 comment_lines.append(iname)
         #print("DEBUG {0} {1} {2}".format(repr(filename), repr(self.codec), repr(comment_lines)))
-        comment_tag_extract(self, mod.name.decode('ascii', 'ignore'), comment_lines)
-
-    def transcode(self, tofile, sample_rate = 44100, bit_rate = 0, channels = 2, codec = None, verbose=False):
-        # First, transform to a temporary wav file.
-        tmp = 'tmp.wav'
-        if os.path.exists(tmp):
-            os.unlink(tmp)
-        try:
-            convert(self.filename, tmp)
-            ffmpeg.convert(tmp, tofile,
-                bit_rate=bit_rate,
-                channels=channels,
-                sample_rate=sample_rate,
-                codec=codec,
-                tags=self.get_tags())
-        finally:
-            if os.path.exists(tmp):
-                os.unlink(tmp)
+        comment_tag_extract(self, meta.name.decode('ascii', 'ignore'), comment_lines)
+
+    def transcode(self, tofile, sample_rate = 44100, bit_rate = 0, channels = 2, codec = None, volume=None, verbose=False):
+        # Render straight into the encoder, on the shared render pool; no
+        # temporary wav file.
+        ffmpeg.convert_pcm(lambda outp: _pooled_stream(self.filename, outp), tofile,
+            in_sample_rate=OPT_FREQUENCY,
+            in_channels=OPT_CHANNEL_COUNT,
+            bit_rate=bit_rate,
+            channels=channels,
+            sample_rate=sample_rate,
+            codec=codec,
+            tags=self.get_tags(),
+            volume=volume,
+            verbose=verbose)
+
+    def volume_levels(self):
+        from .. import pcm_analysis
+        if pcm_analysis.available():
+            return MediaProbe.volume_levels(self)
+        # Measured on the rendered audio; ffmpeg can't read most modules.
+        return ffmpeg.find_pcm_volume_levels(lambda outp: _pooled_stream(self.filename, outp),
+            in_sample_rate=OPT_FREQUENCY,
+            in_channels=OPT_CHANNEL_COUNT)
+
+    def decode_pcm(self, sample_rate=None, channels=None, duration=None):
+        # Always the renderer's own format.
+        blocks = render_buffers(self.filename)
+        if duration is not None:
+            blocks = _limit_blocks(blocks,
+                int(duration * OPT_FREQUENCY) * OPT_CHANNEL_COUNT * OPT_BITS_PER_SAMPLE // 8)
+        return OPT_FREQUENCY, OPT_CHANNEL_COUNT, blocks
+
+
+def _pooled_stream(filename, outp):
+    """
+    Renders the module into the writable binary stream on the shared render
+    pool, and waits for it (see xmp_wav.stream).
+    """
+    return get_render_pool().submit(filename, outp.write).result()
+
+
+def _limit_blocks(blocks, size):
+    for b in blocks:
+        if len(b) >= size:
+            yield b[0:size]
+            blocks.close()
+            return
+        size -= len(b)
+        yield b
 
 
 class XmpProbeFactory(ProbeFactory):
@@ -5,16 +5,18 @@ from .libxmp import (
     xmp_set_player, xmp_create_context, xmp_set_player,
     xmp_load_module, xmp_start_player, xmp_get_player,
     xmp_play_frame, xmp_get_frame_info, xmp_end_player, xmp_release_module,
-    xmp_free_context, xmp_get_module_info, xmp_set_position,
+    xmp_free_context, xmp_get_module_info, xmp_set_position, xmp_play_buffer,
+    xmp_load_module_from_memory,
 
     XMP_INTERP_SPLINE, XMP_DSP_LOWPASS, XMP_DSP_ALL, XMP_MODE_AUTO,
     XMP_FLAGS_VBLANK, XMP_FLAGS_FX9BUG, XMP_FLAGS_FIXLOOP, XMP_FLAGS_A500,
 
     XMP_PLAYER_DEFPAN, XMP_PLAYER_VOICES, XMP_PLAYER_INTERP, XMP_PLAYER_DSP,
-    XMP_PLAYER_AMP, XMP_PLAYER_CFLAGS,
+    XMP_PLAYER_AMP, XMP_PLAYER_CFLAGS, XMP_FORMAT_MONO,
 )
 import wave
-from ctypes import pointer
+from ctypes import pointer, c_char
+from .unpack_cache import get_unpack_cache
 
 OPT_FREQUENCY = 44100
 OPT_CHANNEL_COUNT = 2
@@ -35,6 +37,47 @@ OPT_AMIGA_MIXER = 0 # Use Paula simulation mixer in Amiga formats
 # 16 bit, stereo, signed
 OPT_FORMAT = 0
 
+# Bytes rendered per xmp_play_buffer call; about 1.5 seconds of audio.
+RENDER_BUFFER_SIZE = 256 * 1024
+
+
+class RenderOptions(object):
+    """
+    The player settings for rendering one module.  The defaults come from
+    the OPT_* module settings at the time the options are created.
+    """
+    def __init__(self, **kwargs):
+        object.__init__(self)
+        self.frequency = OPT_FREQUENCY
+        self.channel_count = OPT_CHANNEL_COUNT
+        self.default_pan = OPT_DEFAULT_PAN
+        self.number_voices = OPT_NUMBER_VOICES
+        self.interpolate = OPT_INTERPOLATE
+        self.dsp = OPT_DSP
+        self.amplify = OPT_AMPLIFY
+        self.vblank = OPT_VBLANK
+        self.fx9bug = OPT_FX9BUG
+        self.fixloop = OPT_FIXLOOP
+        self.amiga_mixer = OPT_AMIGA_MIXER
+        for k, v in kwargs.items():
+            if not hasattr(self, k):
+                raise TypeError('Unknown render option {0}'.format(k))
+            setattr(self, k, v)
+        assert self.channel_count in (1, 2)
+
+    @property
+    def format(self):
+        # Always signed 16 bit.
+        return self.channel_count == 1 and XMP_FORMAT_MONO or OPT_FORMAT
+
+    @property
+    def frame_size(self):
+        return self.channel_count * OPT_SAMPLE_WIDTH
+
+    @property
+    def bytes_per_second(self):
+        return self.frequency * self.frame_size
+
 
 def _set_flag(flag, action, val):
     if action > 0:
@@ -43,15 +86,35 @@ def _set_flag(flag, action, val):
         flag &= ~val
     return flag
 
-def convert(inp_file, outp_file, loop_count = 0):
-    assert isinstance(inp_file, str)
 
+def create_context():
+    """
+    Creates an xmp context, which can render one module at a time.  A
+    context must only be used by one thread at a time.  Free it with
+    free_context.
+    """
     xc = xmp_create_context()
     if xc == None:
         raise Exception()
+    return xc
+
+
+def free_context(xc):
+    xmp_free_context(xc)
+
+
+def _start_player(xc, inp_file, options):
+    """
+    Loads the module into the xmp context and starts the player.
+    """
     # must be set before loading module
-    xmp_set_player(xc, XMP_PLAYER_DEFPAN, OPT_DEFAULT_PAN)
-    rc = xmp_load_module(xc, bytes(inp_file, 'utf-8'))
+    xmp_set_player(xc, XMP_PLAYER_DEFPAN, options.default_pan)
+    # Use the already decompressed module, if the probe unpacked it.
+    with get_unpack_cache().open(inp_file) as unpacked:
+        if unpacked.in_memory:
+            rc = xmp_load_module_from_memory(xc, unpacked.data, unpacked.size)
+        else:
+            rc = xmp_load_module(xc, bytes(unpacked.path, 'utf-8'))
     if rc < 0:
         raise Exception()
     module = ModuleInfo()
@@ -66,15 +129,16 @@ def convert(inp_file, outp_file, loop_count = 0):
     #        print(" {0} {1}".format(i, module.xxi[i].name))
 
 
-    xmp_set_player(xc, XMP_PLAYER_VOICES, OPT_NUMBER_VOICES)
-    rc = xmp_start_player(xc, OPT_FREQUENCY, OPT_FORMAT)
+    xmp_set_player(xc, XMP_PLAYER_VOICES, options.number_voices)
+    rc = xmp_start_player(xc, options.frequency, options.format)
     if rc != 0:
+        xmp_release_module(xc)
         raise Exception()
-    xmp_set_player(xc, XMP_PLAYER_INTERP, OPT_INTERPOLATE)
-    xmp_set_player(xc, XMP_PLAYER_DSP, OPT_DSP)
+    xmp_set_player(xc, XMP_PLAYER_INTERP, options.interpolate)
+    xmp_set_player(xc, XMP_PLAYER_DSP, options.dsp)
     # if not auto mode,
     # xmp_set_player(xc, XMP_PLAYER_MODE, player mode)
-    xmp_set_player(xc, XMP_PLAYER_AMP, OPT_AMPLIFY)
+    xmp_set_player(xc, XMP_PLAYER_AMP, options.amplify)
     # if mix >= 0:
     # xmp_set_player(xc, XMP_PLAYER_MIX, OPT_MIX)
     # if reversed, set mix to negative OPT_MIX
@@ -82,35 +146,135 @@ def convert(inp_file, outp_file, loop_count = 0):
 
     # mute channels?!?
     flags = xmp_get_player(xc, XMP_PLAYER_CFLAGS)
-    flags = _set_flag(flags, OPT_VBLANK, XMP_FLAGS_VBLANK)
-    flags = _set_flag(flags, OPT_FX9BUG, XMP_FLAGS_FX9BUG)
-    flags = _set_flag(flags, OPT_FIXLOOP, XMP_FLAGS_FIXLOOP)
-    flags = _set_flag(flags, OPT_AMIGA_MIXER, XMP_FLAGS_A500)
+    flags = _set_flag(flags, options.vblank, XMP_FLAGS_VBLANK)
+    flags = _set_flag(flags, options.fx9bug, XMP_FLAGS_FX9BUG)
+    flags = _set_flag(flags, options.fixloop, XMP_FLAGS_FIXLOOP)
+    flags = _set_flag(flags, options.amiga_mixer, XMP_FLAGS_A500)
     xmp_set_player(xc, XMP_PLAYER_CFLAGS, flags)
 
-    out = wave.open(outp_file, 'wb')
-    out.setnchannels(OPT_CHANNEL_COUNT)
-    out.setsampwidth(OPT_SAMPLE_WIDTH)
-    out.setframerate(OPT_FREQUENCY)
-
-    fi = FrameInfo()
-    fi.loop_count = 0
-    while xmp_play_frame(xc) == 0:
-        old_loop = fi.loop_count
-        xmp_get_frame_info(xc, pointer(fi))
-        if old_loop != fi.loop_count:
-            # Looping!
-            loop_count -= 1
-            if loop_count <= 0:
-                break
-        b = fi.get_buffer()
-        # print("Writing frme with {0} bytes".format(len(b)))
-        out.writeframes(b)
 
+def _end_player(xc):
     xmp_end_player(xc)
     xmp_release_module(xc)
-    xmp_free_context(xc)
-    out.close()
+
+
+class _Playing(object):
+    """
+    Context manager around a started player; uses the given xmp context, or
+    a new one that is freed at the end.
+    """
+    def __init__(self, inp_file, options, xc):
+        object.__init__(self)
+        assert isinstance(inp_file, str)
+        self.inp_file = inp_file
+        self.options = options or RenderOptions()
+        self.xc = xc
+        self.__owned = xc is None
+
+    def __enter__(self):
+        if self.__owned:
+            self.xc = create_context()
+        try:
+            _start_player(self.xc, self.inp_file, self.options)
+        except:
+            if self.__owned:
+                free_context(self.xc)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _end_player(self.xc)
+        if self.__owned:
+            free_context(self.xc)
+
+
+def render_frames(inp_file, loop_count = 0, options = None, xc = None):
+    """
+    Generator for the rendered PCM data of the module, one frame at a time.
+    The data is signed 16 bit samples in the native byte order, with the
+    channel count and frequency of the RenderOptions (by default,
+    OPT_CHANNEL_COUNT and OPT_FREQUENCY).
+
+    If an xmp context is given, it is used instead of a new one.
+    """
+    with _Playing(inp_file, options, xc) as playing:
+        xc = playing.xc
+        fi = FrameInfo()
+        fi.loop_count = 0
+        while xmp_play_frame(xc) == 0:
+            old_loop = fi.loop_count
+            xmp_get_frame_info(xc, pointer(fi))
+            if old_loop != fi.loop_count:
+                # Looping!
+                loop_count -= 1
+                if loop_count <= 0:
+                    break
+            yield fi.get_buffer()
+
+
+def render_buffers(inp_file, loop_count = 0, buffer_size = RENDER_BUFFER_SIZE,
+        options = None, xc = None):
+    """
+    Generator for the rendered PCM data of the module (in the same format as
+    render_frames), in large blocks from xmp_play_buffer.
+
+    Each block is a memoryview over one of two buffers that are reused for
+    the whole module, so a block is only valid until the next one is
+    requested; copy it if it must be kept.
+
+    xmp_play_buffer pads the last block with silence, so trailing zero
+    samples are removed from the last block.
+    """
+    with _Playing(inp_file, options, xc) as playing:
+        xc = playing.xc
+        frame_size = playing.options.frame_size
+        buffer_size -= buffer_size % frame_size
+        loop = max(1, loop_count)
+        buffers = []
+        for i in range(2):
+            data = bytearray(buffer_size)
+            buffers.append((memoryview(data), (c_char * buffer_size).from_buffer(data)))
+        current = 0
+        if xmp_play_buffer(xc, buffers[current][1], buffer_size, loop) != 0:
+            return
+        while True:
+            following = 1 - current
+            if xmp_play_buffer(xc, buffers[following][1], buffer_size, loop) != 0:
+                break
+            yield buffers[current][0]
+            current = following
+        last = buffers[current][0]
+        used = len(last.tobytes().rstrip(b'\0'))
+        used += -used % frame_size
+        if used > 0:
+            yield last[0:used]
+
+
+def stream(inp_file, outp, loop_count = 0, options = None, xc = None):
+    """
+    Writes the rendered PCM data (see render_buffers) into the writable
+    binary stream, such as the stdin pipe of an encoder.  A blocking write
+    holds back the rendering until the reader catches up.  Returns the number
+    of bytes written.
+    """
+    total = 0
+    for b in render_buffers(inp_file, loop_count, options=options, xc=xc):
+        outp.write(b)
+        total += len(b)
+    return total
+
+
+def convert(inp_file, outp_file, loop_count = 0, options = None, xc = None):
+    options = options or RenderOptions()
+    out = wave.open(outp_file, 'wb')
+    try:
+        out.setnchannels(options.channel_count)
+        out.setsampwidth(OPT_SAMPLE_WIDTH)
+        out.setframerate(options.frequency)
+        for b in render_buffers(inp_file, loop_count, options=options, xc=xc):
+            out.writeframes(b)
+    finally:
+        out.close()
 
 
 if __name__ == '__main__':
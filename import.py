@@ -5,15 +5,26 @@ import shutil
 import sys
 import traceback
 from convertmusic import (MediaFileHistory, get_history)
+from convertmusic import profiling
 from convertmusic.tools import (
     is_media_file_supported,
     probe_media_file,
     MediaProbe,
     to_ascii,
     tag,
-    get_destdir,
-    transcode_correct_format,
+    OutputLayout,
+    transcode_with_digest,
+    plan_transcode,
 )
+from convertmusic.tools.device_profile import ACTIONS
+from convertmusic.tools.staging import StagingArea
+from convertmusic.tools.fast_copy import COPY_STATS
+from convertmusic.tools import stage_metrics
+from convertmusic.tools import file_trace
+from convertmusic.tools.stage_metrics import timed, timed_iter
+from convertmusic.db.working_copy import WORK_MEMORY
+from convertmusic.tools import pcm_analysis
+from convertmusic.tools.fingerprint import fingerprint_probe
 from convertmusic.tools.cli_output import (OutlineOutput, YamlOutput, JsonOutput)
 from convertmusic.tools.filename_util import (simplify_name, to_filename)
 
@@ -51,28 +62,107 @@ def find_files(rootdir):
                 OUTPUT.error('Link to non-existent file: {0}'.format(filename))
 
 
-def find_new_media(rootdir, history):
+def find_new_media(rootdir, history, processed=None, filenames=None, record_failures=True):
     """
-    Returns media probes for media files not already processed.
+    Returns media probes for media files not already processed.  Files that
+    failed to probe are recorded, and skipped on later runs until they
+    change (see `manage-data.py probe-failures`).  With record_failures
+    False, the failures are only reported, and the database isn't changed.
+
+    `processed` is the PathIndex of processed files (loaded if not given),
+    so known files are skipped without a database query.  `filenames` are
+    the files found under rootdir, if they were already listed.
     """
     assert isinstance(history, MediaFileHistory)
-    for filename in find_files(rootdir):
+    if processed is None:
+        processed = history.load_processed_index()
+    if filenames is None:
+        filenames = find_files(rootdir)
+    for filename in timed_iter('walk', filenames):
         # print("DEBUG - checking {0}".format(repr(filename)))
-        # print('DEBUG checking {0}: supported? {1} processed? {2}'.format(filename, is_media_file_supported(filename), history.is_processed(filename)))
-        if is_media_file_supported(filename) and not history.is_processed(filename):
-            try:
-                probe = probe_media_file(filename)
-                yield probe
-            except Exception as e:
-                OUTPUT.error('Problem loading file {0}: {1}'.format(
-                    filename, e
-                ))
-                # traceback.print_exc()
+        # print('DEBUG checking {0}: supported? {1} processed? {2}'.format(filename, is_media_file_supported(filename), filename in processed))
+        if filename not in processed and is_media_file_supported(filename):
+            file_trace.start(filename)
+            with timed('probe'):
+                if history.is_quarantined(filename):
+                    _file_done('quarantined')
+                    continue
+                try:
+                    probe = probe_media_file(filename)
+                except Exception as e:
+                    OUTPUT.error('Problem loading file {0}: {1}'.format(
+                        filename, e
+                    ))
+                    # traceback.print_exc()
+                    if record_failures:
+                        history.mark_probe_failure(filename, e)
+                    _file_done('probe_failed')
+                    continue
+                if record_failures:
+                    history.clear_probe_failure(filename)
+            yield probe
 
 
-def process_probe(history, base_destdir, probe):
-    OUTPUT.dict_start(probe.filename)
+def count_new_media(filenames, processed):
+    """
+    The number of the listed files that `find_new_media` will look at.
+    """
+    return sum(1 for f in filenames if f not in processed and is_media_file_supported(f))
+
+
+def _file_done(outcome, probe=None, digest=None, **fields):
+    """
+    Counts the file's outcome in the run metrics, and finishes its trace
+    with the extra fields.
+    """
+    bytes_read = 0
+    if probe is not None and probe.tag('size_bytes') is not None:
+        bytes_read = int(probe.tag('size_bytes'))
+    bytes_written = digest is not None and digest[0] or 0
+    metrics = stage_metrics.active()
+    if metrics is not None:
+        metrics.file_done(outcome, bytes_read, bytes_written)
+    trace = file_trace.current()
+    if trace is not None:
+        trace.finish(outcome, bytes_read=bytes_read, bytes_written=bytes_written, **fields)
+
+
+def _fingerprint(probe):
+    if not pcm_analysis.available():
+        return None
     try:
+        with timed('fingerprint'):
+            return fingerprint_probe(probe)
+    except Exception as e:
+        print("*** WARNING: could not fingerprint {0}: {1}".format(probe.filename, e))
+        return None
+
+
+def _record_found(history, probe, fingerprint):
+    with timed('record'):
+        history.mark_found(probe)
+        if fingerprint is not None:
+            history.set_fingerprint(probe, fingerprint)
+
+
+def _record_target(history, probe, destfile, digest):
+    with timed('record'):
+        history.transcoded_to(probe, destfile, digest)
+
+
+def _write_failed(history, layout, probe, destfile, error):
+    layout.release(destfile)
+    # Forget the source, so that the next import tries it again.
+    history.delete_source_record(probe)
+    OUTPUT.error('Could not write {0}: {1}'.format(destfile, error))
+
+
+def _find_duplicate(history, probe):
+    """
+    Marks the probed file as a duplicate if it has the same contents or tags
+    as a known file.  Returns True if it's a duplicate.
+    """
+    with timed('dedupe'):
         matches = history.get_file_duplicate_tag_matches(probe)
         if len(matches) > 0:
             OUTPUT.list_section('exact_duplicate_of', matches)
@@ -80,7 +170,8 @@ def process_probe(history, base_destdir, probe):
             #    probe.filename, ', '.join(matches)
             #))
             history.mark_duplicate(probe, matches[0])
-            return
+            file_trace.note(duplicate='exact', duplicate_of=matches[0])
+            return True
         if probe.tag(tag.ARTIST_NAME) is not None and probe.tag(tag.SONG_NAME) is not None:
             matches = history.get_exact_matches(probe)
             if len(matches) > 0:
@@ -89,7 +180,8 @@ def process_probe(history, base_destdir, probe):
                 #    probe.filename, ', '.join(matches)
                 #))
                 history.mark_duplicate(probe, matches[0])
-                return
+                file_trace.note(duplicate='tags', duplicate_of=matches[0])
+                return True
         matches = history.get_close_matches(probe, 0.9)
         if len(matches) > 0:
             OUTPUT.list_section('close_duplicate_of', matches)
@@ -97,50 +189,246 @@ def process_probe(history, base_destdir, probe):
             #    probe.filename, ', '.join(matches)
             #))
             history.mark_duplicate(probe, matches[0])
+            file_trace.note(duplicate='close', duplicate_of=matches[0])
+            return True
+    return False
+
+
+def process_probe(history, layout, probe, staging=None):
+    """
+    Checks the probed file for duplicates, then puts it into the output.
+    With a StagingArea, the output is written there first, and the target
+    file is only recorded once the staging area has flushed it to the
+    output.  The source is recorded right away, so that the files after it
+    find it as a duplicate.
+    """
+    OUTPUT.dict_start(probe.filename)
+    try:
+        if _find_duplicate(history, probe):
+            _file_done('duplicate', probe)
             return
-        destdir = get_destdir(base_destdir)
+        # The same audio in another encoding, with different tags.
+        fingerprint = _fingerprint(probe)
+        if fingerprint is not None:
+            with timed('dedupe'):
+                matches = history.get_audio_matches(probe, fingerprint)
+                if len(matches) > 0:
+                    OUTPUT.list_section('audio_duplicate_of', [m[0] for m in matches])
+                    history.mark_duplicate(probe, matches[0][0])
+                    file_trace.note(duplicate='audio', duplicate_of=matches[0][0])
+            if len(matches) > 0:
+                _file_done('duplicate', probe)
+                return
+        destdir = layout.get_destdir()
         if not os.path.isdir(destdir):
             os.makedirs(destdir)
         OUTPUT.dict_item('title', probe.tag(tag.SONG_NAME))
         OUTPUT.dict_item('artist', probe.tag(tag.ARTIST_NAME))
         #print("{0} ({1} by {2})".format(probe.filename, probe.tag(tag.SONG_NAME), probe.tag(tag.ARTIST_NAME)))
-        destfile = transcode_correct_format(history, probe, destdir)
+        with timed('transcode'):
+            destfile, digest = transcode_with_digest(history, probe, destdir, layout=layout, staging=staging)
         OUTPUT.dict_item('destination', destfile)
         #print("   -> {0}".format(destfile))
-        history.mark_found(probe)
-        history.transcoded_to(probe, destfile)
+        _record_found(history, probe, fingerprint)
+        if staging is None:
+            _record_target(history, probe, destfile, digest)
+        else:
+            staging.submit(destfile,
+                on_flushed=lambda: _record_target(history, probe, destfile, digest),
+                on_failed=lambda e: _write_failed(history, layout, probe, destfile, e))
+        _file_done('transcoded', probe, digest, destination=destfile)
     finally:
         OUTPUT.dict_end()
 
 
+def explain(history, src_dir):
+    """
+    Reports what would be done with each new media file, without changing
+    anything.
+    """
+    counts = {}
+    for action in ACTIONS:
+        counts[action] = 0
+    OUTPUT.list_start('plan')
+    for probe in find_new_media(src_dir, history, record_failures=False):
+        plan = plan_transcode(probe)
+        counts[plan.action] += 1
+        OUTPUT.dict_start(probe.filename)
+        OUTPUT.dict_item('action', plan.action)
+        OUTPUT.dict_item('codec', probe.codec)
+        OUTPUT.dict_item('extension', plan.extension)
+        OUTPUT.dict_end()
+    OUTPUT.list_end()
+    OUTPUT.dict_section('totals', counts)
+
+
 def main(args):
     if len(args) < 3:
-        print("Usage: main.py [--json] [--yaml] (src music dir) (dest music dir)")
+        print("Usage: main.py [--json] [--yaml] [--explain] [--stage[=dir]] [--local-db[=path]]")
+        print("               [--metrics=file] [--progress] [--trace=file] [--profile=cpu|mem]")
+        print("               (src music dir) (dest music dir)")
+        print("  --explain   only report how many files would be copied, remuxed or encoded")
+        print("  --stage     write the output on local disk (in dir, or a temporary directory)")
+        print("              first, and move it to the destination in large sequential writes")
+        print("  --local-db  work on a copy of media.db in memory (or in the local dir or file),")
+        print("              saved to the destination at checkpoints and at the end")
+        print("  --metrics   write the run summary to the file, as a Prometheus textfile if")
+        print("              it ends in .prom, otherwise as JSON")
+        print("  --progress  list the source files first, then show the progress and time")
+        print("              left on stderr")
+        print("  --trace     append a JSON line for each source file to the file, with its")
+        print("              stage times, decision, and each ffprobe/ffmpeg run's resource use")
+        print("  --profile   run the import under cProfile (cpu) or tracemalloc (mem), and")
+        print("              write the profile to import-(timestamp).pstats or .tracemalloc")
         return 1
     global OUTPUT
     argp = 1
-    if args[argp] == '--json':
-        OUTPUT = JsonOutput(_out_writer)
+    explain_only = False
+    stage = False
+    stage_dir = None
+    db_work = None
+    metrics_file = None
+    progress = False
+    trace_file = None
+    profile_mode = None
+    while argp < len(args) and args[argp].startswith('--'):
+        if args[argp] == '--json':
+            OUTPUT = JsonOutput(_out_writer)
+        elif args[argp] == '--yaml':
+            OUTPUT = YamlOutput(_out_writer)
+        elif args[argp] == '--explain':
+            explain_only = True
+        elif args[argp] == '--stage':
+            stage = True
+        elif args[argp].startswith('--stage='):
+            stage = True
+            stage_dir = args[argp][8:]
+        elif args[argp] == '--local-db':
+            db_work = WORK_MEMORY
+        elif args[argp].startswith('--local-db='):
+            db_work = args[argp][11:]
+        elif args[argp].startswith('--metrics='):
+            metrics_file = args[argp][10:]
+        elif args[argp] == '--progress':
+            progress = True
+        elif args[argp].startswith('--trace='):
+            trace_file = args[argp][8:]
+        elif args[argp].startswith('--profile='):
+            profile_mode = args[argp][10:]
+        else:
+            print("Unknown option {0}".format(args[argp]))
+            return 1
         argp += 1
-    elif args[argp] == '--yaml':
-        OUTPUT = YamlOutput(_out_writer)
-        argp += 1
-    src_dir = args[argp]
-    target_dir = args[argp + 1]
+    if argp + 1 >= len(args):
+        return main(args[0:1])
+    if profile_mode is None:
+        profile_mode = profiling.mode_from_env()
+    error = profile_mode is not None and profiling.check_mode(profile_mode)
+    if error:
+        print(error)
+        return 1
+    with profiling.profiled('import', profile_mode):
+        return run_import(args[argp], args[argp + 1], explain_only, stage, stage_dir, db_work,
+            metrics_file, progress, trace_file)
+
+
+def run_import(src_dir, target_dir, explain_only=False, stage=False, stage_dir=None, db_work=None,
+        metrics_file=None, progress=False, trace_file=None):
+    if explain_only:
+        db_file = os.path.join(target_dir, 'media.db')
+        if not os.path.isfile(db_file):
+            # Don't create anything in explain mode.
+            db_file = ':memory:'
+        history = get_history(db_file, lock=False)
+        try:
+            OUTPUT.start()
+            explain(history, src_dir)
+        finally:
+            OUTPUT.end()
+            history.close()
+        return 0
     if not os.path.isdir(target_dir):
         os.makedirs(target_dir)
-    history = get_history(os.path.join(target_dir, 'media.db'))
+    history = get_history(os.path.join(target_dir, 'media.db'), db_work)
+    layout = OutputLayout(target_dir)
+    staging = None
+    if stage:
+        staging = StagingArea(stage_dir)
+    metrics = stage_metrics.StageMetrics()
+    stage_metrics.enable(metrics)
+    trace_log = None
+    if trace_file is not None:
+        trace_log = file_trace.TraceLog(trace_file)
+        file_trace.enable(trace_log)
+    progress_line = None
     try:
         OUTPUT.start()
+        processed = history.load_processed_index()
+        OUTPUT.dict_section('processed_index', processed.stats())
+        filenames = None
+        if progress:
+            with timed('walk'):
+                filenames = list(find_files(src_dir))
+            progress_line = stage_metrics.ProgressLine(metrics, count_new_media(filenames, processed))
         OUTPUT.list_start('transcoded')
-        for probe in find_new_media(src_dir, history):
-            process_probe(history, target_dir, probe)
+        for probe in find_new_media(src_dir, history, processed, filenames):
+            try:
+                process_probe(history, layout, probe, staging)
+            except BaseException as e:
+                _file_done('failed', probe, error=repr(e))
+                raise
+            processed.add(probe.filename)
+            with timed('commit'):
+                if staging is not None:
+                    staging.drain()
+                history.checkpoint()
+            if progress_line is not None:
+                progress_line.update()
+        if staging is not None:
+            with timed('commit'):
+                staging.flush()
         OUTPUT.list_end()
+        if progress_line is not None:
+            progress_line.close()
+        _output_metrics(metrics)
+        if metrics_file is not None:
+            metrics.write(metrics_file)
+        for method, stats in sorted(COPY_STATS.stats().items()):
+            OUTPUT.dict_section('copied_by_' + method, stats)
+        if staging is not None:
+            OUTPUT.dict_section('staging', staging.stats())
     finally:
+        stage_metrics.enable(None)
+        if trace_log is not None:
+            file_trace.enable(None)
+            trace_log.close()
+        if staging is not None:
+            staging.close()
         OUTPUT.end()
         history.close()
     return 0
 
 
+def _output_metrics(metrics):
+    summary = metrics.summary()
+    OUTPUT.list_start('stage_times')
+    for stage, times in sorted(summary['stages'].items(), key=lambda s: -s[1]['total']):
+        OUTPUT.dict_start(stage)
+        for k in ('count', 'total', 'p50', 'p95', 'p99', 'max', 'share'):
+            OUTPUT.dict_item(k, round(times[k], 4))
+        OUTPUT.dict_end()
+    OUTPUT.list_end()
+    OUTPUT.dict_section('outcomes', summary['outcomes'])
+    OUTPUT.dict_section('run', {
+        'elapsed': round(summary['elapsed'], 2),
+        'files': summary['files'],
+        'files_per_second': round(summary['files_per_second'], 3),
+        'bytes_read': summary['bytes_read'],
+        'bytes_written': summary['bytes_written'],
+        'bytes_read_per_second': int(summary['bytes_read_per_second']),
+        'bytes_written_per_second': int(summary['bytes_written_per_second']),
+    })
+
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -11,17 +11,20 @@ from convertmusic.cmd import (
     Cmd, std_main, OUTPUT, prompt_key, prompt_value
 )
 from convertmusic.cache import (MediaCache, MediaEntry)
+from convertmusic.tools.transcode import copy_file
 from convertmusic.tools import (
     is_media_file_supported,
     MediaProbe,
     to_ascii,
     tag,
     set_tags_on_file,
+    TagWriterPool,
     FfProbeFactory,
     get_media_player,
     get_destdir,
-    transcode_correct_format,
+    transcode_with_digest,
     normalize_audio,
+    source_volume_increase,
     trim_audio
 )
 
@@ -547,7 +550,7 @@ Usage:
 Where:
     -np     don't play the transcoded file after transcoding.
     -v      show the transcode command
-    -norm   attempt to normalize with 0.1 headroom.
+    -norm   normalize with 0.1 headroom while transcoding.
 
 Re-attempts to transcode the file.  If the transcoded file doesn't exist,
 it will be created.
@@ -566,26 +569,21 @@ it will be created.
         if original is not None and os.path.exists(original):
             os.unlink(original)
         verbose = '-v' in args
-        destfile = transcode_correct_format(history, current.probe, get_destdir(base_destdir), verbose=verbose)
+        increase = None
+        if '-norm' in args:
+            increase = source_volume_increase(history, current.probe, 0.1)
+            if increase is None:
+                print("Can't normalize.")
+            else:
+                print("Increasing volume by {0:#.1f}dB".format(increase))
+        destfile, digest = transcode_with_digest(history, current.probe, get_destdir(base_destdir),
+            verbose=verbose, volume=increase)
         if original != destfile:
             print("[debug] replacing old transcode dest ({0}) with ({1})".format(original, destfile))
-            current.set_transcoded_to(destfile)
+            current.set_transcoded_to(destfile, digest)
             print("New transcoded file recorded at {0}".format(destfile))
-        if '-norm' in args:
-            output_fd, output_file = tempfile.mkstemp(
-                suffix=os.path.splitext(destfile)[1])
-            try:
-                headroom = 0.1
-                print("Normalizing file by {1:#.1f} into {0}".format(output_file, headroom))
-                os.close(output_fd)
-                increase = normalize_audio(destfile, output_file, headroom)
-                if increase is None:
-                    print("Can't normalize.")
-                else:
-                    print("Increased volume by {0}dB".format(increase))
-                    shutil.copyfile(output_file, destfile)
-            finally:
-                os.unlink(output_file)
+        else:
+            history.set_transcoded_digest(destfile, digest)
         if "-np" not in args:
             get_media_player().play_file(destfile)
         return current_index
@@ -631,7 +629,8 @@ Where:
                 if v == 'p':
                     get_media_player().play_file(output_file)
                 if v == 'K':
-                    shutil.copyfile(output_file, current.transcoded_to)
+                    history.set_transcoded_digest(current.transcoded_to,
+                        copy_file(output_file, current.transcoded_to))
                     break
                 if v == 's':
                     break
@@ -794,7 +793,8 @@ Where:
                 if v == 'p':
                     get_media_player().play_file(output_file)
                 if v == 'K':
-                    shutil.copyfile(output_file, current.transcoded_to)
+                    history.set_transcoded_digest(current.transcoded_to,
+                        copy_file(output_file, current.transcoded_to))
                     break
                 if v == 's':
                     break
@@ -847,9 +847,14 @@ def add_actions_to_options(action_list, options):
 
 def commit():
     entries = CACHE.commit()
-    for entry in entries:
-        if entry.transcoded_to and os.path.isfile(entry.transcoded_to):
-            set_tags_on_file(entry.transcoded_to, entry.tags)
+    with TagWriterPool() as writers:
+        for entry in entries:
+            if entry.transcoded_to and os.path.isfile(entry.transcoded_to):
+                writers.submit(entry.transcoded_to, entry.tags, rehash=True)
+        for filename, err in writers.wait():
+            print("Could not write tags to {0}: {1}".format(filename, err))
+        for filename, digest in writers.digests.items():
+            CACHE.history.set_transcoded_digest(filename, digest)
     print("Committed {0} entries.".format(len(entries)))
 
 
@@ -13,11 +13,23 @@ from convertmusic.tools import (
     to_ascii,
     tag,
     set_tags_on_file,
-    FfProbeFactory
+    set_tags_and_hash,
+    get_transcode_cache,
 )
+from convertmusic.tools import device_sync
+from convertmusic.tools import file_hash
 from convertmusic.transform_db_path import tform_tcode, reverse_tcode
 
-FF_PROBES = FfProbeFactory()
+_FF_PROBES = None
+
+
+def ff_probes():
+    """The FfProbeFactory, made on first use, since it loads the media tools."""
+    global _FF_PROBES
+    if _FF_PROBES is None:
+        from convertmusic.tools import FfProbeFactory
+        _FF_PROBES = FfProbeFactory()
+    return _FF_PROBES
 
 
 def _do_check_file(fn, args):
@@ -146,7 +158,7 @@ be checked.
                 else:
                     print("Already handled {0}".format(t))
             if adjusted_tags:
-                if FF_PROBES.is_supported(fn):
+                if ff_probes().is_supported(fn):
                     # Fix the source, too.
                     try:
                         set_tags_on_file(fn, fn_tags)
@@ -155,8 +167,9 @@ be checked.
                         OUTPUT.error("Couldn't update tags on source file {0} ({1})".format(
                             fn, e
                         ))
-                set_tags_on_file(tn, fn_tags)
+                digest = set_tags_and_hash(tn, fn_tags)
                 history.set_tags_for(fn, fn_tags)
+                history.set_transcoded_digest(tn, digest)
         print("Finished with tag handling")
         return 0
 
@@ -202,7 +215,7 @@ arguments will be checked.
                     fn_tags[tag_name] = tag_value
                     adjusted_tags = True
             if adjusted_tags:
-                if FF_PROBES.is_supported(fn):
+                if ff_probes().is_supported(fn):
                     # Fix the source, too.
                     try:
                         set_tags_on_file(fn, fn_tags)
@@ -211,8 +224,334 @@ arguments will be checked.
                         OUTPUT.error("Couldn't update tags on source file {0} ({1})".format(
                             fn, e
                         ))
-                set_tags_on_file(local_tn, fn_tags)
+                digest = set_tags_and_hash(local_tn, fn_tags)
                 history.set_tags_for(fn, fn_tags)
+                history.set_transcoded_digest(tn, digest, local_tn)
+        return 0
+
+
+class CmdTranscodeCache(Cmd):
+    def __init__(self):
+        Cmd.__init__(self)
+        self.name = 'transcode-cache'
+        self.desc = 'Show statistics for, or prune, the transcode output cache.'
+        self.help = '''
+Usage:
+    transcode-cache [stats]
+    transcode-cache prune [max size MB]
+    transcode-cache clear
+
+`stats` (the default) shows the cache location, size and entry count.
+`prune` removes the least recently used entries until the cache is no
+larger than the given size, or the configured limit.  `clear` removes all
+entries.
+
+The cache is configured with the environment variables
+CONVERTMUSIC_TRANSCODE_CACHE (the directory, or `off`),
+CONVERTMUSIC_TRANSCODE_CACHE_MB (the size limit) and
+CONVERTMUSIC_TRANSCODE_CACHE_LINK (`reflink`, `hardlink` or `copy`).
+'''
+
+    def _parse_args(self, args):
+        if len(args) <= 0:
+            return True, ['stats', None]
+        if args[0] == 'stats' and len(args) == 1:
+            return True, ['stats', None]
+        if args[0] == 'clear' and len(args) == 1:
+            return True, ['prune', 0]
+        if args[0] == 'prune' and len(args) <= 2:
+            if len(args) == 1:
+                return True, ['prune', None]
+            try:
+                return True, ['prune', int(args[1]) * 1024 * 1024]
+            except ValueError:
+                OUTPUT.error('Invalid size {0}'.format(args[1]))
+                return False, []
+        OUTPUT.error('Unknown arguments: {0}'.format(' '.join(args)))
+        return False, []
+
+    def _cmd(self, history, args):
+        cache = get_transcode_cache()
+        if cache is None:
+            OUTPUT.error('The transcode cache is turned off.')
+            return 1
+        if args[0] == 'prune':
+            count, size = cache.prune(args[1])
+            OUTPUT.dict_section('pruned', {
+                'entries': count,
+                'bytes': size,
+            })
+        OUTPUT.dict_section('transcode_cache', cache.stats())
+        return 0
+
+
+class CmdProbeFailures(Cmd):
+    def __init__(self):
+        Cmd.__init__(self)
+        self.name = 'probe-failures'
+        self.desc = 'List or retry the files that could not be probed.'
+        self.help = '''
+Usage:
+    probe-failures [list] [(file1 (file2 ...))]
+    probe-failures retry [(file1 (file2 ...))]
+    probe-failures clear [(file1 (file2 ...))]
+
+Files that fail to probe during an import (corrupt, unsupported, or an
+ffprobe that timed out) are quarantined: later imports skip them until the
+file changes.
+
+`list` (the default) shows the quarantined files.  `retry` probes them
+again; the ones that now work are released, and will be picked up by the
+next import.  `clear` releases them without probing.  If file matches are
+given, only the matching files are affected.
+
+The probe time limit is set with CONVERTMUSIC_PROBE_TIMEOUT (seconds).
+'''
+
+    def _parse_args(self, args):
+        if len(args) > 0 and args[0] in ('list', 'retry', 'clear'):
+            return True, args
+        return True, ['list', *args]
+
+    def _cmd(self, history, args):
+        action = args[0]
+        search_for = args[1:]
+        OUTPUT.list_start('probe_failures')
+        for failure in history.get_probe_failures():
+            fn = failure['source']
+            if not _do_check_file(fn, search_for):
+                continue
+            OUTPUT.list_dict_start()
+            for k, v in failure.items():
+                OUTPUT.dict_item(k, v)
+            if action == 'clear':
+                history.clear_probe_failure(fn)
+                OUTPUT.dict_item('released', True)
+            elif action == 'retry':
+                released = False
+                if os.path.isfile(fn):
+                    try:
+                        probe_media_file(fn)
+                        history.clear_probe_failure(fn)
+                        released = True
+                    except Exception as e:
+                        history.mark_probe_failure(fn, e)
+                        OUTPUT.dict_item('retry_error', str(e))
+                OUTPUT.dict_item('released', released)
+            OUTPUT.list_dict_end()
+        OUTPUT.list_end()
+        return 0
+
+
+class CmdSync(Cmd):
+    def __init__(self):
+        Cmd.__init__(self)
+        self.name = 'sync'
+        self.desc = 'Mirror the transcoded files onto a removable device.'
+        self.help = """
+Usage:
+    sync [-n] [-f] [-j count] (device directory)
+
+Makes the device directory hold the same transcoded files as the output
+directory, in the same layout.  Only new and changed files are copied, and
+files that are no longer in the output are removed from the device.
+
+The output files are compared by their sha256, which is kept in the
+database and only computed again for files that changed.  The device gets
+a manifest file (""" + device_sync.MANIFEST_NAME + """) listing what it
+holds, so the next sync only needs to list the device, not read it.
+
+Options:
+    -n        only report what would be copied and removed.
+    -f        sync onto a device directory that has files but no manifest;
+              all of those files that aren't in the output are removed.
+    -j count  number of files to hash and copy at once (default """ + str(device_sync.DEFAULT_JOBS) + """).
+
+Use --txtc if the output directory has moved since the files were made.
+"""
+
+    def _parse_args(self, args):
+        dry_run = False
+        force = False
+        jobs = device_sync.DEFAULT_JOBS
+        device_dir = None
+        i = 0
+        while i < len(args):
+            if args[i] == '-n':
+                dry_run = True
+            elif args[i] == '-f':
+                force = True
+            elif args[i] == '-j' and i + 1 < len(args):
+                i += 1
+                try:
+                    jobs = max(1, int(args[i]))
+                except ValueError:
+                    OUTPUT.error('Invalid job count {0}'.format(args[i]))
+                    return False, []
+            elif device_dir is None:
+                device_dir = args[i]
+            else:
+                OUTPUT.error('Unknown argument {0}'.format(args[i]))
+                return False, []
+            i += 1
+        if device_dir is None:
+            OUTPUT.error('Must give the device directory.')
+            return False, []
+        if not os.path.isdir(device_dir):
+            OUTPUT.error('No such directory {0}'.format(device_dir))
+            return False, []
+        return True, [device_dir, dry_run, force, jobs]
+
+    def _cmd(self, history, args):
+        device_dir, dry_run, force, jobs = args
+        db_names = {}
+        records = []
+        for target, size, mtime_ns, sha256 in history.get_transcoded_file_hashes():
+            local = tform_tcode(target)
+            db_names[local] = target
+            records.append((local, size, mtime_ns, sha256))
+        manifest, updates, missing = device_sync.build_master_manifest(records, jobs)
+        history.set_transcoded_file_hashes([
+            (db_names[u[0]], u[1], u[2], u[3]) for u in updates])
+        for fn in missing:
+            OUTPUT.error('Missing transcoded file {0}'.format(fn))
+        base_dir = device_sync.master_base(list(manifest.keys()))
+        if base_dir is None:
+            OUTPUT.error('No transcoded files to sync.')
+            return 1
+        device_real = os.path.realpath(device_dir)
+        base_real = os.path.realpath(base_dir)
+        if os.path.commonpath([device_real, base_real]) == base_real:
+            OUTPUT.error('The device directory must not be inside the output directory {0}'.format(base_dir))
+            return 1
+        master = {}
+        for fn, value in manifest.items():
+            master[device_sync.relative_name(base_dir, fn)] = value
+
+        device_manifest = device_sync.device_manifest_for_sync(device_dir, force)
+        if device_manifest is None:
+            OUTPUT.error('{0} has files but no sync manifest; use -f to sync onto it anyway.'.format(
+                device_dir))
+            return 1
+        trusted, unknown = device_sync.scan_device(device_dir, device_manifest)
+        plan = device_sync.SyncPlan(master, trusted, unknown)
+        OUTPUT.dict_section('sync_plan', {
+            'output': base_dir,
+            'device': device_dir,
+            'hashed': len(updates),
+            'unchanged': plan.unchanged,
+            'copy': len(plan.copies),
+            'copy_bytes': plan.copy_bytes,
+            'delete': len(plan.deletes),
+        })
+        if dry_run:
+            OUTPUT.list_section('copy', plan.copies)
+            OUTPUT.list_section('delete', plan.deletes)
+            return 0
+
+        def on_file(action, name, error):
+            if error is not None:
+                OUTPUT.error('Could not {0} {1}: {2}'.format(action, name, error))
+
+        failed = device_sync.sync_device(base_dir, master, device_dir, plan,
+            jobs=jobs, trusted=trusted, on_file=on_file)
+        OUTPUT.dict_section('synced', {
+            'copied': len(plan.copies) - len([f for f in failed if f[0] in plan.copies]),
+            'deleted': len(plan.deletes) - len([f for f in failed if f[0] in plan.deletes]),
+            'failed': len(failed),
+        })
+        return failed and 1 or 0
+
+
+# Changed files that verify -a recorded.
+ACCEPTED = 'accepted'
+
+
+class CmdVerify(Cmd):
+    def __init__(self):
+        Cmd.__init__(self)
+        self.name = 'verify'
+        self.desc = 'Check the transcoded files against their recorded hashes.'
+        self.help = """
+Usage:
+    verify [-a] [-j count] [(file match 1) ...]
+
+Reads every transcoded file (or those matching the file matches) and
+compares its sha256 with the one recorded when it was written.  Reports
+the files that are missing, that have different contents with the same
+size and modification time (corrupt), and that were changed since they
+were recorded.  Files with no recorded hash have it recorded now.
+
+The tools that change the tags record the new hash, but files changed by
+hand are reported until they're accepted with -a.
+
+Options:
+    -a        accept the changed files: record their current hash, and
+              don't count them as problems.  Corrupt files are never
+              accepted.
+    -j count  number of files to hash at once (default """ + str(device_sync.DEFAULT_JOBS) + """).
+
+Use --txtc if the output directory has moved since the files were made.
+"""
+
+    def _parse_args(self, args):
+        jobs = device_sync.DEFAULT_JOBS
+        accept = False
+        matches = []
+        i = 0
+        while i < len(args):
+            if args[i] == '-a':
+                accept = True
+            elif args[i] == '-j' and i + 1 < len(args):
+                i += 1
+                try:
+                    jobs = max(1, int(args[i]))
+                except ValueError:
+                    OUTPUT.error('Invalid job count {0}'.format(args[i]))
+                    return False, []
+            else:
+                matches.append(args[i])
+            i += 1
+        return True, [jobs, accept, matches]
+
+    def _cmd(self, history, args):
+        jobs, accept, matches = args
+        db_names = {}
+        records = []
+        for target, size, mtime_ns, sha256 in history.get_transcoded_file_hashes():
+            local = tform_tcode(target)
+            if _do_check_file(local, matches):
+                db_names[local] = target
+                records.append((local, size, mtime_ns, sha256))
+        counts = {}
+        updates = []
+        OUTPUT.list_start('problems')
+        for fn, state, size, mtime_ns, sha256 in file_hash.verify_files(records, jobs):
+            counts[state] = counts.get(state, 0) + 1
+            if state == file_hash.UNRECORDED:
+                updates.append((db_names[fn], size, mtime_ns, sha256))
+            elif state != file_hash.OK:
+                accepted = accept and state == file_hash.CHANGED
+                if accepted:
+                    updates.append((db_names[fn], size, mtime_ns, sha256))
+                    counts[ACCEPTED] = counts.get(ACCEPTED, 0) + 1
+                OUTPUT.list_dict_start()
+                OUTPUT.dict_item('file', fn)
+                OUTPUT.dict_item('state', state)
+                if accepted:
+                    OUTPUT.dict_item('accepted', True)
+                OUTPUT.list_dict_end()
+        OUTPUT.list_end()
+        history.set_transcoded_file_hashes(updates)
+        summary = {'checked': len(records)}
+        for state in (file_hash.OK, file_hash.UNRECORDED, file_hash.MISSING,
+                file_hash.CHANGED, ACCEPTED, file_hash.CORRUPT):
+            summary[state] = counts.get(state, 0)
+        OUTPUT.dict_section('verified', summary)
+        problems = summary[file_hash.MISSING] + summary[file_hash.CORRUPT]
+        problems += summary[file_hash.CHANGED] - summary[ACCEPTED]
+        if problems > 0:
+            return 1
         return 0
 
 
@@ -220,7 +559,11 @@ if __name__ == '__main__':
     sys.exit(std_main(sys.argv, (
         CmdDupes(),
         CmdEmptyTags(),
-        CmdFixTags()
+        CmdFixTags(),
+        CmdTranscodeCache(),
+        CmdProbeFailures(),
+        CmdSync(),
+        CmdVerify()
     ), (
         JsonOption(),
         YamlOption(),